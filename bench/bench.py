@@ -0,0 +1,414 @@
+""" end-to-end benchmarks of the acquisition, filtering, storage and api paths.
+
+runs against the emulated load cell on a virtual clock, or against a recorded trace with --trace, so it needs no
+hardware and measures pure cpu cost: run it on the pi (zero) the numbers are wanted for. the gpio drivers' frame
+decoding is timed against a fake RPi.GPIO that clocks out a canned frame. results are printed and, with --output,
+written as json so runs can be compared.
+
+    PYTHONPATH=$PWD python bench/bench.py --output bench-$(hostname).json
+    PYTHONPATH=$PWD python bench/bench.py --only decode,filters --trace field.trace
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import config
+
+from lib.hx711py import hx711_emulator
+from lib.hx711py import hx711_trace
+from lib.hx711py.hx711_filters import SlidingMedian, TrimmedMean, MadGate, ConstantVelocityKalman
+
+SECTIONS = ("decode", "filters", "storage", "api")
+
+def percentiles(samples):
+    """ p50/p90/p99/max/mean of a list of latencies, in milliseconds. """
+    if not samples:
+        return {}
+
+    ordered = sorted(samples)
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"count": len(ordered), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": ordered[-1] * 1000,
+        "mean": sum(ordered) / len(ordered) * 1000}
+
+def build_driver(args):
+    """ a driver that serves frames as fast as they are read: a trace replayed unthrottled or the seeded emulator on
+    a virtual clock. """
+    if args.trace:
+        return hx711_trace.HX711Replay(args.trace, speed=None, loop=True)
+
+    return hx711_emulator.HX711(config.DATA_PIN, config.CLOCK_PIN, clock=hx711_emulator.VirtualClock(), seed=args.seed)
+
+class FakeGPIO(object):
+    """ stands in for RPi.GPIO with an hx711 that always has `frame` ready: DOUT reads low (ready) until PD_SCK is
+    pulsed, then gives one bit of the frame, msb first, after each of the 24 data pulses and reads high after the gain
+    pulses, until the frame is done. PD_SCK held high over 60us powers it down and starts the frame over, like the
+    chip, until reset(). the drivers' decoding is timed on it without a pi or a load cell. """
+    BCM = "BCM"
+    IN = "IN"
+    OUT = "OUT"
+    FALLING = "FALLING"
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, frame=0x5A3C96):
+        self._bits = [(frame >> (23 - i)) & 1 for i in range(24)]
+        self._pulses = 0
+        self._high_since = None
+        self._power_cycles = True
+
+    def reset(self):
+        """ starts a frame over and stops modelling power down: the driver under test is built, and a scheduling hiccup
+        while its frames are timed must not count as one. """
+        self._pulses = 0
+        self._power_cycles = False
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def output(self, pin, value):
+        if value:
+            self._pulses += 1
+            self._high_since = time.perf_counter()
+        elif self._high_since is not None:
+            # the drivers' power down holds PD_SCK high 100us, the chip is off after 60us
+            if self._power_cycles and time.perf_counter() - self._high_since > 0.00006:
+                self._pulses = 0
+            self._high_since = None
+
+    def input(self, pin):
+        pulses = self._pulses
+        if pulses == 0:
+            return 0
+        if pulses <= 24:
+            return self._bits[pulses - 1]
+
+        # read once after the gain pulses, the next conversion is ready right away
+        self._pulses = 0
+        return 1
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        pass
+
+def gpio_driver_module(name, gpio):
+    """ lib.hx711py.`name` bound to the fake gpio, imported with a fake RPi.GPIO off the pi. """
+    if "RPi.GPIO" not in sys.modules:
+        try:
+            importlib.import_module("RPi.GPIO")
+        except ImportError:
+            rpi = types.ModuleType("RPi")
+            rpi.GPIO = gpio
+            sys.modules["RPi"] = rpi
+            sys.modules["RPi.GPIO"] = gpio
+
+    module = importlib.import_module("lib.hx711py." + name)
+    module.GPIO = gpio
+    return module
+
+def per_bit_frame(gpio, driver):
+    """ a frame clocked out the way the drivers did before the bit weight table: a call per bit with the bit format
+    checked on every bit, bytes put in order afterwards. the baseline the table decoder is measured against. """
+    def read_next_bit():
+        gpio.output(driver.PD_SCK, True)
+        gpio.output(driver.PD_SCK, False)
+        return int(gpio.input(driver.DOUT))
+
+    def read_next_byte():
+        byte_value = 0
+        for _ in range(8):
+            if driver.bit_format == 'MSB':
+                byte_value <<= 1
+                byte_value |= read_next_bit()
+            else:
+                byte_value >>= 1
+                byte_value |= read_next_bit() * 0x80
+        return byte_value
+
+    first = read_next_byte()
+    second = read_next_byte()
+    third = read_next_byte()
+    for _ in range(driver.GAIN):
+        read_next_bit()
+    gpio.input(driver.DOUT)
+
+    if driver.byte_format == 'LSB':
+        return (third << 16) | (second << 8) | first
+    return (first << 16) | (second << 8) | third
+
+def bench_gpio_decode(args):
+    results = {}
+    drivers = {}
+    for name in ("hx711", "hx711v0_5_1"):
+        # a chip per driver, each powered down and up while its driver is built
+        gpio = FakeGPIO()
+        module = gpio_driver_module(name, gpio)
+        driver = module.HX711(config.DATA_PIN, config.CLOCK_PIN)
+        driver.set_reading_format("MSB", "MSB")
+        driver.useEdgeDetect = False
+        gpio.reset()
+        drivers[name] = (driver, gpio)
+
+        if driver.clockOutFrame() != 0x5A3C96:
+            raise RuntimeError("bench: {} decoded the fake frame wrong".format(name))
+
+        def frames(count):
+            for _ in range(count):
+                driver.clockOutFrame()
+
+        def raw_longs(count):
+            for _ in range(count):
+                driver.readRawLong()
+
+        results[name] = {"clockOutFrame": rate(frames, args.frames), "readRawLong": rate(raw_longs, args.frames)}
+
+    # hx711.HX711 is left in MSB/MSB, the format the per bit reader handled slowest
+    (driver, gpio) = drivers["hx711"]
+    if per_bit_frame(gpio, driver) != 0x5A3C96:
+        raise RuntimeError("bench: the per bit reader decoded the fake frame wrong")
+
+    def per_bit_frames(count):
+        for _ in range(count):
+            per_bit_frame(gpio, driver)
+
+    results["per_bit"] = rate(per_bit_frames, args.frames)
+    results["speedup"] = results["per_bit"]["us_per_call"] / results["hx711"]["clockOutFrame"]["us_per_call"]
+    return results
+
+def rate(fn, count):
+    start = time.perf_counter()
+    fn(count)
+    elapsed = time.perf_counter() - start
+    return {"count": count, "seconds": elapsed, "per_second": count / elapsed, "us_per_call": elapsed / count * 1000000}
+
+def bench_decode(args):
+    driver = build_driver(args)
+    driver.set_reading_format("MSB", "MSB")
+
+    def raw_bytes(count):
+        for _ in range(count):
+            driver.readRawBytes()
+
+    def read_longs(count):
+        for _ in range(count):
+            driver.read_long()
+
+    results = {"driver": type(driver).__module__ + "." + type(driver).__name__, "readRawBytes": rate(raw_bytes, args.frames),
+        "read_long": rate(read_longs, args.frames)}
+    if not args.trace:
+        results["gpio"] = bench_gpio_decode(args)
+    return results
+
+def bench_filters(args):
+    driver = build_driver(args)
+    driver.set_reference_unit(config.REFERENCE_UNIT)
+
+    results = {}
+    for (name, times, read) in (("read_median", config.MEDIAN_VALUE_N, driver.read_median), ("read_average", 15, driver.read_average)):
+        def calls(count):
+            for _ in range(count):
+                read(times)
+
+        result = rate(calls, max(1, args.frames // times))
+        result["times"] = times
+        result["us_per_sample"] = result["us_per_call"] / times
+        results[name] = result
+
+    # the streaming filters the acquisition channel pushes every sample through, without the driver's cost
+    values = [driver.read_long() for _ in range(args.frames)]
+    streaming = {
+        "SlidingMedian": SlidingMedian(config.MEDIAN_VALUE_N).push,
+        "TrimmedMean": TrimmedMean(15).push,
+        "MadGate": MadGate(config.MEDIAN_VALUE_N, config.OUTLIER_GATE_THRESHOLD).accept,
+    }
+    for (name, push) in streaming.items():
+        def pushes(count):
+            for value in values:
+                push(value)
+        results[name] = rate(pushes, len(values))
+
+    kalman = ConstantVelocityKalman(config.ESTIMATOR_PROCESS_NOISE, config.ESTIMATOR_MEASUREMENT_NOISE)
+    def kalman_pushes(count):
+        t = 0.0
+        for value in values:
+            t += 0.0125
+            kalman.push(value, t)
+    results["ConstantVelocityKalman"] = rate(kalman_pushes, len(values))
+
+    return results
+
+def bench_storage(args):
+    from src.storage import DBWorker, ReadPool
+
+    db = DBWorker("bench")
+    db.start()
+
+    # rows as the sensor worker would log them, one every 0.25s ending now
+    now = time.time_ns()
+    step = 250000000
+    start = time.perf_counter()
+    for i in range(args.rows):
+        db.insert_weight(now - (args.rows - i) * step, 20000 - i * 0.001)
+    enqueued = time.perf_counter() - start
+
+    db.stop()
+    db.join()
+    elapsed = time.perf_counter() - start
+
+    stats = db.commit_stats
+    result = {"rows": args.rows, "enqueue_seconds": enqueued, "seconds": elapsed, "rows_per_second": args.rows / elapsed,
+        "commits": stats["commits"], "commit_ms_mean": stats["commit_seconds"] / max(1, stats["commits"]) * 1000,
+        "commit_ms_max": stats["max_commit_seconds"] * 1000, "commit_rows": config.DB_COMMIT_ROWS}
+
+    reader = ReadPool(db.path, 1)
+    queries = {"hour": 3600, "day": 86400}
+    for (name, span) in queries.items():
+        latencies = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            reader.weights(now - span * 1000000000, now)
+            latencies.append(time.perf_counter() - t)
+        result["history_" + name] = percentiles(latencies)
+
+        latencies = []
+        for _ in range(args.queries):
+            t = time.perf_counter()
+            reader.aggregate(now - span * 1000000000, now, span * 1000000000 // 300)
+            latencies.append(time.perf_counter() - t)
+        result["aggregate_" + name] = percentiles(latencies)
+    reader.close()
+
+    return result
+
+def bench_api(args):
+    try:
+        import uvicorn
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    # the app is built from config on import, point it at the emulator before
+    config.SENSOR_BACKEND = "emulator"
+    config.EMULATOR_SEED = args.seed
+    try:
+        from src import app as api
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    for sensor in api.sensors.values():
+        sensor.db.start()
+    api.start_acquisition()
+    for sensor in api.sensors.values():
+        sensor.start()
+
+    # an hour of history to query
+    now = time.time_ns()
+    for i in range(14400):
+        api.default_sensor.db.insert_weight(now - (14400 - i) * 250000000, 20000 - i * 0.001)
+
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    # let the ring buffer fill so GET / is served from it
+    time.sleep(max(1, config.SENSOR_POLLING_MIN * 2))
+
+    base = "http://127.0.0.1:{}".format(args.port)
+    end = datetime.now(timezone.utc)
+    history = json.dumps({"timestart": (end - timedelta(hours=1)).isoformat(), "timeend": end.isoformat()}).encode()
+
+    requests = {
+        "get_latest": lambda: urllib.request.urlopen(base + "/").read(),
+        "post_history_hour": lambda: urllib.request.urlopen(urllib.request.Request(base + "/", data=history,
+            headers={"Content-Type": "application/json"})).read(),
+    }
+
+    results = {"clients": args.clients}
+    for (name, request) in requests.items():
+        def client():
+            latencies = []
+            for _ in range(args.requests):
+                t = time.perf_counter()
+                request()
+                latencies.append(time.perf_counter() - t)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.clients) as pool:
+            latencies = [latency for future in [pool.submit(client) for _ in range(args.clients)] for latency in future.result()]
+        elapsed = time.perf_counter() - start
+
+        results[name] = percentiles(latencies)
+        results[name]["requests_per_second"] = len(latencies) / elapsed
+
+    server.should_exit = True
+    thread.join()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks acquisition, filtering, storage and the api")
+    parser.add_argument("--only", default=",".join(SECTIONS), help="comma separated sections: " + ", ".join(SECTIONS))
+    parser.add_argument("--trace", help="replay this trace file instead of the emulator")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=20000, help="frames for the decode and filter benchmarks")
+    parser.add_argument("--rows", type=int, default=50000, help="rows inserted through the DBWorker")
+    parser.add_argument("--queries", type=int, default=50, help="history queries per range")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent api clients")
+    parser.add_argument("--requests", type=int, default=100, help="requests per api client")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="also write the results to this json file")
+    args = parser.parse_args()
+
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    output = os.path.abspath(args.output) if args.output else None
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "platform": {"machine": platform.machine(), "processor": platform.processor(), "system": platform.platform(),
+            "python": platform.python_version(), "cpus": os.cpu_count()},
+        "args": vars(args),
+    }
+
+    # keep the per reading debug output out of the measurements
+    config.DEBUG = 0
+
+    benchmarks = {"decode": bench_decode, "filters": bench_filters, "storage": bench_storage, "api": bench_api}
+
+    # db files, calibration pickles etc. are created relative to the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for section in args.only.split(","):
+                section = section.strip()
+                if section not in benchmarks:
+                    parser.error("unknown section: {}".format(section))
+                print("bench: {} ...".format(section), file=sys.stderr)
+                results[section] = benchmarks[section](args)
+        finally:
+            os.chdir(cwd)
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
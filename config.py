@@ -11,9 +11,81 @@ WELDER_TYPE = Welder.MIG
 
 APP_NAME = "weight_tracker"
 
-# Sensor polling rate in seconds. How many seconds the sensor worker takes a reading and writes it to the db
+# Sensor polling rate in seconds. How many seconds the sensor worker takes a reading and writes it to the db when
+# SENSOR_POLLING_ADAPTIVE is off
 SENSOR_POLLING_RATE = 2
 
+# Adaptive polling: log every SENSOR_POLLING_MIN seconds while the weight moves (gas is drawn, a cylinder is swapped) and
+# back off by SENSOR_POLLING_BACKOFF every time a whole interval passed, up to SENSOR_POLLING_MAX seconds, while it is
+# flat
+SENSOR_POLLING_ADAPTIVE = True
+SENSOR_POLLING_MIN = 0.25
+SENSOR_POLLING_MAX = 300
+SENSOR_POLLING_BACKOFF = 2
+# The weight counts as moving above this slope (weight units per second) or this standard deviation over the readings
+# of the last SENSOR_POLLING_WINDOW seconds ...
+SENSOR_POLLING_SLOPE_THRESHOLD = 0.2
+SENSOR_POLLING_STDDEV_THRESHOLD = 2
+SENSOR_POLLING_WINDOW = 5
+# ... and only counts as flat again once both are below threshold * SENSOR_POLLING_HYSTERESIS
+SENSOR_POLLING_HYSTERESIS = 0.5
+
+# Acquisition mode. "continuous" clocks samples out of the hx711 at its native rate into a ring buffer and readings
+# are computed from the buffer. "polling" takes MEDIAN_VALUE_N blocking reads from the hx711 for every reading.
+# "process" is "continuous" with the hx711s clocked by a process of their own into a shared memory ring buffer, so
+# frame timing doesn't depend on the load of the api. "interrupt" is "continuous" on the hx711v0_5_1 driver, every
+# frame is read from its DOUT falling edge callback instead of a polling thread (channel A only).
+ACQUISITION_MODE = "continuous"
+
+# Seconds the acquisition scheduler sleeps when none of several sensors has a sample ready and it can't tell when the
+# next one is due
+ACQUISITION_IDLE_SLEEP = 0.001
+
+# Conversions per second of the hx711s, set by their RATE pin: 10 (low) or 80 (high). A sensor in SENSORS can override
+# it with a "sample_rate" key. The acquisition scheduler sleeps until the next conversion is due instead of polling.
+SENSOR_SAMPLE_RATE = 80
+
+# Number of raw samples kept in the ring buffer (~12s at 80 SPS, ~100s at 10 SPS)
+SAMPLE_RING_SIZE = 1024
+
+# Seconds a single hx711 sample may take before the read fails with a timeout (an unplugged load cell never signals
+# ready). 10 SPS needs at least 0.1s.
+SENSOR_READ_TIMEOUT = 0.5
+
+# Frames in a row a single hx711 read throws away when they fail the integrity checks (PD_SCK held high too long,
+# saturated, all ones, DOUT low after the frame) before it fails. Retries stay within SENSOR_READ_TIMEOUT.
+SENSOR_FRAME_RETRIES = 3
+
+# Upper bound in seconds for a complete blocking reading (median, tare) requested through the api
+SENSOR_REQUEST_TIMEOUT = 5
+
+# Age in seconds after which buffered samples are considered stale and a blocking read is taken instead. A channel of an
+# hx711 read on both is stale only after the longest gap between its runs (plus a frame) if that is longer, and waits
+# for its next run instead, a blocking read would switch the channel under the run scheduler.
+SAMPLE_MAX_AGE = 1
+
+# Tare and calibration run as background jobs. A tare averages TARE_SAMPLES samples (trimmed mean), a calibration takes
+# the median of MEDIAN_VALUE_N. While samples are being clocked into the ring buffer the jobs take the next ones from
+# there, polling it every JOB_POLL_INTERVAL seconds, instead of reading the hx711 themselves. The api keeps the last
+# JOB_HISTORY finished jobs.
+TARE_SAMPLES = 15
+JOB_POLL_INTERVAL = 0.01
+JOB_HISTORY = 100
+
+''' DATABASE '''
+# Rows are group committed: the db worker commits once this many rows are pending ...
+DB_COMMIT_ROWS = 500
+# ... or this many seconds passed since the last commit. This is also how much logging a power loss can cost.
+DB_COMMIT_INTERVAL = 5
+# Max number of queued statements drained and executed in one go
+DB_BATCH_MAX = 1000
+# WAL + NORMAL only syncs on checkpoints instead of on every commit, which saves the sd card on append-heavy logging
+DB_JOURNAL_MODE = "WAL"
+DB_SYNCHRONOUS = "NORMAL"
+# Number of read-only connections history queries run on, and how long (seconds) a query waits for a free one
+DB_READ_POOL_SIZE = 2
+DB_READ_TIMEOUT = 5
+
 ''' RASPBERRY PI ZERO W 1.1 PIN DEFINITIONS'''
 # hx711 device pins
 DATA_PIN = 5    # GPIO5
@@ -22,8 +94,67 @@ CLOCK_PIN = 6   # GPIO6
 # led pin
 LED_PIN = 25    # GPIO25
 
+# Driver behind every sensor: "hx711" bit-bangs the real chip over RPi.GPIO, "emulator" generates samples in software
+# (lib/hx711py/hx711_emulator.py) so the whole app runs on a machine without a load cell and "replay" plays back the
+# trace file in the sensor's "replay_file" key (lib/hx711py/hx711_trace.py). A sensor in SENSORS can override it with a
+# "backend" key.
+SENSOR_BACKEND = "hx711"
+# Seed of the emulator's noise, None for different samples on every start
+EMULATOR_SEED = None
+# Speed a trace is replayed at, 1 is real time. The app's own timers (polling, db timestamps, analytics) stay on the
+# wall clock, so only 1 keeps them consistent with the replayed samples.
+REPLAY_SPEED = 1
+
+# Load cells driven by this pi. Every sensor has its own pins, its own file its tare/calibration is saved to and its own
+# db series ("{APP_NAME}-{name}-db"). The first one is the default the api answers for when no sensor is given. A
+# "trace_file" key records every raw frame the sensor reads to that file (~80MB per day at 80 SPS). Two sensors on the
+# same pins are the two inputs of one hx711, the one with "channel": "B" is read on channel B (gain 32).
+SENSORS = [
+    {"name": WELDER_TYPE.name, "data_pin": DATA_PIN, "clock_pin": CLOCK_PIN, "config_file": "hx711.obj.config"},
+    # {"name": Welder.TIG.name, "data_pin": 13, "clock_pin": 19, "config_file": "hx711-TIG.obj.config"},
+    # {"name": Welder.TIG.name, "data_pin": DATA_PIN, "clock_pin": CLOCK_PIN, "channel": "B", "config_file": "hx711-TIG.obj.config"},
+]
+
+# Both inputs of one hx711 are read in runs of this many kept samples per channel, a sensor's "run_frames" key
+# overrides it (longer runs give that channel a larger share of the sample rate). A switch costs no extra frame but the
+# first CHANNEL_SETTLE_FRAMES frames converted after it are unsettled and thrown away.
+CHANNEL_RUN_FRAMES = 16
+CHANNEL_SETTLE_FRAMES = 1
+
 ''' Program Specific Variables'''
 REFERENCE_UNIT = 7455.333/311.845
 
-# Do NOT make this value even there is a bug in the library code. only odd.
-MEDIAN_VALUE_N = 13
\ No newline at end of file
+# Number of samples the median is taken over. Odd values return the centre sample, even values the mean of the two
+# middle samples.
+MEDIAN_VALUE_N = 13
+
+# Samples further than this many robust standard deviations (1.4826 * MAD) from the running median are dropped
+# before they reach the median filter.
+OUTLIER_GATE_THRESHOLD = 3.5
+
+# Kalman filter tracking weight and flow (its rate of change) from every accepted sample in continuous mode. Readings
+# then come from the estimate instead of the median, which settles faster for the same precision. Both noise figures
+# are standard deviations in raw hx711 counts (REFERENCE_UNIT counts per weight unit): how much the flow may change
+# per second and the noise on a single sample.
+ESTIMATOR_ENABLED = True
+ESTIMATOR_PROCESS_NOISE = 10
+ESTIMATOR_MEASUREMENT_NOISE = 50
+
+''' ANALYTICS '''
+# Windows (name: seconds) consumption rates and time-to-empty forecasts are kept for
+ANALYTICS_WINDOWS = {"hour": 60 * 60, "shift": 8 * 60 * 60, "day": 24 * 60 * 60, "week": 7 * 24 * 60 * 60}
+# Every window is decimated into this many buckets, memory and the cost of expiring a bucket don't grow with its span
+ANALYTICS_BUCKETS = 60
+# Weight at which a cylinder counts as empty, used when a sensor in SENSORS has no "empty_weight" of its own
+ANALYTICS_EMPTY_WEIGHT = 0
+# A weight increase larger than this is a cylinder swap and restarts all windows
+ANALYTICS_REFILL_THRESHOLD = 1000
+# Seconds a computed analytics snapshot is served before it is recomputed
+ANALYTICS_CACHE_TTL = 5
+
+# Weld sessions: flow (weight units per second) below which a cylinder counts as idle, the weight that has to be drawn
+# beyond that to start a session and the weight that would have been drawn at that flow during the pause that ends it
+# (0.05 and 1.5 end a session after 30s without gas being drawn)
+SESSION_DRIFT = 0.05
+SESSION_START_THRESHOLD = 3
+SESSION_END_THRESHOLD = 1.5
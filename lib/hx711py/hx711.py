@@ -2,6 +2,60 @@ import RPi.GPIO as GPIO
 import time
 import threading
 
+try:
+    from .hx711_filters import SlidingMedian, TrimmedMean
+except ImportError:
+    from hx711_filters import SlidingMedian, TrimmedMean
+
+
+def buildBitWeights(byteFormat, bitFormat):
+    # Lookup table with, for each of the 24 data bits in the order they are
+    # clocked out of the HX711, the value that bit carries in the final 24bit
+    # twos complement word. Byte and bit ordering are resolved here once, so
+    # the clock-out loop only has to OR in a table entry for every high bit.
+    weights = []
+
+    for bitIndex in range(24):
+        byteIndex = bitIndex // 8
+        bitInByte = bitIndex % 8
+
+        if byteFormat == 'MSB':
+            byteShift = (2 - byteIndex) * 8
+        else:
+            byteShift = byteIndex * 8
+
+        if bitFormat == 'MSB':
+            bitShift = 7 - bitInByte
+        else:
+            bitShift = bitInByte
+
+        weights.append(1 << (byteShift + bitShift))
+
+    return tuple(weights)
+
+def buildSuspectFrames(bitWeights):
+    # The 24bit words, in the configured byte and bit order, of frames that
+    # can't be trusted, mapped to the check they fail: positive (0x7FFFFF)
+    # and negative (0x800000) saturation, and all ones, which is what a chip
+    # that powered down in the middle of a frame clocks out. The first bit
+    # clocked out is the sign bit.
+    signBit = bitWeights[0]
+
+    return {0xFFFFFF ^ signBit: "saturated", signBit: "saturated", 0xFFFFFF: "stuck"}
+
+class HX711TimeoutError(TimeoutError):
+    # Raised when a read doesn't complete before its deadline, either because
+    # another thread held the read lock or because the HX711 never pulled DOUT
+    # low (unplugged or powered down load cell).
+    pass
+
+
+class HX711FrameError(IOError):
+    # Raised when a read gives up after frameRetries frames in a row failed
+    # the integrity checks (see checkFrame()).
+    pass
+
+
 class HX711:
 
     def __init__(self, dout, pd_sck, gain=128):
@@ -11,7 +65,9 @@ class HX711:
 
         # Mutex for reading from the HX711, in case multiple threads in client
         # software try to access get values from the class at the same time.
-        self.readLock = threading.Lock()
+        # Reentrant, so a caller can hold it across selecting a gain and
+        # reading, with both channels of the HX711 in use.
+        self.readLock = threading.RLock()
         
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.PD_SCK, GPIO.OUT)
@@ -30,8 +86,46 @@ class HX711:
 
         self.DEBUG_PRINTING = False
 
+        # Seconds a single read may take when the caller doesn't pass a
+        # deadline. None waits forever.
+        self.readTimeout = 1.0
+
+        # Waiting for DOUT sleeps on a falling edge interrupt when possible,
+        # re-checking DOUT every readyPollInterval seconds. Without edge
+        # detection it just sleeps readyPollInterval between checks.
+        self.useEdgeDetect = True
+        self.readyPollInterval = 0.005
+
+        # Conversions per second the RATE pin selects (10 or 80). Not used
+        # for reading, schedulers driving several HX711s sleep until the
+        # next conversion is due with it.
+        self.sampleRateHz = 80.0
+
+        # Timings (seconds) of the last frame read: waiting for the read
+        # lock, waiting for DOUT, clocking the frame out and the whole time
+        # the lock was held. Cheap to keep, read by whoever wants metrics.
+        self.lastLockWait = 0.0
+        self.lastReadyWait = 0.0
+        self.lastClockOut = 0.0
+        self.lastLockHold = 0.0
+
+        # Frame integrity checks. A frame is thrown away and the next one read
+        # (up to frameRetries times per read, within the read's deadline) when
+        # PD_SCK may have been high longer than highTimeBudget seconds (the
+        # HX711 powers down after 60us), when it is saturated or all ones, or
+        # when DOUT isn't high after it. Failures are counted per check.
+        self.checkFrames = True
+        self.frameRetries = 3
+        self.highTimeBudget = 0.00006
+        self.frameErrorCounts = {"timing": 0, "saturated": 0, "stuck": 0, "dout": 0}
+        self.frameFailureCount = 0
+        self.lastHighTime = 0.0
+        self.lastDoutHigh = True
+
         self.byte_format = 'MSB'
         self.bit_format = 'MSB'
+        self.bitWeights = buildBitWeights(self.byte_format, self.bit_format)
+        self.suspectFrames = buildSuspectFrames(self.bitWeights)
 
         self.set_gain(gain)
         
@@ -46,6 +140,45 @@ class HX711:
     def is_ready(self):
         return GPIO.input(self.DOUT) == 0
 
+
+    def wait_ready(self, deadline=None):
+        # Wait until the HX711 pulls DOUT low or the deadline (a
+        # time.monotonic() value) passes. Returns False on timeout.
+        #
+        # Instead of spinning on is_ready() we block on a falling edge of DOUT,
+        # which doesn't burn any CPU. The wait is capped at readyPollInterval
+        # and DOUT re-checked: an edge that happened just before we started
+        # waiting is missed, and DOUT then stays low until the sample is read.
+        while not self.is_ready():
+            wait = self.readyPollInterval
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            if self.useEdgeDetect:
+                try:
+                    GPIO.wait_for_edge(self.DOUT, GPIO.FALLING, timeout=max(1, int(wait * 1000)))
+                    continue
+                except RuntimeError:
+                    # Edge detection is already in use on DOUT (for example
+                    # by hx711_add_event_detect). Fall back to sleeping.
+                    self.useEdgeDetect = False
+
+            time.sleep(wait)
+
+        return True
+
+
+    def get_deadline(self, deadline=None):
+        # Deadline for a read when the caller didn't supply one.
+        if deadline is not None or self.readTimeout is None:
+            return deadline
+
+        return time.monotonic() + self.readTimeout
+
     
     def set_gain(self, gain):
         if gain == 128:
@@ -73,228 +206,275 @@ class HX711:
         return 0
         
 
-    def readNextBit(self):
-       # Clock HX711 Digital Serial Clock (PD_SCK).  DOUT will be
-       # ready 1us after PD_SCK rising edge, so we sample after
-       # lowering PD_SCL, when we know DOUT will be stable.
-       GPIO.output(self.PD_SCK, True)
-       GPIO.output(self.PD_SCK, False)
-       value = GPIO.input(self.DOUT)
-
-       # Convert Boolean to int and return it.
-       return int(value)
-
-
-    def readNextByte(self):
-       byteValue = 0
-
-       # Read bits and build the byte from top, or bottom, depending
-       # on whether we are in MSB or LSB bit mode.
-       for x in range(8):
-          if self.bit_format == 'MSB':
-             byteValue <<= 1
-             byteValue |= self.readNextBit()
-          else:
-             byteValue >>= 1              
-             byteValue |= self.readNextBit() * 0x80
-
-       # Return the packed byte.
-       return byteValue 
-        
+    def readRawLong(self, deadline=None):
+        deadline = self.get_deadline(deadline)
 
-    def readRawBytes(self):
         # Wait for and get the Read Lock, in case another thread is already
         # driving the HX711 serial interface.
-        self.readLock.acquire()
-
-        # Wait until HX711 is ready for us to read a sample.
-        while not self.is_ready():
-           pass
-
-        # Read three bytes of data from the HX711.
-        firstByte  = self.readNextByte()
-        secondByte = self.readNextByte()
-        thirdByte  = self.readNextByte()
+        perfCounter = time.perf_counter
+        start = perfCounter()
+        lockTimeout = -1 if deadline is None else max(0, deadline - time.monotonic())
+        if not self.readLock.acquire(timeout=lockTimeout):
+            raise HX711TimeoutError("HX711::readRawLong(): timed out waiting for the read lock")
+
+        try:
+            locked = perfCounter()
+            failures = 0
+
+            while True:
+                # Wait until HX711 is ready for us to read a sample.
+                if not self.wait_ready(deadline):
+                    raise HX711TimeoutError("HX711::readRawLong(): timed out waiting for the HX711 to become ready")
+
+                ready = perfCounter()
+                value = self.clockOutFrame()
+                done = perfCounter()
+
+                error = self.checkFrame(value) if self.checkFrames else None
+                if error is None:
+                    break
+
+                # Throw the frame away and read the next one.
+                self.frameErrorCounts[error] += 1
+                failures += 1
+                if failures > self.frameRetries:
+                    self.frameFailureCount += 1
+                    raise HX711FrameError("HX711::readRawLong(): %d frames in a row failed the integrity checks, last: %s" % (failures, error))
+
+                # A HX711 that powered down comes back up on channel A, gain
+                # 128, and its next frame is converted at that gain.
+                if error == "timing" and self.GAIN != 1:
+                    if not self.wait_ready(deadline):
+                        raise HX711TimeoutError("HX711::readRawLong(): timed out waiting for the HX711 to become ready")
+                    self.clockOutFrame()
+
+            self.lastLockWait = locked - start
+            self.lastReadyWait = ready - locked
+            self.lastClockOut = done - ready
+            self.lastLockHold = done - locked
+            return value
+
+        finally:
+            # Release the Read Lock, now that we've finished driving the HX711
+            # serial interface.
+            self.readLock.release()
+
+
+    def clockOutFrame(self):
+        # Bind everything the clock-out loop touches to locals, keeping the
+        # time PD_SCK spends high as short as possible.
+        output = GPIO.output
+        readBit = GPIO.input
+        perfCounter = time.perf_counter
+        pdSck = self.PD_SCK
+        dout = self.DOUT
+        value = 0
+
+        # Upper bound of the time PD_SCK was high, timed around every pulse.
+        # The timer is read while PD_SCK is low, where time doesn't matter.
+        maxHighTime = 0.0
+
+        # Clock the 24 data bits straight into one integer. Byte and bit
+        # ordering are taken care of by the bitWeights lookup table.
+        for weight in self.bitWeights:
+           pulseStart = perfCounter()
+           output(pdSck, True)
+           output(pdSck, False)
+           highTime = perfCounter() - pulseStart
+           if readBit(dout):
+              value |= weight
+           if highTime > maxHighTime:
+              maxHighTime = highTime
 
         # HX711 Channel and gain factor are set by number of bits read
         # after 24 data bits.
         for i in range(self.GAIN):
            # Clock a bit out of the HX711 and throw it away.
-           self.readNextBit()
+           pulseStart = perfCounter()
+           output(pdSck, True)
+           output(pdSck, False)
+           highTime = perfCounter() - pulseStart
+           if highTime > maxHighTime:
+              maxHighTime = highTime
+
+        # The 25th pulse pulls DOUT high until the next conversion is ready.
+        self.lastDoutHigh = readBit(dout)
+        self.lastHighTime = maxHighTime
+
+        # Return the 24bit 2s complement value.
+        return value
 
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()           
 
-        # Depending on how we're configured, return an ordered list of raw byte
-        # values.
-        if self.byte_format == 'LSB':
-           return [thirdByte, secondByte, firstByte]
-        else:
-           return [firstByte, secondByte, thirdByte]
+    def checkFrame(self, value):
+        # Returns the check the frame just clocked out failed, or None. A
+        # PD_SCK pulse over budget may have powered the chip down mid frame;
+        # lost or extra bits leave DOUT low after the frame.
+        if self.lastHighTime > self.highTimeBudget:
+            return "timing"
 
+        error = self.suspectFrames.get(value)
+        if error is not None:
+            return error
 
-    def read_long(self):
-        # Get a sample from the HX711 in the form of raw bytes.
-        dataBytes = self.readRawBytes()
+        if not self.lastDoutHigh:
+            return "dout"
 
+        return None
 
-        if self.DEBUG_PRINTING:
-            print(dataBytes,)
-        
-        # Join the raw bytes into a single 24bit 2s complement value.
-        twosComplementValue = ((dataBytes[0] << 16) |
-                               (dataBytes[1] << 8)  |
-                               dataBytes[2])
+
+    def readRawBytes(self, deadline=None):
+        # Get a sample and split it back into raw bytes. The byte order
+        # configured with set_reading_format has already been applied, so
+        # joining these bytes MSB first gives the sample back.
+        rawValue = self.readRawLong(deadline)
+
+        return [(rawValue >> 16) & 0xFF, (rawValue >> 8) & 0xFF, rawValue & 0xFF]
+
+
+    def read_long(self, deadline=None):
+        # Get a sample from the HX711 as a 24bit 2s complement value.
+        twosComplementValue = self.readRawLong(deadline)
 
         if self.DEBUG_PRINTING:
             print("Twos: 0x%06x" % twosComplementValue)
         
         # Convert from 24bit twos-complement to a signed value.
-        signedIntValue = self.convertFromTwosComplement24bit(twosComplementValue)
+        signedIntValue = twosComplementValue - ((twosComplementValue & 0x800000) << 1)
 
         # Record the latest sample value we've read.
         self.lastVal = signedIntValue
 
         # Return the sample value we've read from the HX711.
-        return int(signedIntValue)
+        return signedIntValue
 
     
-    def read_average(self, times=3):
+    def read_average(self, times=3, deadline=None):
         # Make sure we've been asked to take a rational amount of samples.
         if times <= 0:
             raise ValueError("HX711()::read_average(): times must >= 1!!")
 
         # If we're only average across one value, just read it and return it.
         if times == 1:
-            return self.read_long()
+            return self.read_long(deadline)
 
         # If we're averaging across a low amount of values, just take the
         # median.
         if times < 5:
-            return self.read_median(times)
-
-        # If we're taking a lot of samples, we'll collect them in a list, remove
-        # the outliers, then take the mean of the remaining set.
-        valueList = []
-
-        for x in range(times):
-            valueList += [self.read_long()]
-
-        valueList.sort()
-
-        # We'll be trimming 20% of outlier samples from top and bottom of collected set.
-        trimAmount = int(len(valueList) * 0.2)
-
-        # Trim the edge case values.
-        valueList = valueList[trimAmount:-trimAmount]
+            return self.read_median(times, deadline)
 
-        # Return the mean of remaining samples.
-        return sum(valueList) / len(valueList)
+        # If we're taking a lot of samples, we'll trim 20% of outlier samples
+        # from top and bottom of the collected set and take the mean of the rest.
+        return self.read_filtered(TrimmedMean(times, 0.2), times, deadline)
 
 
     # A median-based read method, might help when getting random value spikes
     # for unknown or CPU-related reasons
-    def read_median(self, times=3):
+    def read_median(self, times=3, deadline=None):
        if times <= 0:
           raise ValueError("HX711::read_median(): times must be greater than zero!")
       
        # If times == 1, just return a single reading.
        if times == 1:
-          return self.read_long()
+          return self.read_long(deadline)
 
-       valueList = []
+       # Odd times return the centre value, even times the arithmetic mean of
+       # the two middle values.
+       return self.read_filtered(SlidingMedian(times), times, deadline)
 
-       for x in range(times):
-          valueList += [self.read_long()]
 
-       valueList.sort()
+    # Feeds `times` new samples into a streaming filter from hx711_filters and
+    # returns its value. A long lived filter can be passed in to keep filtering
+    # a continuous stream instead of re-sorting a fresh batch on every call.
+    # The deadline, if given, bounds all `times` reads together.
+    def read_filtered(self, valueFilter, times=1, deadline=None):
+       for x in range(times):
+          valueFilter.push(self.read_long(deadline))
 
-       # If times is odd we can just take the centre value.
-       if (times & 0x1) == 0x1:
-          return valueList[len(valueList) // 2]
-       else:
-          # If times is even we have to take the arithmetic mean of
-          # the two middle values.
-          midpoint = len(valueList) / 2
-          return sum(valueList[midpoint:midpoint+2]) / 2.0
+       return valueFilter.value
 
 
     # Compatibility function, uses channel A version
-    def get_value(self, times=3):
-        return self.get_value_A(times)
+    def get_value(self, times=3, deadline=None):
+        return self.get_value_A(times, deadline)
 
 
-    def get_value_A(self, times=3):
-        return self.read_median(times) - self.get_offset_A()
+    def get_value_A(self, times=3, deadline=None):
+        return self.read_median(times, deadline) - self.get_offset_A()
 
 
-    def get_value_B(self, times=3):
-        # for channel B, we need to set_gain(32)
+    def get_value_B(self, times=3, deadline=None):
+        # for channel B, we need to set_gain(32), unless it's selected already
         g = self.get_gain()
-        self.set_gain(32)
-        value = self.read_median(times) - self.get_offset_B()
-        self.set_gain(g)
+        if g != 32:
+            self.set_gain(32)
+        value = self.read_median(times, deadline) - self.get_offset_B()
+        if g != 32:
+            self.set_gain(g)
         return value
 
     # Compatibility function, uses channel A version
-    def get_weight(self, times=3):
-        return self.get_weight_A(times)
+    def get_weight(self, times=3, deadline=None):
+        return self.get_weight_A(times, deadline)
 
 
-    def get_weight_A(self, times=3):
-        value = self.get_value_A(times)
+    def get_weight_A(self, times=3, deadline=None):
+        value = self.get_value_A(times, deadline)
         value = value / self.REFERENCE_UNIT
         return value
 
-    def get_weight_B(self, times=3):
-        value = self.get_value_B(times)
+    def get_weight_B(self, times=3, deadline=None):
+        value = self.get_value_B(times, deadline)
         value = value / self.REFERENCE_UNIT_B
         return value
     
 
     # Sets tare for channel A for compatibility purposes
-    def tare(self, times=15):
-        return self.tare_A(times)
+    def tare(self, times=15, deadline=None):
+        return self.tare_A(times, deadline)
     
     
-    def tare_A(self, times=15):
+    def tare_A(self, times=15, deadline=None):
         # Backup REFERENCE_UNIT value
         backupReferenceUnit = self.get_reference_unit_A()
         self.set_reference_unit_A(1)
         
-        value = self.read_average(times)
+        try:
+            value = self.read_average(times, deadline)
+        finally:
+            # Restore the reference unit, even if the read timed out.
+            self.set_reference_unit_A(backupReferenceUnit)
 
         if self.DEBUG_PRINTING:
             print("Tare A value:", value)
         
         self.set_offset_A(value)
 
-        # Restore the reference unit, now that we've got our offset.
-        self.set_reference_unit_A(backupReferenceUnit)
-
         return value
 
 
-    def tare_B(self, times=15):
+    def tare_B(self, times=15, deadline=None):
         # Backup REFERENCE_UNIT value
         backupReferenceUnit = self.get_reference_unit_B()
         self.set_reference_unit_B(1)
 
-        # for channel B, we need to set_gain(32)
+        # for channel B, we need to set_gain(32), unless it's selected already
         backupGain = self.get_gain()
-        self.set_gain(32)
-
-        value = self.read_average(times)
+        if backupGain != 32:
+            self.set_gain(32)
+
+        try:
+            value = self.read_average(times, deadline)
+        finally:
+            # Restore gain/channel/reference unit settings, even if the read
+            # timed out.
+            if backupGain != 32:
+                self.set_gain(backupGain)
+            self.set_reference_unit_B(backupReferenceUnit)
 
         if self.DEBUG_PRINTING:
             print("Tare B value:", value)
         
         self.set_offset_B(value)
-
-        # Restore gain/channel/reference unit settings.
-        self.set_gain(backupGain)
-        self.set_reference_unit_B(backupReferenceUnit)
        
         return value
 
@@ -314,6 +494,9 @@ class HX711:
         else:
             raise ValueError("Unrecognised bitformat: \"%s\"" % bit_format)
 
+        self.bitWeights = buildBitWeights(self.byte_format, self.bit_format)
+        self.suspectFrames = buildSuspectFrames(self.bitWeights)
+
             
     # sets offset for channel A for compatibility reasons
     def set_offset(self, offset):
@@ -3,42 +3,189 @@ import random
 import math
 import threading
 
+try:
+    from .hx711_filters import SlidingMedian, TrimmedMean
+except ImportError:
+    from hx711_filters import SlidingMedian, TrimmedMean
+
+
+class HX711TimeoutError(TimeoutError):
+    # Raised when a read doesn't complete before its deadline.
+    pass
+
+
+class HX711FrameError(IOError):
+    # Raised when a read gives up after frameRetries frames in a row failed
+    # the integrity checks.
+    pass
+
+
+# Frames the integrity checks reject, MSB first: positive and negative
+# saturation and all ones (a chip that powered down mid frame).
+SUSPECT_FRAMES = {0x7FFFFF: "saturated", 0x800000: "saturated", 0xFFFFFF: "stuck"}
+
+
+class RealClock:
+    # The wall clock. Default clock of the emulator, samples come at the
+    # configured rate in real time.
+
+    def time(self):
+        return time.time()
+
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock:
+    # A clock for running the emulator faster than real time. With
+    # speed=None it only moves when somebody sleeps on it and a sleep returns
+    # immediately, so a day of 80 SPS samples is generated as fast as the CPU
+    # allows. Sleeps from several threads all advance the same clock. With
+    # speed=N it runs N times faster than the wall clock, whether anybody
+    # sleeps on it or not, and a sleep takes 1/N real seconds per virtual
+    # second: a scheduler that only polls is_ready() sees time pass, and
+    # threads sleeping side by side don't add up their sleeps.
+    #
+    # time() and monotonic() return the same virtual time, which starts at
+    # `start` (the current wall time by default). Deadlines for reads from an
+    # emulator on a virtual clock have to be taken from clock.monotonic().
+
+    def __init__(self, start=None, speed=None):
+        if speed is not None and speed <= 0:
+            raise ValueError("VirtualClock(): speed must be greater than zero!")
+
+        self.now = time.time() if start is None else start
+        self.speed = speed
+        self.lock = threading.Lock()
+        # Real time `now` was taken at, with a speed virtual time runs from
+        # there.
+        self.realStart = time.monotonic()
+
+
+    def time(self):
+        if self.speed is None:
+            return self.now
+
+        return self.now + (time.monotonic() - self.realStart) * self.speed
+
+
+    def monotonic(self):
+        return self.time()
+
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+
+        if self.speed is not None:
+            time.sleep(seconds / self.speed)
+            return
+
+        self.advance(seconds)
+
+
+    def advance(self, seconds):
+        # Skips time ahead, with a speed on top of the real time passing.
+        with self.lock:
+            self.now += seconds
+
+
+def sineSignal(seconds):
+    # Default signal of the emulator: a weight swinging between 0 and 72000
+    # reference units every 18 seconds.
+    return abs(math.sin(math.radians(seconds * 20)) * 72.0) * 1000
+
 
 class HX711:
-    def __init__(self, dout, pd_sck, gain=128):
+    # Emulates hx711.HX711 (same snake_case API and channel A/B handling).
+    # See HX711v0_5_1 below for the camelCase API of hx711v0_5_1.HX711.
+    #
+    # Pass a VirtualClock to run faster than real time and a seed to get the
+    # same samples on every run. `signal` maps seconds since reset() to the
+    # weight (in reference units) the emulated load cell carries.
+
+    # Every this many samples (on average) a bad sample is injected, 0 never.
+    BIG_ERROR_SAMPLE_FREQUENCY = 142
+    BIG_ERROR_SAMPLES = [0.0, 40000.0, 70000.0, 150000.0, 280000.0, 580000.0]
+
+    def __init__(self, dout, pd_sck, gain=128, clock=None, seed=None, signal=None, sampleRateHz=80.0):
         self.PD_SCK = pd_sck
 
         self.DOUT = dout
 
+        self.clock = clock if clock is not None else RealClock()
+        self.random = random.Random(seed)
+        self.signal = signal if signal is not None else sineSignal
+        # What the load cell on channel B carries, None for the same as A.
+        self.signalB = None
+
         # Last time we've been read.
-        self.lastReadTime = time.time()
-        self.sampleRateHz = 80.0
-        self.resetTimeStamp = time.time()
+        self.lastReadTime = self.clock.time()
+        self.sampleRateHz = sampleRateHz
+        self.resetTimeStamp = self.clock.time()
         self.sampleCount = 0
         self.simulateTare = False
 
+        # Noise on every sample, in reference units (uniform, +- noiseScale).
+        self.noiseScale = 1000.0
+        self.bigErrorFrequency = self.BIG_ERROR_SAMPLE_FREQUENCY
+        # Every this many frames (on average) a frame the integrity checks
+        # reject is injected, 0 never.
+        self.badFrameFrequency = 0
+
         # Mutex for reading from the HX711, in case multiple threads in client
         # software try to access get values from the class at the same time.
-        self.readLock = threading.Lock()
-        
+        # Reentrant, so a caller can hold it across selecting a gain and
+        # reading, with both channels of the HX711 in use.
+        self.readLock = threading.RLock()
+
         self.GAIN = 0
         self.REFERENCE_UNIT = 1  # The value returned by the hx711 that corresponds to your reference unit AFTER dividing by the SCALE.
-        
+        self.REFERENCE_UNIT_B = 1
+
         self.OFFSET = 1
-        self.lastVal = long(0)
+        self.OFFSET_B = 1
+        self.lastVal = 0
 
         self.DEBUG_PRINTING = False
-        
-        self.byte_format = 'MSB'
-        self.bit_format = 'MSB'
 
-        self.set_gain(gain)
+        # Seconds a single read may take when the caller doesn't pass a
+        # deadline. None waits forever.
+        self.readTimeout = 1.0
+
+        # Timings (seconds) of the last frame read: waiting for the read
+        # lock, waiting for DOUT, clocking the frame out and the whole time
+        # the lock was held. Cheap to keep, read by whoever wants metrics.
+        self.lastLockWait = 0.0
+        self.lastReadyWait = 0.0
+        self.lastClockOut = 0.0
+        self.lastLockHold = 0.0
+
+        # Frame integrity checks, as in hx711.HX711. There is no PD_SCK here,
+        # so only the saturated and stuck checks ever fail.
+        self.checkFrames = True
+        self.frameRetries = 3
+        self.highTimeBudget = 0.00006
+        self.frameErrorCounts = {"timing": 0, "saturated": 0, "stuck": 0, "dout": 0}
+        self.frameFailureCount = 0
+        self.lastHighTime = 0.0
+        self.lastDoutHigh = True
 
+        self.byte_format = 'MSB'
+        self.bit_format = 'MSB'
 
+        # Like the real chip, a frame holds the conversion the gain pulses
+        # after the previous frame selected (the GAIN value at that time),
+        # starting with channel A, gain 128 after power up.
+        self.conversionGain = 1
 
+        self.set_gain(gain)
 
-        # Think about whether this is necessary.
-        time.sleep(1)
 
     def convertToTwosComplement24bit(self, inputValue):
        # HX711 has saturating logic.
@@ -58,19 +205,44 @@ class HX711:
 
           return 0x800000 + diff
 
-        
+
     def convertFromTwosComplement24bit(self, inputValue):
         return -(inputValue & 0x800000) + (inputValue & 0x7fffff)
 
-    
+
     def is_ready(self):
         # Calculate how long we should be waiting between samples, given the
         # sample rate.
         sampleDelaySeconds = 1.0 / self.sampleRateHz
 
-        return time.time() >= self.lastReadTime + sampleDelaySeconds
+        return self.clock.time() >= self.lastReadTime + sampleDelaySeconds
+
+
+    def wait_ready(self, deadline=None):
+        # Sleep until the next sample is due or the deadline (a
+        # clock.monotonic() value) passes. Returns False on timeout.
+        while not self.is_ready():
+            wait = self.lastReadTime + 1.0 / self.sampleRateHz - self.clock.time()
+
+            if deadline is not None:
+                remaining = deadline - self.clock.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            self.clock.sleep(max(0, wait))
+
+        return True
+
+
+    def get_deadline(self, deadline=None):
+        # Deadline for a read when the caller didn't supply one.
+        if deadline is not None or self.readTimeout is None:
+            return deadline
+
+        return self.clock.monotonic() + self.readTimeout
+
 
-    
     def set_gain(self, gain):
         if gain == 128:
             self.GAIN = 1
@@ -78,11 +250,14 @@ class HX711:
             self.GAIN = 3
         elif gain == 32:
             self.GAIN = 2
+        else:
+            return False
 
         # Read out a set of raw bytes and throw it away.
-        self.readRawBytes()
+        self.readSample()
+        return True
+
 
-        
     def get_gain(self):
         if self.GAIN == 1:
             return 128
@@ -93,238 +268,633 @@ class HX711:
 
         # Shouldn't get here.
         return 0
-        
 
-    def readRawBytes(self):
+
+    def readSample(self, deadline=None, blockUntilReady=True):
+        # Common read path of both APIs. Returns the 24bit 2s complement
+        # sample, in the configured byte order, or None when blockUntilReady
+        # is False and another thread holds the read lock.
+        deadline = self.get_deadline(deadline)
+
+        # Timings are taken on the real clock, they measure this code and not
+        # the emulated chip.
+        perfCounter = time.perf_counter
+        start = perfCounter()
+
         # Wait for and get the Read Lock, incase another thread is already
         # driving the virtual HX711 serial interface.
-        self.readLock.acquire()
-
-        # Wait until HX711 is ready for us to read a sample.
-        while not self.is_ready():
-           pass
+        if blockUntilReady:
+            lockTimeout = -1 if deadline is None else max(0, deadline - self.clock.monotonic())
+            if not self.readLock.acquire(timeout=lockTimeout):
+                raise HX711TimeoutError("HX711().readRawLong(): timed out waiting for the read lock")
+        elif not self.readLock.acquire(False):
+            return None
+
+        try:
+            locked = perfCounter()
+            failures = 0
+
+            while True:
+                # Wait until HX711 is ready for us to read a sample.
+                if not self.wait_ready(deadline):
+                    raise HX711TimeoutError("HX711().readRawLong(): timed out waiting for the HX711 to become ready")
+
+                ready = perfCounter()
+                self.lastReadTime = self.clock.time()
+
+                # Generate a 24bit 2s complement sample for the virtual HX711.
+                rawSample = self.convertToTwosComplement24bit(self.generateFakeSample())
+                self.conversionGain = self.GAIN
+                if self.badFrameFrequency and self.random.randrange(0, self.badFrameFrequency) == 0:
+                    rawSample = self.random.choice(list(SUSPECT_FRAMES))
+
+                done = perfCounter()
+
+                error = SUSPECT_FRAMES.get(rawSample) if self.checkFrames else None
+                if error is None:
+                    break
+
+                # Throw the frame away and read the next one.
+                self.frameErrorCounts[error] += 1
+                failures += 1
+                if failures > self.frameRetries:
+                    self.frameFailureCount += 1
+                    raise HX711FrameError("HX711().readRawLong(): %d frames in a row failed the integrity checks, last: %s" % (failures, error))
+
+            self.lastLockWait = locked - start
+            self.lastReadyWait = ready - locked
+            self.lastClockOut = done - ready
+            self.lastLockHold = done - locked
+
+        finally:
+            # Release the Read Lock, now that we've finished driving the virtual HX711
+            # serial interface.
+            self.readLock.release()
+
+        # Depending on how we're configured, swap the first and last byte the
+        # same way a real HX711 read in LSB byte order would.
+        if self.byte_format == 'LSB':
+           rawSample = ((rawSample & 0xFF) << 16) | (rawSample & 0xFF00) | ((rawSample >> 16) & 0xFF)
 
-        self.lastReadTime = time.time()
+        return rawSample
 
-        # Generate a 24bit 2s complement sample for the virtual HX711.
-        rawSample = self.convertToTwosComplement24bit(self.generateFakeSample())
-        
-        # Read three bytes of data from the HX711.
-        firstByte  = (rawSample >> 16) & 0xFF
-        secondByte = (rawSample >> 8)  & 0xFF
-        thirdByte  = rawSample & 0xFF
 
-        # Release the Read Lock, now that we've finished driving the virtual HX711
-        # serial interface.
-        self.readLock.release()           
+    def readRawLong(self, deadline=None):
+        return self.readSample(deadline)
 
-        # Depending on how we're configured, return an orderd list of raw byte
-        # values.
-        if self.byte_format == 'LSB':
-           return [thirdByte, secondByte, firstByte]
-        else:
-           return [firstByte, secondByte, thirdByte]
 
+    def readRawBytes(self, deadline=None):
+        rawSample = self.readSample(deadline)
 
-    def read_long(self):
-        # Get a sample from the HX711 in the form of raw bytes.
-        dataBytes = self.readRawBytes()
+        return [(rawSample >> 16) & 0xFF, (rawSample >> 8) & 0xFF, rawSample & 0xFF]
 
 
-        if self.DEBUG_PRINTING:
-            print(dataBytes,)
-        
-        # Join the raw bytes into a single 24bit 2s complement value.
-        twosComplementValue = ((dataBytes[0] << 16) |
-                               (dataBytes[1] << 8)  |
-                               dataBytes[2])
+    def read_long(self, deadline=None):
+        # Get a sample from the HX711 as a 24bit 2s complement value.
+        twosComplementValue = self.readSample(deadline)
 
         if self.DEBUG_PRINTING:
             print("Twos: 0x%06x" % twosComplementValue)
-        
+
         # Convert from 24bit twos-complement to a signed value.
-        signedIntValue = self.convertFromTwosComplement24bit(twosComplementValue)
+        signedIntValue = twosComplementValue - ((twosComplementValue & 0x800000) << 1)
 
         # Record the latest sample value we've read.
         self.lastVal = signedIntValue
 
         # Return the sample value we've read from the HX711.
-        return int(signedIntValue)
+        return signedIntValue
 
-    
-    def read_average(self, times=3):
+
+    def read_average(self, times=3, deadline=None):
         # Make sure we've been asked to take a rational amount of samples.
         if times <= 0:
-            print("HX711().read_average(): times must >= 1!!  Assuming value of 1.")
-            times = 1
+            raise ValueError("HX711()::read_average(): times must >= 1!!")
 
         # If we're only average across one value, just read it and return it.
         if times == 1:
-            return self.read_long()
+            return self.read_long(deadline)
 
-        # If we're averaging across a low amount of values, just take an
-        # arithmetic mean.
+        # If we're averaging across a low amount of values, just take the
+        # median.
         if times < 5:
-            values = int(0)
-            for i in range(times):
-                values += self.read_long()
+            return self.read_median(times, deadline)
+
+        # If we're taking a lot of samples, we'll trim 20% of outlier samples
+        # from top and bottom of the collected set and take the mean of the rest.
+        return self.read_filtered(TrimmedMean(times, 0.2), times, deadline)
+
 
-            return values / times
+    def read_median(self, times=3, deadline=None):
+       if times <= 0:
+          raise ValueError("HX711::read_median(): times must be greater than zero!")
 
-        # If we're taking a lot of samples, we'll collect them in a list, remove
-        # the outliers, then take the mean of the remaining set.
-        valueList = []
+       if times == 1:
+          return self.read_long(deadline)
 
+       return self.read_filtered(SlidingMedian(times), times, deadline)
+
+
+    # Feeds `times` new samples into a streaming filter from hx711_filters and
+    # returns its value. The deadline, if given, bounds all `times` reads.
+    def read_filtered(self, valueFilter, times=1, deadline=None):
         for x in range(times):
-            valueList += [self.read_long()]
+            valueFilter.push(self.read_long(deadline))
 
-        valueList.sort()
+        return valueFilter.value
 
-        # We'll be trimming 20% of outlier samples from top and bottom of collected set.
-        trimAmount = int(len(valueList) * 0.2)
 
-        # Trim the edge case values.
-        valueList = valueList[trimAmount:-trimAmount]
+    def get_value(self, times=3, deadline=None):
+        return self.get_value_A(times, deadline)
 
-        # Return the mean of remaining samples.
-        return sum(valueList) / len(valueList)
 
-    
-    def get_value(self, times=3):
-        return self.read_average(times) - self.OFFSET
+    def get_value_A(self, times=3, deadline=None):
+        return self.read_median(times, deadline) - self.get_offset_A()
+
+
+    def get_value_B(self, times=3, deadline=None):
+        g = self.get_gain()
+        if g == 32:
+            return self.read_median(times, deadline) - self.get_offset_B()
+
+        self.set_gain(32)
+        try:
+            return self.read_median(times, deadline) - self.get_offset_B()
+        finally:
+            self.set_gain(g)
+
+
+    def get_weight(self, times=3, deadline=None):
+        return self.get_weight_A(times, deadline)
+
+
+    def get_weight_A(self, times=3, deadline=None):
+        return self.get_value_A(times, deadline) / self.REFERENCE_UNIT
+
+
+    def get_weight_B(self, times=3, deadline=None):
+        return self.get_value_B(times, deadline) / self.REFERENCE_UNIT_B
+
+
+    def tare(self, times=15, deadline=None):
+        return self.tare_A(times, deadline)
 
-    
-    def get_weight(self, times=3):
-        value = self.get_value(times)
-        value = value / self.REFERENCE_UNIT
-        return value
 
-    
-    def tare(self, times=15):
+    def tare_A(self, times=15, deadline=None):
         # If we aren't simulating Taring because it takes too long, just skip it.
         if not self.simulateTare:
             return 0
 
         # Backup REFERENCE_UNIT value
-        reference_unit = self.REFERENCE_UNIT
-        self.set_reference_unit(1)
+        reference_unit = self.get_reference_unit_A()
+        self.set_reference_unit_A(1)
 
-        value = self.read_average(times)
+        try:
+            value = self.read_average(times, deadline)
+        finally:
+            # Restore the reference unit, even if the read timed out.
+            self.set_reference_unit_A(reference_unit)
 
         if self.DEBUG_PRINTING:
-            print("Tare value:", value)
-        
-        self.set_offset(value)
+            print("Tare A value:", value)
 
-        # Restore the reference unit, now that we've got our offset.
-        self.set_reference_unit(reference_unit)
+        self.set_offset_A(value)
 
-        return value;
+        return value
 
-    
-    def set_reading_format(self, byte_format="LSB", bit_format="MSB"):
 
+    def tare_B(self, times=15, deadline=None):
+        if not self.simulateTare:
+            return 0
+
+        reference_unit = self.get_reference_unit_B()
+        self.set_reference_unit_B(1)
+        backupGain = self.get_gain()
+        if backupGain != 32:
+            self.set_gain(32)
+
+        try:
+            value = self.read_average(times, deadline)
+        finally:
+            if backupGain != 32:
+                self.set_gain(backupGain)
+            self.set_reference_unit_B(reference_unit)
+
+        if self.DEBUG_PRINTING:
+            print("Tare B value:", value)
+
+        self.set_offset_B(value)
+
+        return value
+
+
+    def set_reading_format(self, byte_format="LSB", bit_format="MSB"):
         if byte_format == "LSB":
             self.byte_format = byte_format
         elif byte_format == "MSB":
             self.byte_format = byte_format
         else:
-            print("Unrecognised byte_format: \"%s\"" % byte_format)
+            raise ValueError("Unrecognised byte_format: \"%s\"" % byte_format)
 
         if bit_format == "LSB":
             self.bit_format = bit_format
         elif bit_format == "MSB":
             self.bit_format = bit_format
         else:
-            print("Unrecognised bit_format: \"%s\"" % bit_format)
+            raise ValueError("Unrecognised bitformat: \"%s\"" % bit_format)
 
-            
 
     def set_offset(self, offset):
+        self.set_offset_A(offset)
+
+    def set_offset_A(self, offset):
         self.OFFSET = offset
 
-        
+    def set_offset_B(self, offset):
+        self.OFFSET_B = offset
+
     def get_offset(self):
+        return self.get_offset_A()
+
+    def get_offset_A(self):
         return self.OFFSET
 
-    
+    def get_offset_B(self):
+        return self.OFFSET_B
+
+
     def set_reference_unit(self, reference_unit):
+        self.set_reference_unit_A(reference_unit)
+
+
+    def set_reference_unit_A(self, reference_unit):
         # Make sure we aren't asked to use an invalid reference unit.
         if reference_unit == 0:
-            print("HX711().set_reference_unit(): Can't use 0 as a reference unit!!")
-            return
+            raise ValueError("HX711::set_reference_unit_A() can't accept 0 as a reference unit!")
 
         self.REFERENCE_UNIT = reference_unit
 
 
-    def power_down(self):
-        # Wait for and get the Read Lock, incase another thread is already
-        # driving the HX711 serial interface.
-        self.readLock.acquire()
+    def set_reference_unit_B(self, reference_unit):
+        if reference_unit == 0:
+            raise ValueError("HX711::set_reference_unit_B() can't accept 0 as a reference unit!")
 
-        # Wait 100us for the virtual HX711 to power down.
-        time.sleep(0.0001)
+        self.REFERENCE_UNIT_B = reference_unit
 
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()           
+    def get_reference_unit_A(self):
+        return self.REFERENCE_UNIT
 
+    def get_reference_unit_B(self):
+        return self.REFERENCE_UNIT_B
 
-    def power_up(self):
+    def get_reference_unit(self):
+        return self.get_reference_unit_A()
+
+
+    def power_down(self):
         # Wait for and get the Read Lock, incase another thread is already
         # driving the HX711 serial interface.
-        self.readLock.acquire()
+        with self.readLock:
+            # Wait 100us for the virtual HX711 to power down.
+            self.clock.sleep(0.0001)
 
-        # Wait 100 us for the virtual HX711 to power back up.
-        time.sleep(0.0001)
 
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()
+    def power_up(self):
+        with self.readLock:
+            # Wait 100 us for the virtual HX711 to power back up.
+            self.clock.sleep(0.0001)
+            self.conversionGain = 1
 
         # HX711 will now be defaulted to Channel A with gain of 128.  If this
         # isn't what client software has requested from us, take a sample and
         # throw it away, so that next sample from the HX711 will be from the
         # correct channel/gain.
         if self.get_gain() != 128:
-            self.readRawBytes()
+            self.readSample()
 
 
     def reset(self):
-        # self.power_down()
-        # self.power_up()
-
         # Mark time when we were reset.  We'll use this for sample generation.
-        self.resetTimeStamp = time.time()
+        self.resetTimeStamp = self.clock.time()
 
 
     def generateFakeSample(self):
-       sampleTimeStamp = time.time() - self.resetTimeStamp
+       sampleTimeStamp = self.clock.time() - self.resetTimeStamp
 
-       noiseScale = 1.0
-       noiseValue = random.randrange(-(noiseScale * 1000),(noiseScale * 1000)) / 1000.0
-       sample     = math.sin(math.radians(sampleTimeStamp * 20)) * 72.0
+       # Channel B converts with 2 gain pulses.
+       signal = self.signalB if self.conversionGain == 2 and self.signalB is not None else self.signal
+       sample = signal(sampleTimeStamp)
+       sample += self.random.uniform(-self.noiseScale, self.noiseScale)
 
        self.sampleCount += 1
 
-       if sample < 0.0:
-          sample = -sample
+       if self.bigErrorFrequency and self.random.randrange(0, self.bigErrorFrequency) == 0:
+          sample = self.random.choice(self.BIG_ERROR_SAMPLES)
+          if self.DEBUG_PRINTING:
+             print("Sample %d: Injecting %f as a random bad sample." % (self.sampleCount, sample))
 
-       sample += noiseValue
+       # Channel B (gain 32) sees a quarter of what channel A at gain 128
+       # sees, channel A at gain 64 half of it.
+       sample *= {1: 128, 3: 64, 2: 32}[self.conversionGain] / 128.0
 
-       BIG_ERROR_SAMPLE_FREQUENCY = 142
-       ###BIG_ERROR_SAMPLE_FREQUENCY = 15
-       BIG_ERROR_SAMPLES = [0.0, 40.0, 70.0, 150.0, 280.0, 580.0]
+       sample *= self.REFERENCE_UNIT
 
-       if random.randrange(0, BIG_ERROR_SAMPLE_FREQUENCY) == 0:
-          sample = random.sample(BIG_ERROR_SAMPLES, 1)[0]
-          print("Sample %d: Injecting %f as a random bad sample." % (self.sampleCount, sample))
+       return int(sample)
 
-       sample *= 1000
 
-       sample *= self.REFERENCE_UNIT
+class HX711v0_5_1(HX711):
+    # Emulates hx711v0_5_1.HX711: the camelCase API with per channel offsets
+    # and reference units, non blocking reads and the ready callback. Same
+    # clock, seed and signal options as HX711.
 
-       return int(sample)
+    def __init__(self, dout, pd_sck, gain=128, clock=None, seed=None, signal=None, sampleRateHz=80.0):
+        self.readyCallbackEnabled = False
+        self.paramCallback = None
+        self.lastRawBytes = None
+        self.callbackThread = None
+        # Frames the ready callback lost because another thread held the read
+        # lock.
+        self.droppedFrameCount = 0
+
+        super().__init__(dout, pd_sck, gain, clock, seed, signal, sampleRateHz)
+
+        self.byteFormat = 'MSB'
+        self.bitFormat = 'MSB'
+
+
+    def powerDown(self):
+        self.power_down()
+
+
+    def powerUp(self):
+        self.power_up()
+
+
+    def isReady(self):
+        return self.is_ready()
+
+
+    def waitReady(self, deadline=None):
+        return self.wait_ready(deadline)
+
+
+    def getDeadline(self, deadline=None):
+        return self.get_deadline(deadline)
+
+
+    def setGain(self, gain):
+        return self.set_gain(gain)
+
+
+    def getGain(self):
+        gain = self.get_gain()
+        if gain == 0:
+            raise ValueError("HX711::getGain() gain is currently an invalid value")
+
+        return gain
+
+
+    def setChannel(self, channel='A'):
+        if channel == 'A':
+            self.setGain(128)
+            return True
+        elif channel == 'B':
+            self.setGain(32)
+            return True
+
+        raise ValueError("HX711::setChannel() invalid channel: \"%s\"" % channel)
+
+
+    def getChannel(self):
+        if self.GAIN == 1 or self.GAIN == 3:
+            return 'A'
+        elif self.GAIN == 2:
+            return 'B'
+
+        raise ValueError("HX711::getChannel() gain is currently an invalid value")
+
+
+    def readRawLong(self, blockUntilReady=True, deadline=None):
+        return self.readSample(deadline, blockUntilReady)
+
+
+    def readRawBytes(self, blockUntilReady=True, deadline=None):
+        rawLong = self.readSample(deadline, blockUntilReady)
+
+        if rawLong is None:
+            return None
+
+        return [(rawLong >> 16) & 0xFF, (rawLong >> 8) & 0xFF, rawLong & 0xFF]
+
+
+    def onChannel(self, channel, read):
+        # Runs read() with the requested channel selected, switching back
+        # afterwards.
+        currentChannel = self.getChannel()
+        if channel != currentChannel:
+            self.setChannel(channel)
+
+        try:
+            return read()
+        finally:
+            if channel != currentChannel:
+                self.setChannel(currentChannel)
+
+
+    def getRawBytes(self, channel='A', deadline=None):
+        return self.onChannel(channel, lambda: self.readRawBytes(deadline=deadline))
+
+
+    def getLastRawBytes(self):
+        rawBytes = self.lastRawBytes
+        self.lastRawBytes = None
+        return rawBytes
+
+
+    def readyCallback(self, pin):
+        if pin != self.DOUT:
+            return
+
+        try:
+            self.lastRawBytes = self.readRawBytes(blockUntilReady=False)
+        except (HX711TimeoutError, HX711FrameError):
+            # Already counted by the read, keep the callback loop running.
+            self.lastRawBytes = None
+        else:
+            if self.lastRawBytes is None:
+                self.droppedFrameCount += 1
+
+        if self.paramCallback is not None:
+            self.paramCallback(self.lastRawBytes)
+
+
+    def callbackLoop(self):
+        # Stands in for the falling edge interrupt on DOUT.
+        while self.readyCallbackEnabled:
+            if self.waitReady(self.clock.monotonic() + 1.0):
+                sampleCount = self.sampleCount
+                self.readyCallback(self.DOUT)
+                # A frame the callback lost goes to the read holding the
+                # lock, the edge only fires again for the next one.
+                while self.readyCallbackEnabled and self.sampleCount == sampleCount and self.is_ready():
+                    self.clock.sleep(0.0005)
+
+
+    def enableReadyCallback(self, paramCallback=None):
+        self.paramCallback = paramCallback if paramCallback is not None else self.paramCallback
+        self.readyCallbackEnabled = True
+        self.callbackThread = threading.Thread(target=self.callbackLoop, daemon=True)
+        self.callbackThread.start()
+
+
+    def disableReadyCallback(self):
+        self.readyCallbackEnabled = False
+        if self.callbackThread is not None:
+            self.callbackThread.join()
+            self.callbackThread = None
+        self.paramCallback = None
+
+
+    def setReadingFormat(self, byteFormat="MSB", bitFormat="MSB"):
+        if byteFormat != 'MSB' and byteFormat != 'LSB':
+            raise ValueError(f"HX711::setReadingFormat() invalid byteFormat: '{byteFormat}'" )
+
+        if bitFormat != 'MSB' and bitFormat != 'LSB':
+            raise ValueError(f"HX711::setReadingFormat() invalid bitFormat: '{bitFormat}'" )
+
+        self.byteFormat = byteFormat
+        self.bitFormat = bitFormat
+        self.set_reading_format(byteFormat, bitFormat)
+
+
+    def rawLongToLong(self, rawLong=None):
+        if rawLong is None:
+            return None
+
+        signedIntValue = rawLong - ((rawLong & 0x800000) << 1)
+        self.lastVal = signedIntValue
+        return signedIntValue
+
+
+    def rawBytesToLong(self, rawBytes=None):
+        if rawBytes is None:
+            return None
+
+        return self.rawLongToLong((rawBytes[0] << 16) | (rawBytes[1] << 8) | rawBytes[2])
+
+
+    def getLong(self, channel='A', deadline=None):
+        return self.rawLongToLong(self.onChannel(channel, lambda: self.readRawLong(deadline=deadline)))
+
+
+    def getLongFiltered(self, valueFilter, times=1, channel='A', deadline=None):
+        def read():
+            for x in range(times):
+                rawLong = self.readRawLong(deadline=deadline)
+                if rawLong is not None:
+                    valueFilter.push(self.rawLongToLong(rawLong))
+
+            return valueFilter.value
+
+        return self.onChannel(channel, read)
+
+
+    def getLongMedian(self, times=3, channel='A', deadline=None):
+        return self.getLongFiltered(SlidingMedian(times), times, channel, deadline)
+
+
+    def getLongTrimmedMean(self, times=15, channel='A', deadline=None):
+        return self.getLongFiltered(TrimmedMean(times, 0.2), times, channel, deadline)
+
+
+    def setOffset(self, offset, channel='A'):
+        if channel == 'A':
+            self.set_offset_A(offset)
+            return True
+        elif channel == 'B':
+            self.set_offset_B(offset)
+            return True
+
+        raise ValueError("HX711::setOffset() invalid channel: \"%s\"" % channel)
+
+
+    def setOffsetA(self, offset):
+        return self.setOffset(offset, 'A')
+
+
+    def setOffsetB(self, offset):
+        return self.setOffset(offset, 'B')
+
+
+    def getOffset(self, channel='A'):
+        if channel == 'A':
+            return self.get_offset_A()
+        elif channel == 'B':
+            return self.get_offset_B()
+
+        raise ValueError("HX711::getOffset() invalid channel: \"%s\"" % channel)
+
+
+    def getOffsetA(self):
+        return self.getOffset('A')
+
+
+    def getOffsetB(self):
+        return self.getOffset('B')
+
+
+    def rawBytesToLongWithOffset(self, rawBytes=None, channel='A'):
+        if rawBytes is None:
+            return None
+
+        return self.rawBytesToLong(rawBytes) - self.getOffset(channel)
+
+
+    def getLongWithOffset(self, channel='A', deadline=None):
+        return self.rawBytesToLongWithOffset(self.getRawBytes(channel, deadline), channel)
+
+
+    def setReferenceUnit(self, referenceUnit, channel='A'):
+        if channel == 'A':
+            self.set_reference_unit_A(referenceUnit)
+            return True
+        elif channel == 'B':
+            self.set_reference_unit_B(referenceUnit)
+            return True
+
+        raise ValueError("HX711::setReferenceUnit() invalid channel: \"%s\"" % channel)
+
+
+    def getReferenceUnit(self, channel='A'):
+        if channel == 'A':
+            return self.get_reference_unit_A()
+        elif channel == 'B':
+            return self.get_reference_unit_B()
+
+        raise ValueError("HX711::getReferenceUnit() invalid channel: \"%s\"" % channel)
+
+
+    def rawBytesToWeight(self, rawBytes=None, channel='A'):
+        if rawBytes is None:
+            return None
+
+        return self.rawBytesToLongWithOffset(rawBytes, channel) / self.getReferenceUnit(channel)
+
+
+    def getWeight(self, channel='A', deadline=None):
+        return self.rawBytesToWeight(self.getRawBytes(channel, deadline), channel)
+
+
+    def autosetOffset(self, channel='A'):
+        referenceUnit = self.getReferenceUnit(channel)
+        self.setReferenceUnit(1, channel)
+
+        try:
+            self.setOffset(self.getLong(channel), channel)
+        finally:
+            self.setReferenceUnit(referenceUnit, channel)
+
+        return True
 
 
-# EOF - emulated_hx711.py
+# EOF - hx711_emulator.py
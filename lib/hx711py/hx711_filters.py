@@ -0,0 +1,315 @@
+import bisect
+from collections import deque
+
+
+class SortedWindow:
+    # Sliding window over the last `size` samples, kept both in arrival order
+    # (to know which sample leaves the window) and in sorted order (to answer
+    # order statistics). Finding a sample is a binary search, O(log n); the
+    # insert/delete itself is a single C-level memmove, which for the window
+    # sizes used on a HX711 (tens to a few hundred samples) is cheaper than
+    # any tree structure written in Python.
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("SortedWindow(): size must be greater than zero!")
+
+        self.size = size
+        self.fifo = deque()
+        self.sorted = []
+
+
+    def push(self, value):
+        # Add a sample, evicting the oldest one once the window is full.
+        # Returns (evictedValue, evictedIndex, insertedIndex) so subclasses can
+        # keep running statistics up to date without rescanning the window.
+        evictedValue = None
+        evictedIndex = None
+
+        if len(self.fifo) == self.size:
+            evictedValue = self.fifo.popleft()
+            evictedIndex = bisect.bisect_left(self.sorted, evictedValue)
+            del self.sorted[evictedIndex]
+
+        self.fifo.append(value)
+        insertedIndex = bisect.bisect_right(self.sorted, value)
+        self.sorted.insert(insertedIndex, value)
+
+        return (evictedValue, evictedIndex, insertedIndex)
+
+
+    def clear(self):
+        self.fifo.clear()
+        self.sorted = []
+
+
+    def isFull(self):
+        return len(self.fifo) == self.size
+
+
+    def __len__(self):
+        return len(self.fifo)
+
+
+class SlidingMedian(SortedWindow):
+    # Median of the last `size` samples. O(log n) per push, O(1) per query.
+
+    @property
+    def value(self):
+        n = len(self.sorted)
+
+        if n == 0:
+            return None
+
+        # If the window is odd we can just take the centre value.
+        if (n & 0x1) == 0x1:
+            return self.sorted[n // 2]
+
+        # If it's even we take the arithmetic mean of the two middle values.
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2.0
+
+
+class TrimmedMean(SortedWindow):
+    # Mean of the last `size` samples after trimming `trim` (20% by default,
+    # same rule as HX711.read_average) of the samples from the top and the
+    # bottom. The total and the sums of the trimmed tails are updated in O(1)
+    # on every push once the window is full, so the query is O(1) as well.
+
+    def __init__(self, size, trim=0.2):
+        if trim < 0 or trim >= 0.5:
+            raise ValueError("TrimmedMean(): trim must be in [0, 0.5)!")
+
+        super().__init__(size)
+        self.trim = trim
+        self.total = 0
+        self.lowSum = 0
+        self.highSum = 0
+
+
+    def trimAmount(self, n=None):
+        if n is None:
+            n = len(self.sorted)
+        return int(n * self.trim)
+
+
+    def push(self, value):
+        wasFull = self.isFull()
+        (evictedValue, evictedIndex, insertedIndex) = super().push(value)
+
+        self.total += value
+
+        if not wasFull:
+            # Still filling up, the trim amount may change with every sample.
+            # This only happens for the first `size` samples.
+            k = self.trimAmount()
+            self.lowSum = sum(self.sorted[:k])
+            self.highSum = sum(self.sorted[len(self.sorted) - k:]) if k else 0
+            return
+
+        self.total -= evictedValue
+
+        k = self.trimAmount()
+        if k == 0:
+            return
+
+        n = len(self.sorted)
+        s = self.sorted
+
+        # Replay the eviction followed by the insertion on the tail sums.
+        # After the eviction the list is one shorter, so the element sitting
+        # on the tail boundary moves into the tail it left.
+        if evictedIndex < k:
+            self.lowSum += s[k - 1] if insertedIndex >= k else s[k]
+            self.lowSum -= evictedValue
+        if evictedIndex >= n - k:
+            self.highSum += s[n - k - 1] if insertedIndex > n - k - 1 else s[n - k]
+            self.highSum -= evictedValue
+
+        # The inserted sample pushes the old boundary element out of a tail.
+        if insertedIndex < k:
+            self.lowSum += value - s[k]
+        if insertedIndex >= n - k:
+            self.highSum += value - s[n - k - 1]
+
+
+    def clear(self):
+        super().clear()
+        self.total = 0
+        self.lowSum = 0
+        self.highSum = 0
+
+
+    @property
+    def value(self):
+        n = len(self.sorted)
+
+        if n == 0:
+            return None
+
+        k = self.trimAmount(n)
+        return (self.total - self.lowSum - self.highSum) / (n - 2 * k)
+
+
+class MadGate:
+    # Outlier gate based on the median absolute deviation (MAD). A sample is
+    # rejected when it is further than `threshold` robust standard deviations
+    # (1.4826 * MAD) away from the median of the recently accepted samples.
+    # The deviations of accepted samples are kept in their own sliding median,
+    # so both the check and the update stay O(log n).
+    #
+    # If the signal really moves to a new level (a cylinder is swapped) every
+    # sample would look like an outlier, so after `size // 2` rejections in a
+    # row the gate forgets its history and starts over from the new level.
+
+    MAD_TO_SIGMA = 1.4826
+
+    def __init__(self, size, threshold=3.5, minSamples=5):
+        self.values = SlidingMedian(size)
+        self.deviations = SlidingMedian(size)
+        self.threshold = threshold
+        self.minSamples = min(minSamples, size)
+        self.maxRejectedRun = max(1, size // 2)
+        self.rejectedRun = 0
+        self.acceptedCount = 0
+        self.rejectedCount = 0
+
+
+    def accept(self, value):
+        # Returns True and records the sample if it passes the gate, False if
+        # it was rejected as an outlier.
+        median = self.values.value
+        deviation = abs(value - median) if median is not None else 0
+
+        if len(self.values) >= self.minSamples:
+            mad = self.deviations.value
+            if mad > 0 and deviation > self.threshold * self.MAD_TO_SIGMA * mad:
+                self.rejectedRun += 1
+
+                if self.rejectedRun < self.maxRejectedRun:
+                    self.rejectedCount += 1
+                    return False
+
+                # Too many in a row, this is a level change not an outlier.
+                self.values.clear()
+                self.deviations.clear()
+                deviation = 0
+
+        self.rejectedRun = 0
+        self.acceptedCount += 1
+        self.values.push(value)
+        self.deviations.push(deviation)
+        return True
+
+
+    def reset(self):
+        self.values.clear()
+        self.deviations.clear()
+        self.rejectedRun = 0
+
+
+class ConstantVelocityKalman:
+    # Kalman filter tracking a value and its rate of change together (for a
+    # gas cylinder: the weight and the flow). The model is a constant
+    # velocity one with a random acceleration of `processNoise` (units/s^2)
+    # and independent measurement noise of `measurementNoise` (units) on every
+    # sample. Both are standard deviations. The 2x2 covariance is written out
+    # by hand, so every push is a handful of float operations.
+    #
+    # Samples may arrive at irregular intervals, every push takes its own
+    # timestamp in seconds. The first two samples initialise the state, from
+    # then on `value`, `rate` and their standard deviations are available.
+
+    def __init__(self, processNoise, measurementNoise):
+        if processNoise <= 0 or measurementNoise <= 0:
+            raise ValueError("ConstantVelocityKalman(): noise must be greater than zero!")
+
+        self.q = processNoise * processNoise
+        self.r = measurementNoise * measurementNoise
+        self.clear()
+
+
+    def clear(self):
+        self.x = None
+        self.v = 0.0
+        self.p00 = 0.0
+        self.p01 = 0.0
+        self.p11 = 0.0
+        self.timestamp = None
+        self.count = 0
+
+
+    def push(self, value, timestamp):
+        if self.count == 0:
+            self.x = float(value)
+            self.timestamp = timestamp
+            self.count = 1
+            return
+
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            # Same instant (or a clock step backwards), treat it as a repeated
+            # measurement without advancing the state in time.
+            dt = 0
+
+        if self.count == 1:
+            if dt == 0:
+                return
+            # Two point initialisation: the rate is the difference quotient and
+            # its variance follows from the measurement noise of both points.
+            r = self.r
+            self.v = (value - self.x) / dt
+            self.x = float(value)
+            self.p00 = r
+            self.p01 = r / dt
+            self.p11 = 2 * r / (dt * dt)
+            self.timestamp = timestamp
+            self.count = 2
+            return
+
+        # Predict: x += v * dt, P = F P F' + Q.
+        if dt > 0:
+            q = self.q
+            self.x += self.v * dt
+            self.p00 += dt * (2 * self.p01 + dt * self.p11) + q * dt * dt * dt / 3
+            self.p01 += dt * self.p11 + q * dt * dt / 2
+            self.p11 += q * dt
+
+        # Update with the measurement.
+        s = self.p00 + self.r
+        k0 = self.p00 / s
+        k1 = self.p01 / s
+        innovation = value - self.x
+        self.x += k0 * innovation
+        self.v += k1 * innovation
+        self.p11 -= k1 * self.p01
+        self.p01 *= 1 - k0
+        self.p00 *= 1 - k0
+
+        self.timestamp = timestamp
+        self.count += 1
+
+
+    def isReady(self):
+        return self.count >= 2
+
+
+    @property
+    def value(self):
+        return self.x if self.isReady() else None
+
+
+    @property
+    def rate(self):
+        return self.v if self.isReady() else None
+
+
+    @property
+    def valueStd(self):
+        return self.p00 ** 0.5 if self.isReady() else None
+
+
+    @property
+    def rateStd(self):
+        return self.p11 ** 0.5 if self.isReady() else None
+
+# EOF - hx711_filters.py
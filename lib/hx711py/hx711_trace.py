@@ -0,0 +1,307 @@
+import mmap
+import struct
+import threading
+import time
+
+try:
+    from .hx711_emulator import HX711 as EmulatedHX711, HX711TimeoutError, VirtualClock
+except ImportError:
+    from hx711_emulator import HX711 as EmulatedHX711, HX711TimeoutError, VirtualClock
+
+
+# Trace file layout: one header, then one fixed size record per frame.
+#
+#   header: magic, wall clock time (seconds) and monotonic time (seconds) the
+#           recording started at, so monotonic record times map back to
+#           wall clock time.
+#   record: monotonic time (seconds) the frame was read, and the raw 24 bit
+#           frame exactly as readRawLong returned it with the number of gain
+#           pulses (1: A/128, 3: A/64, 2: B/32) it was converted with in the
+#           top byte. Those are the pulses clocked after the previous frame,
+#           not the ones clocked after this one, which select the next
+#           conversion. 0 when unknown.
+#
+# 12 bytes per frame, about 80MB per day at 80 SPS.
+TRACE_MAGIC = b"HX711TR1"
+TRACE_HEADER = struct.Struct("<8sdd")
+TRACE_RECORD = struct.Struct("<dI")
+
+
+class HX711TraceRecorder:
+    # Appends every frame a driver reads to a trace file. Works with
+    # hx711.HX711, hx711v0_5_1.HX711 and the emulator: it wraps, on the
+    # driver instance, the one method all of that driver's reads go through.
+    # A frame costs a struct.pack and a buffered write, the file is flushed
+    # every `flushEvery` frames and on close().
+    #
+    # A frame is labelled with the gain pulses the driver clocked after the
+    # frame before it. The first frame recorded gets the gain set when
+    # recording started, and a frame after power_up() gets A/128, which the
+    # HX711 falls back to.
+
+    def __init__(self, driver, path, flushEvery=800):
+        self.driver = driver
+        self.path = path
+        self.flushEvery = flushEvery
+        self.clock = getattr(driver, "clock", time)
+        self.frameCount = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        # Gain pulses the conversion the next frame carries was selected with.
+        self.conversionGain = driver.GAIN or 0
+
+        self.file = open(path, "ab", buffering=64 * 1024)
+        if self.file.tell() == 0:
+            self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, self.clock.time(), self.clock.monotonic()))
+
+        # The emulators read through readSample, the GPIO drivers through
+        # readRawLong.
+        self.methodName = "readSample" if hasattr(driver, "readSample") else "readRawLong"
+        self.wrapped = getattr(driver, self.methodName)
+        setattr(driver, self.methodName, self.read)
+
+        # hx711v0_5_1.HX711 only has the camelCase name.
+        self.powerUpName = "power_up" if hasattr(driver, "power_up") else "powerUp"
+        self.wrappedPowerUp = getattr(driver, self.powerUpName, None)
+        if self.wrappedPowerUp is not None:
+            setattr(driver, self.powerUpName, self.powerUp)
+
+
+    def read(self, *args, **kwargs):
+        rawLong = self.wrapped(*args, **kwargs)
+
+        # A non blocking v0.5.1 read that didn't get the lock.
+        if rawLong is None:
+            return rawLong
+
+        timestamp = self.clock.monotonic()
+        with self.lock:
+            # The pulses after this frame, clocked by the read that just
+            # returned, select the next conversion.
+            gain = self.conversionGain
+            self.conversionGain = self.driver.GAIN or 0
+
+            if self.file is None:
+                return rawLong
+
+            record = TRACE_RECORD.pack(timestamp, (rawLong & 0xFFFFFF) | (gain << 24))
+
+            self.file.write(record)
+            self.frameCount += 1
+            self.pending += 1
+            if self.pending >= self.flushEvery:
+                self.file.flush()
+                self.pending = 0
+
+        return rawLong
+
+
+    def powerUp(self, *args, **kwargs):
+        # A powered up HX711 converts on channel A at gain 128, including the
+        # frame the driver throws away to select another gain.
+        with self.lock:
+            self.conversionGain = 1
+        return self.wrappedPowerUp(*args, **kwargs)
+
+
+    def close(self):
+        # Stops recording and puts the driver's methods back.
+        with self.lock:
+            if self.file is None:
+                return
+
+            setattr(self.driver, self.methodName, self.wrapped)
+            if self.wrappedPowerUp is not None:
+                setattr(self.driver, self.powerUpName, self.wrappedPowerUp)
+            self.file.close()
+            self.file = None
+
+
+class HX711Trace:
+    # Memory mapped, read only view of a trace file.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.wallStart, self.monotonicStart) = TRACE_HEADER.unpack_from(self.map, 0)
+        if magic != TRACE_MAGIC:
+            self.close()
+            raise ValueError("HX711Trace(): %s is not a hx711 trace!" % path)
+
+        # A trace that is still being written may end in a partial record.
+        self.count = (len(self.map) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+
+    def record(self, index):
+        # (monotonic time, raw 24 bit frame, gain pulses) of frame `index`.
+        (timestamp, packed) = TRACE_RECORD.unpack_from(self.map, TRACE_HEADER.size + index * TRACE_RECORD.size)
+        return (timestamp, packed & 0xFFFFFF, packed >> 24)
+
+
+    def records(self, start=0, stop=None):
+        # Iterates over frames without going through a driver, the fastest
+        # way to push a long trace through filters.
+        stop = self.count if stop is None else min(stop, self.count)
+        begin = TRACE_HEADER.size + start * TRACE_RECORD.size
+        end = TRACE_HEADER.size + stop * TRACE_RECORD.size
+
+        for (timestamp, packed) in TRACE_RECORD.iter_unpack(self.map[begin:end]):
+            yield (timestamp, packed & 0xFFFFFF, packed >> 24)
+
+
+    def wallTime(self, timestamp):
+        # Wall clock time of a record's monotonic time.
+        return self.wallStart + (timestamp - self.monotonicStart)
+
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class HX711Replay(EmulatedHX711):
+    # Serves a recorded trace through the HX711 API (hx711.HX711 flavour,
+    # see hx711_emulator.HX711). Frames become ready at their recorded times
+    # on a VirtualClock that starts at the wall clock time of the recording:
+    # speed=1 replays in real time, speed=N N times faster and speed=None as
+    # fast as the frames are read. Frames are served per gain: a read gets
+    # the next frame recorded at the gain its conversion was selected with,
+    # frames recorded at other gains are skipped (frames of unknown gain
+    # match any). At the end of the trace reads raise EOFError, unless
+    # `loop` starts the trace over.
+
+    def __init__(self, path, speed=1.0, loop=False, gain=128):
+        self.trace = HX711Trace(path)
+        if self.trace.count == 0:
+            self.trace.close()
+            raise ValueError("HX711Replay(): %s holds no frames!" % path)
+
+        self.position = 0
+        # Guards position and timeShift, moved by is_ready() as well as by
+        # reads.
+        self.positionLock = threading.Lock()
+        self.loop = loop
+        self.lastGain = None
+        # Added to record times to get clock times, grows with every loop.
+        self.timeShift = self.trace.wallStart - self.trace.monotonicStart
+
+        super().__init__(None, None, gain, clock=VirtualClock(self.trace.wallTime(self.trace.record(0)[0]), speed))
+        self.conversionGain = self.GAIN
+
+
+    def set_gain(self, gain):
+        # Selecting a gain doesn't cost a frame here, the trace already holds
+        # whatever the recorded driver threw away.
+        if gain == 128:
+            self.GAIN = 1
+        elif gain == 64:
+            self.GAIN = 3
+        elif gain == 32:
+            self.GAIN = 2
+        else:
+            return False
+
+        self.conversionGain = self.GAIN
+        return True
+
+
+    def nextTime(self):
+        # Due time of the next frame at the conversion's gain, skipping the
+        # frames recorded at other gains. None at the end of the trace.
+        with self.positionLock:
+            skipped = 0
+            while True:
+                if self.position >= self.trace.count:
+                    if not self.loop:
+                        return None
+
+                    # Continue one sample period after the last frame.
+                    last = self.trace.record(self.trace.count - 1)[0]
+                    first = self.trace.record(0)[0]
+                    self.timeShift += last - first + 1.0 / self.sampleRateHz
+                    self.position = 0
+
+                (timestamp, rawLong, gain) = self.trace.record(self.position)
+                if gain == 0 or gain == self.conversionGain:
+                    return timestamp + self.timeShift
+
+                self.position += 1
+                skipped += 1
+                if skipped > self.trace.count:
+                    raise ValueError("HX711Replay(): %s holds no frames at gain pulses %d!" % (self.trace.path, self.conversionGain))
+
+
+    def is_ready(self):
+        due = self.nextTime()
+        return due is not None and self.clock.time() >= due
+
+
+    def wait_ready(self, deadline=None):
+        while True:
+            due = self.nextTime()
+            if due is None:
+                raise EOFError("HX711Replay(): end of trace %s" % self.trace.path)
+
+            wait = due - self.clock.time()
+            if wait <= 0:
+                return True
+
+            if deadline is not None:
+                remaining = deadline - self.clock.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            self.clock.sleep(wait)
+
+
+    def readSample(self, deadline=None, blockUntilReady=True):
+        deadline = self.get_deadline(deadline)
+
+        perfCounter = time.perf_counter
+        start = perfCounter()
+
+        if blockUntilReady:
+            lockTimeout = -1 if deadline is None else max(0, deadline - self.clock.monotonic())
+            if not self.readLock.acquire(timeout=lockTimeout):
+                raise HX711TimeoutError("HX711Replay().readRawLong(): timed out waiting for the read lock")
+        elif not self.readLock.acquire(False):
+            return None
+
+        try:
+            locked = perfCounter()
+
+            if not self.wait_ready(deadline):
+                raise HX711TimeoutError("HX711Replay().readRawLong(): timed out waiting for the next frame")
+
+            ready = perfCounter()
+            with self.positionLock:
+                (timestamp, rawLong, self.lastGain) = self.trace.record(self.position)
+                self.position += 1
+            # The pulses after this frame select the next conversion.
+            self.conversionGain = self.GAIN
+            self.lastReadTime = self.clock.time()
+            self.sampleCount += 1
+
+            done = perfCounter()
+            self.lastLockWait = locked - start
+            self.lastReadyWait = ready - locked
+            self.lastClockOut = done - ready
+            self.lastLockHold = done - locked
+
+        finally:
+            self.readLock.release()
+
+        return rawLong
+
+
+    def reset(self):
+        pass
+
+
+    def close(self):
+        self.trace.close()
+
+# EOF - hx711_trace.py
@@ -2,6 +2,60 @@ import RPi.GPIO as GPIO
 import time
 import threading
 
+try:
+    from .hx711_filters import SlidingMedian, TrimmedMean
+except ImportError:
+    from hx711_filters import SlidingMedian, TrimmedMean
+
+
+def buildBitWeights(byteFormat, bitFormat):
+    # Lookup table with, for each of the 24 data bits in the order they are
+    # clocked out of the HX711, the value that bit carries in the final 24bit
+    # twos complement word. Byte and bit ordering are resolved here once, so
+    # the clock-out loop only has to OR in a table entry for every high bit.
+    weights = []
+
+    for bitIndex in range(24):
+        byteIndex = bitIndex // 8
+        bitInByte = bitIndex % 8
+
+        if byteFormat == 'MSB':
+            byteShift = (2 - byteIndex) * 8
+        else:
+            byteShift = byteIndex * 8
+
+        if bitFormat == 'MSB':
+            bitShift = 7 - bitInByte
+        else:
+            bitShift = bitInByte
+
+        weights.append(1 << (byteShift + bitShift))
+
+    return tuple(weights)
+
+def buildSuspectFrames(bitWeights):
+    # The 24bit words, in the configured byte and bit order, of frames that
+    # can't be trusted, mapped to the check they fail: positive (0x7FFFFF)
+    # and negative (0x800000) saturation, and all ones, which is what a chip
+    # that powered down in the middle of a frame clocks out. The first bit
+    # clocked out is the sign bit.
+    signBit = bitWeights[0]
+
+    return {0xFFFFFF ^ signBit: "saturated", signBit: "saturated", 0xFFFFFF: "stuck"}
+
+class HX711TimeoutError(TimeoutError):
+    # Raised when a read doesn't complete before its deadline, either because
+    # another thread held the read lock or because the HX711 never pulled DOUT
+    # low (unplugged or powered down load cell).
+    pass
+
+
+class HX711FrameError(IOError):
+    # Raised when a read gives up after frameRetries frames in a row failed
+    # the integrity checks (see checkFrame()).
+    pass
+
+
 class HX711:
 
     def __init__(self, dout, pd_sck, gain=128):
@@ -11,7 +65,9 @@ class HX711:
 
         # Mutex for reading from the HX711, in case multiple threads in client
         # software try to access get values from the class at the same time.
-        self.readLock = threading.Lock()
+        # Reentrant, so a caller can hold it across selecting a gain and
+        # reading, with both channels of the HX711 in use.
+        self.readLock = threading.RLock()
         
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.PD_SCK, GPIO.OUT)
@@ -28,6 +84,52 @@ class HX711:
 
         self.byteFormat = 'MSB' # 'MSB' or 'LSB'
         self.bitFormat = 'MSB' # 'MSB' or 'LSB'
+        self.bitWeights = buildBitWeights(self.byteFormat, self.bitFormat)
+        self.suspectFrames = buildSuspectFrames(self.bitWeights)
+
+        # Seconds a single read may take when the caller doesn't pass a
+        # deadline. None waits forever.
+        self.readTimeout = 1.0
+
+        # Waiting for DOUT sleeps on a falling edge interrupt when possible,
+        # re-checking DOUT every readyPollInterval seconds. Without edge
+        # detection (or while the ready callback owns DOUT's edge detection)
+        # it just sleeps readyPollInterval between checks.
+        self.useEdgeDetect = True
+        self.readyPollInterval = 0.005
+
+        # Conversions per second the RATE pin selects (10 or 80). Not used
+        # for reading, schedulers driving several HX711s sleep until the
+        # next conversion is due with it.
+        self.sampleRateHz = 80.0
+
+        # Timings (seconds) of the last frame read: waiting for the read
+        # lock, waiting for DOUT, clocking the frame out and the whole time
+        # the lock was held. Cheap to keep, read by whoever wants metrics.
+        self.lastLockWait = 0.0
+        self.lastReadyWait = 0.0
+        self.lastClockOut = 0.0
+        self.lastLockHold = 0.0
+
+        # Frame integrity checks. A frame is thrown away and the next one read
+        # (up to frameRetries times per read, within the read's deadline) when
+        # PD_SCK may have been high longer than highTimeBudget seconds (the
+        # HX711 powers down after 60us), when it is saturated or all ones, or
+        # when DOUT isn't high after it. Failures are counted per check.
+        self.checkFrames = True
+        self.frameRetries = 3
+        self.highTimeBudget = 0.00006
+        self.frameErrorCounts = {"timing": 0, "saturated": 0, "stuck": 0, "dout": 0}
+        self.frameFailureCount = 0
+        self.lastHighTime = 0.0
+        self.lastDoutHigh = True
+
+        self.readyCallbackEnabled = False
+        self.paramCallback = None
+        self.lastRawBytes = None
+        # Frames the ready callback lost because another thread held the read
+        # lock when DOUT fell.
+        self.droppedFrameCount = 0
         
         # GAIN must be between 1 and 3. None is an invalid value.
         self.GAIN = None
@@ -40,10 +142,6 @@ class HX711:
         
         # Think about whether this is necessary.
         time.sleep(1)
-        
-        self.readyCallbackEnabled = False
-        self.paramCallback = None
-        self.lastRawBytes = None
 
 
     def powerDown(self):
@@ -96,6 +194,45 @@ class HX711:
         return GPIO.input(self.DOUT) == GPIO.LOW
 
 
+    def waitReady(self, deadline=None):
+        # Wait until the HX711 pulls DOUT low or the deadline (a
+        # time.monotonic() value) passes. Returns False on timeout.
+        #
+        # Instead of spinning on isReady() we block on a falling edge of DOUT,
+        # which doesn't burn any CPU. The wait is capped at readyPollInterval
+        # and DOUT re-checked: an edge that happened just before we started
+        # waiting is missed, and DOUT then stays low until the sample is read.
+        while self.isReady() is not True:
+            wait = self.readyPollInterval
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            if self.useEdgeDetect and not self.readyCallbackEnabled:
+                try:
+                    GPIO.wait_for_edge(self.DOUT, GPIO.FALLING, timeout=max(1, int(wait * 1000)))
+                    continue
+                except RuntimeError:
+                    # Edge detection is already in use on DOUT. Fall back to
+                    # sleeping.
+                    self.useEdgeDetect = False
+
+            time.sleep(wait)
+
+        return True
+
+
+    def getDeadline(self, deadline=None):
+        # Deadline for a read when the caller didn't supply one.
+        if deadline is not None or self.readTimeout is None:
+            return deadline
+
+        return time.monotonic() + self.readTimeout
+
+
     def setGain(self, gain):
         
         if gain == 128:
@@ -150,78 +287,146 @@ class HX711:
         raise ValueError("HX711::getChannel() gain is currently an invalid value")
 
 
-    def readNextBit(self):
-       # Clock HX711 Digital Serial Clock (PD_SCK).  DOUT will be
-       # ready 1us after PD_SCK rising edge, so we sample after
-       # lowering PD_SCL, when we know DOUT will be stable.
-       GPIO.output(self.PD_SCK, True)
-       GPIO.output(self.PD_SCK, False)
-       bitValue = GPIO.input(self.DOUT)
-
-       # Convert Boolean to int and return it.
-       return int(bitValue)
-
-
-    def readNextByte(self):
-       byteValue = 0
-
-       # Read bits and build the byte from top, or bottom, depending
-       # on whether we are in MSB or LSB bit mode.
-       for x in range(8):
-            if self.bitFormat == 'MSB':
-                # Most significant Byte first.
-                byteValue <<= 1
-                byteValue |= self.readNextBit()
-            else:
-                # Less significant Byte first.
-                byteValue >>= 1              
-                byteValue |= self.readNextBit() * 0x80
-
-       # Return the packed byte.
-       return byteValue 
-
-
-    def readRawBytes(self, blockUntilReady=True):
+    def readRawLong(self, blockUntilReady=True, deadline=None):
         
         if self.GAIN is None:
-            raise ValueError("HX711::readRawBytes() called without setting gain first!")
+            raise ValueError("HX711::readRawLong() called without setting gain first!")
+
+        deadline = self.getDeadline(deadline)
+
+        perfCounter = time.perf_counter
+        start = perfCounter()
         
         # Try to get the Read Lock. If we can't, we lost our opportunity to read.
         # Though this behaviour is not ideal, it seems key to avoid time consuming interrupt handlers.
-        if self.readLock.acquire(blockUntilReady) is False:
+        if blockUntilReady:
+            lockTimeout = -1 if deadline is None else max(0, deadline - time.monotonic())
+            if self.readLock.acquire(timeout=lockTimeout) is False:
+                raise HX711TimeoutError("HX711::readRawLong() timed out waiting for the read lock")
+        elif self.readLock.acquire(False) is False:
             # If we couldn't get the lock, it's probably because someone else
             # is reading the HX711 right now.  We'll just skip this reading and
             # return None.
             return None
 
-        # Wait until HX711 is ready for us to read a sample.
-        while self.isReady() is not True:
-           pass
-
-        # Read three bytes of data from the HX711.
-        firstByte  = self.readNextByte()
-        secondByte = self.readNextByte()
-        thirdByte  = self.readNextByte()
+        try:
+            locked = perfCounter()
+            failures = 0
+
+            while True:
+                # Wait until HX711 is ready for us to read a sample.
+                if self.waitReady(deadline) is not True:
+                    raise HX711TimeoutError("HX711::readRawLong() timed out waiting for the HX711 to become ready")
+
+                ready = perfCounter()
+                value = self.clockOutFrame()
+                done = perfCounter()
+
+                error = self.checkFrame(value) if self.checkFrames else None
+                if error is None:
+                    break
+
+                # Throw the frame away and read the next one.
+                self.frameErrorCounts[error] += 1
+                failures += 1
+                if failures > self.frameRetries:
+                    self.frameFailureCount += 1
+                    raise HX711FrameError("HX711::readRawLong() %d frames in a row failed the integrity checks, last: %s" % (failures, error))
+
+                # A HX711 that powered down comes back up on channel A, gain
+                # 128, and its next frame is converted at that gain.
+                if error == "timing" and self.GAIN != 1:
+                    if self.waitReady(deadline) is not True:
+                        raise HX711TimeoutError("HX711::readRawLong() timed out waiting for the HX711 to become ready")
+                    self.clockOutFrame()
+
+            self.lastLockWait = locked - start
+            self.lastReadyWait = ready - locked
+            self.lastClockOut = done - ready
+            self.lastLockHold = done - locked
+            return value
+
+        finally:
+            # Release the Read Lock, now that we've finished driving the HX711
+            # serial interface.
+            self.readLock.release()
+
+
+    def clockOutFrame(self):
+
+        # Bind everything the clock-out loop touches to locals, keeping the
+        # time PD_SCK spends high as short as possible.
+        output = GPIO.output
+        readBit = GPIO.input
+        perfCounter = time.perf_counter
+        pdSck = self.PD_SCK
+        dout = self.DOUT
+        value = 0
+
+        # Upper bound of the time PD_SCK was high, timed around every pulse.
+        # The timer is read while PD_SCK is low, where time doesn't matter.
+        maxHighTime = 0.0
+
+        # Clock the 24 data bits straight into one integer. Byte and bit
+        # ordering are taken care of by the bitWeights lookup table.
+        for weight in self.bitWeights:
+            pulseStart = perfCounter()
+            output(pdSck, True)
+            output(pdSck, False)
+            highTime = perfCounter() - pulseStart
+            if readBit(dout):
+                value |= weight
+            if highTime > maxHighTime:
+                maxHighTime = highTime
 
         # HX711 Channel and gain factor are set by number of bits read
         # after 24 data bits.
         for i in range(self.GAIN):
-           # Clock a bit out of the HX711 and throw it away.
-           self.readNextBit()
+            # Clock a bit out of the HX711 and throw it away.
+            pulseStart = perfCounter()
+            output(pdSck, True)
+            output(pdSck, False)
+            highTime = perfCounter() - pulseStart
+            if highTime > maxHighTime:
+                maxHighTime = highTime
 
-        # Release the Read Lock, now that we've finished driving the HX711
-        # serial interface.
-        self.readLock.release()           
+        # The 25th pulse pulls DOUT high until the next conversion is ready.
+        self.lastDoutHigh = readBit(dout)
+        self.lastHighTime = maxHighTime
 
-        # Depending on how we're configured, return an orderd list of raw byte values.
-        if self.byteFormat == 'MSB':
-            # Most significant Byte first.
-            return [firstByte, secondByte, thirdByte]
-        else:
-            # Less Significant Byte first.
-            return [thirdByte, secondByte, firstByte]
+        # Return the 24bit 2s complement value.
+        return value
+
+
+    def checkFrame(self, value):
+        # Returns the check the frame just clocked out failed, or None. A
+        # PD_SCK pulse over budget may have powered the chip down mid frame;
+        # lost or extra bits leave DOUT low after the frame.
+        if self.lastHighTime > self.highTimeBudget:
+            return "timing"
+
+        error = self.suspectFrames.get(value)
+        if error is not None:
+            return error
 
-    def getRawBytes(self, channel='A'):
+        if not self.lastDoutHigh:
+            return "dout"
+
+        return None
+
+
+    def readRawBytes(self, blockUntilReady=True, deadline=None):
+        
+        rawLong = self.readRawLong(blockUntilReady, deadline)
+        
+        if rawLong is None:
+            return None
+
+        # The byte order configured with setReadingFormat has already been
+        # applied, so joining these bytes MSB first gives the sample back.
+        return [(rawLong >> 16) & 0xFF, (rawLong >> 8) & 0xFF, rawLong & 0xFF]
+
+    def getRawBytes(self, channel='A', deadline=None):
         
         # Get current channel
         currentChannel = self.getChannel()
@@ -231,12 +436,13 @@ class HX711:
             # Temporarily switch to the requested channel
             self.setChannel(channel)
         
-        rawBytes = self.readRawBytes()
-        
-        # Compare the requested channel with the current channel
-        if channel != currentChannel:
-            # Switch back to the original channel
-            self.setChannel(currentChannel)
+        try:
+            rawBytes = self.readRawBytes(deadline=deadline)
+        finally:
+            # Compare the requested channel with the current channel
+            if channel != currentChannel:
+                # Switch back to the original channel
+                self.setChannel(currentChannel)
         
         return rawBytes
 
@@ -252,7 +458,16 @@ class HX711:
         if(pin != self.DOUT):
             return
         
-        self.lastRawBytes = self.readRawBytes(blockUntilReady=False)
+        try:
+            self.lastRawBytes = self.readRawBytes(blockUntilReady=False)
+        except (HX711TimeoutError, HX711FrameError):
+            # Already counted by the read. Raising here would only print a
+            # traceback from the GPIO callback thread.
+            self.lastRawBytes = None
+        else:
+            if self.lastRawBytes is None:
+                self.droppedFrameCount += 1
+
         if self.paramCallback is not None:
             self.paramCallback(self.lastRawBytes)
 
@@ -279,12 +494,28 @@ class HX711:
         
         self.byteFormat = byteFormat
         self.bitFormat = bitFormat
+        self.bitWeights = buildBitWeights(self.byteFormat, self.bitFormat)
+        self.suspectFrames = buildSuspectFrames(self.bitWeights)
 
     
     def convertFromTwosComplement24bit(self, inputValue):
         return -(inputValue & 0x800000) + (inputValue & 0x7fffff)
 
     
+    def rawLongToLong(self, rawLong=None):
+        
+        if rawLong is None:
+            return None
+
+        # Convert from 24bit twos-complement to a signed value.
+        signed_int_value = rawLong - ((rawLong & 0x800000) << 1)
+
+        # Record the latest sample value we've read.
+        self.lastVal = signed_int_value
+
+        return signed_int_value
+
+
     def rawBytesToLong(self, rawBytes=None):
         
         if rawBytes is None:
@@ -305,22 +536,49 @@ class HX711:
         return int(signed_int_value)
 
 
-    def getLong(self, channel='A'):
+    def getLong(self, channel='A', deadline=None):
                 
         currentChannel = self.getChannel()
         if channel != currentChannel:
             self.setChannel(channel)
         
-        # Get a sample from the HX711 in the form of raw bytes.
-        rawBytes = self.readRawBytes()
+        try:
+            # Get a sample from the HX711 as a 24bit 2s complement value.
+            rawLong = self.readRawLong(deadline=deadline)
+        finally:
+            if channel != currentChannel:
+                self.setChannel(currentChannel)
         
+        return self.rawLongToLong(rawLong)
+
+
+    def getLongFiltered(self, valueFilter, times=1, channel='A', deadline=None):
+        # Feeds `times` new samples into a streaming filter from hx711_filters
+        # (SlidingMedian, TrimmedMean, ...) and returns the filter's value.
+        # Pass a long lived filter to keep filtering a continuous stream. The
+        # deadline, if given, bounds all `times` reads together.
+        currentChannel = self.getChannel()
         if channel != currentChannel:
-            self.setChannel(currentChannel)
-        
-        if rawBytes is None:
-            return None
-        
-        return self.rawBytesToLong(rawBytes)
+            self.setChannel(channel)
+
+        try:
+            for x in range(times):
+                rawLong = self.readRawLong(deadline=deadline)
+                if rawLong is not None:
+                    valueFilter.push(self.rawLongToLong(rawLong))
+        finally:
+            if channel != currentChannel:
+                self.setChannel(currentChannel)
+
+        return valueFilter.value
+
+
+    def getLongMedian(self, times=3, channel='A', deadline=None):
+        return self.getLongFiltered(SlidingMedian(times), times, channel, deadline)
+
+
+    def getLongTrimmedMean(self, times=15, channel='A', deadline=None):
+        return self.getLongFiltered(TrimmedMean(times, 0.2), times, channel, deadline)
 
 
     def setOffset(self, offset, channel='A'):
@@ -369,16 +627,17 @@ class HX711:
         return longValue - offset
 
 
-    def getLongWithOffset(self, channel='A'):
+    def getLongWithOffset(self, channel='A', deadline=None):
         
         currentChannel = self.getChannel()
         if channel != currentChannel:
             self.setChannel(channel)
         
-        rawBytes = self.readRawBytes()
-        
-        if channel != currentChannel:
-            self.setChannel(currentChannel)
+        try:
+            rawBytes = self.readRawBytes(deadline=deadline)
+        finally:
+            if channel != currentChannel:
+                self.setChannel(currentChannel)
         
         if rawBytes is None:
             return None
@@ -426,16 +685,17 @@ class HX711:
         return longWithOffset / referenceUnit
 
     
-    def getWeight(self, channel='A'):
+    def getWeight(self, channel='A', deadline=None):
         
         currentChannel = self.getChannel()
         if channel != currentChannel:
             self.setChannel(channel)
         
-        rawBytes = self.readRawBytes()
-        
-        if channel != currentChannel:
-            self.setChannel(currentChannel)
+        try:
+            rawBytes = self.readRawBytes(deadline=deadline)
+        finally:
+            if channel != currentChannel:
+                self.setChannel(currentChannel)
         
         if rawBytes is None:
             return None
@@ -463,5 +723,109 @@ class HX711:
             self.setChannel(currentChannel)
         
         return True
+
+
+    # The hx711.HX711 API on top of this driver, so code written against
+    # hx711.py (and the emulator) can run on it, e.g. in interrupt mode.
+    def is_ready(self):
+        return self.isReady()
+
+
+    def set_gain(self, gain):
+        return self.setGain(gain)
+
+
+    def get_gain(self):
+        return self.getGain()
+
+
+    def set_reading_format(self, byte_format="LSB", bit_format="MSB"):
+        self.setReadingFormat(byte_format, bit_format)
+
+
+    def read_long(self, deadline=None):
+        return self.rawLongToLong(self.readRawLong(deadline=deadline))
+
+
+    def set_offset(self, offset):
+        self.setOffset(offset, 'A')
+
+
+    def set_offset_A(self, offset):
+        self.setOffset(offset, 'A')
+
+
+    def set_offset_B(self, offset):
+        self.setOffset(offset, 'B')
+
+
+    def get_offset(self):
+        return self.getOffset('A')
+
+
+    def get_offset_A(self):
+        return self.getOffset('A')
+
+
+    def get_offset_B(self):
+        return self.getOffset('B')
+
+
+    def set_reference_unit(self, reference_unit):
+        self.set_reference_unit_A(reference_unit)
+
+
+    def set_reference_unit_A(self, reference_unit):
+        if reference_unit == 0:
+            raise ValueError("HX711::set_reference_unit_A() can't accept 0 as a reference unit!")
+
+        self.setReferenceUnit(reference_unit, 'A')
+
+
+    def set_reference_unit_B(self, reference_unit):
+        if reference_unit == 0:
+            raise ValueError("HX711::set_reference_unit_B() can't accept 0 as a reference unit!")
+
+        self.setReferenceUnit(reference_unit, 'B')
+
+
+    def get_reference_unit(self):
+        return self.getReferenceUnit('A')
+
+
+    def get_reference_unit_A(self):
+        return self.getReferenceUnit('A')
+
+
+    def get_reference_unit_B(self):
+        return self.getReferenceUnit('B')
+
+
+    def get_weight(self, times=3, deadline=None):
+        return self.get_weight_A(times, deadline)
+
+
+    def get_weight_A(self, times=3, deadline=None):
+        return (self.getLongMedian(times, 'A', deadline) - self.OFFSET_A) / self.REFERENCE_UNIT_A
+
+
+    def get_weight_B(self, times=3, deadline=None):
+        return (self.getLongMedian(times, 'B', deadline) - self.OFFSET_B) / self.REFERENCE_UNIT_B
+
+
+    def tare(self, times=15, deadline=None):
+        return self.tare_A(times, deadline)
+
+
+    def tare_A(self, times=15, deadline=None):
+        value = self.getLongTrimmedMean(times, 'A', deadline)
+        self.setOffset(value, 'A')
+        return value
+
+
+    def tare_B(self, times=15, deadline=None):
+        value = self.getLongTrimmedMean(times, 'B', deadline)
+        self.setOffset(value, 'B')
+        return value
     
 # EOF - hx711.py
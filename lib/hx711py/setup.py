@@ -4,7 +4,7 @@ setup(
     name='hx711',
     version='0.1.0',
     description='HX711 Python Library for Raspberry Pi',
-    py_modules=['hx711'],
+    py_modules=['hx711', 'hx711_filters', 'hx711_emulator', 'hx711_trace'],
     install_requires=['Rpi.GPIO'],
 )
 
@@ -0,0 +1,579 @@
+import time
+import threading
+from array import array
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+from config import DEBUG
+
+# the frame integrity checks of the hx711 drivers, see checkFrame() in lib/hx711py/hx711.py
+FRAME_CHECKS = ("timing", "saturated", "stuck", "dout")
+
+# gain: pulses clocked after a frame to select it (and the input) for the next conversion
+GAIN_PULSES = {128: 1, 64: 3, 32: 2}
+
+class SampleRing(object):
+    """ fixed-size ring buffer of timestamped raw hx711 counts. backed by two preallocated arrays so appends never
+    allocate. one writer (the acquisition thread) and any number of readers. """
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("SampleRing(): size must be greater than zero!")
+
+        self._size = size
+        self._timestamps = array('d', [0.0]) * size
+        self._values = array('q', [0]) * size
+
+        # total number of samples ever written. the next write goes to _count % _size
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            index = self._count % self._size
+            self._timestamps[index] = timestamp
+            self._values[index] = value
+            self._count += 1
+
+    def latest(self, n):
+        """ returns up to the n most recent raw values, oldest first. """
+        return [value for (_, value) in self.latest_samples(n)]
+
+    def latest_samples(self, n):
+        """ returns up to the n most recent (timestamp, value) pairs, oldest first. """
+        with self._lock:
+            n = min(n, self._count, self._size)
+            start = self._count - n
+            return [(self._timestamps[i % self._size], self._values[i % self._size]) for i in range(start, self._count)]
+
+    def samples_since(self, seen):
+        """ the (timestamp, value) pairs written after the first `seen` samples, as many as are still in the ring, and
+        the sample count to pass next time. """
+        with self._lock:
+            start = max(seen, self._count - self._size)
+            return ([(self._timestamps[i % self._size], self._values[i % self._size]) for i in range(start, self._count)], self._count)
+
+    def last(self):
+        """ returns the most recent (timestamp, value) pair or None if nothing was written yet. """
+        with self._lock:
+            if self._count == 0:
+                return None
+            index = (self._count - 1) % self._size
+            return (self._timestamps[index], self._values[index])
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return min(self._count, self._size)
+
+
+class SharedSampleRing(object):
+    """ a SampleRing in shared memory: written by the sensor process (src/sensor_process.py) and read in place by any
+    process that attaches to it by name. lock free for one writer: it fills a slot and then bumps the sample count,
+    readers read the count, copy the slots and drop those the writer lapped meanwhile. the header also carries the
+    gain readers ask the writer to select, the offset of the writer's driver clock to the wall clock and the frame
+    integrity counters of the writer's driver. """
+    # sample count, size, requested gain (0 none) as int64, the clock offset as a double, then frames thrown away per
+    # FRAME_CHECKS and reads that gave up as int64
+    _HEADER_SIZE = 72
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            if size is None or size <= 0:
+                raise ValueError("SharedSampleRing(): size must be greater than zero!")
+            self._shm = shared_memory.SharedMemory(create=True, size=self._HEADER_SIZE + 16 * size)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+
+        buf = self._shm.buf
+        self._header = buf[0:24].cast('q')
+        self._offset = buf[24:32].cast('d')
+        self._frames = buf[32:72].cast('q')
+        if self._owner:
+            self._header[1] = size
+        self._size = self._header[1]
+
+        end = self._HEADER_SIZE + 8 * self._size
+        self._timestamps = buf[self._HEADER_SIZE:end].cast('d')
+        self._values = buf[end:end + 8 * self._size].cast('q')
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        count = self._header[0]
+        index = count % self._size
+        self._timestamps[index] = timestamp
+        self._values[index] = value
+        # published last, readers never look past the count
+        self._header[0] = count + 1
+
+    def _read(self, start, count):
+        samples = [(self._timestamps[i % self._size], self._values[i % self._size]) for i in range(start, count)]
+        # the writer may have lapped the oldest slots while they were copied, the slot of sample
+        # `count now - size` may be half written
+        lapped = self._header[0] - self._size + 1 - start
+        return samples[lapped:] if lapped > 0 else samples
+
+    def latest(self, n):
+        """ returns up to the n most recent raw values, oldest first. """
+        return [value for (_, value) in self.latest_samples(n)]
+
+    def latest_samples(self, n):
+        """ returns up to the n most recent (timestamp, value) pairs, oldest first. """
+        count = self._header[0]
+        n = min(n, count, self._size)
+        return self._read(count - n, count)
+
+    def samples_since(self, seen):
+        """ the (timestamp, value) pairs written after the first `seen` samples, as many as are still in the ring, and
+        the sample count to pass next time. """
+        count = self._header[0]
+        return (self._read(max(seen, count - self._size), count), count)
+
+    def last(self):
+        """ returns the most recent (timestamp, value) pair or None if nothing was written yet. """
+        samples = self.latest_samples(1)
+        return samples[0] if samples else None
+
+    def close(self):
+        """ detaches from the shared memory, the process that created the ring also frees it. """
+        if self._shm is None:
+            return
+
+        for view in (self._header, self._offset, self._frames, self._timestamps, self._values):
+            view.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def requested_gain(self):
+        return self._header[2]
+
+    @requested_gain.setter
+    def requested_gain(self, gain):
+        self._header[2] = gain
+
+    @property
+    def clock_offset(self):
+        """ seconds the writer's driver clock is ahead of the wall clock, not 0 for a replayed trace. """
+        return self._offset[0]
+
+    @clock_offset.setter
+    def clock_offset(self, offset):
+        self._offset[0] = offset
+
+    @property
+    def frame_errors(self):
+        """ frames the writer's driver threw away per integrity check, and reads it gave up on ("failures"). """
+        return dict(zip(FRAME_CHECKS + ("failures",), self._frames))
+
+    def publish_frame_errors(self, counts, failures):
+        for (i, check) in enumerate(FRAME_CHECKS):
+            self._frames[i] = counts.get(check, 0)
+        self._frames[len(FRAME_CHECKS)] = failures
+
+    @property
+    def count(self):
+        return self._header[0]
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return min(self._header[0], self._size)
+
+
+class AcquisitionChannel(object):
+    """ acquisition state of one hx711: a SampleRing of raw samples plus an optional outlier gate, streaming filter and
+    state estimator (see lib/hx711py/hx711_filters.py) every sample is pushed through, so the filtered value and the
+    estimate are always up to date and cost O(1) to read. driven by an AcquisitionWorker or, with several sensors, an
+    AcquisitionScheduler. an optional SensorMetrics (src/metrics.py) records frame timings and filter cost. """
+    def __init__(self, device, ring, value_filter=None, gate=None, estimator=None, metrics=None):
+        self._device = device
+        self._ring = ring
+        self._value_filter = value_filter
+        self._gate = gate
+        self._estimator = estimator
+        self._metrics = metrics
+        self._filter_lock = threading.Lock()
+        # samples are stamped with the driver's clock, an emulator may run on a virtual one
+        self._clock = getattr(device, "clock", time)
+        # set while a ChannelRunScheduler reads the hx711 (see read_in_runs)
+        self._run_gap = None
+
+    def sample(self, deadline=None):
+        """ clocks one sample out of the hx711 (waiting for it to be ready) into the ring and the filter. """
+        value = self._device.read_long(deadline)
+        self.receive(value)
+        return value
+
+    def receive(self, value):
+        """ takes a sample the driver just read, by itself (the v0.5.1 driver's ready callback) or for sample(). """
+        if self._metrics is not None:
+            self._metrics.observe_frame(self._device)
+
+        self.push(value, self._clock.time())
+
+    def push(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        self._ring.append(value, timestamp)
+        self.observe(value, timestamp)
+
+    def observe(self, value, timestamp):
+        """ pushes a sample that is already in the ring through the gate, filter and estimator. """
+        if self._metrics is None:
+            self._filter(value, timestamp)
+            return
+
+        start = time.perf_counter()
+        accepted = self._filter(value, timestamp)
+        self._metrics.observe_sample(accepted, time.perf_counter() - start)
+
+    def _filter(self, value, timestamp):
+        """ runs a sample through the gate, filter and estimator. returns False if the gate rejected it. """
+        if self._value_filter is None and self._estimator is None:
+            return True
+
+        with self._filter_lock:
+            if self._gate is not None and not self._gate.accept(value):
+                return False
+
+            if self._value_filter is not None:
+                self._value_filter.push(value)
+            if self._estimator is not None:
+                self._estimator.push(value, timestamp)
+
+        return True
+
+    def read_in_runs(self, gap):
+        """ marks the channel as read in runs by a ChannelRunScheduler, which owns the hx711 from now on. gap is the
+        longest the channel goes without a new sample in seconds. """
+        self._run_gap = gap
+
+    @property
+    def device(self):
+        return self._device
+
+    @property
+    def ring(self):
+        return self._ring
+
+    @property
+    def run_gap(self):
+        """ seconds between two samples at most while read in runs, None when the channel isn't. """
+        return self._run_gap
+
+    @property
+    def filtered_value(self):
+        """ current value of the streaming filter or None if there is no filter or its window is not full yet. """
+        if self._value_filter is None:
+            return None
+
+        with self._filter_lock:
+            return self._value_filter.value if len(self._value_filter) >= self._value_filter.size else None
+
+    @property
+    def estimate(self):
+        """ (value, rate per second, value std, rate std, timestamp of the last sample) in raw counts or None if there
+        is no estimator or it hasn't seen enough samples yet. """
+        if self._estimator is None:
+            return None
+
+        with self._filter_lock:
+            e = self._estimator
+            if not e.isReady():
+                return None
+            return (e.value, e.rate, e.valueStd, e.rateStd, e.timestamp)
+
+    @property
+    def rejected_count(self):
+        return self._gate.rejectedCount if self._gate is not None else 0
+
+
+class AcquisitionWorker(threading.Thread):
+    """ clocks samples out of one hx711 at its native rate into its AcquisitionChannel. read_long blocks until the
+    hx711 has a conversion ready so the loop runs at the chip's sample rate (10 or 80 SPS). """
+    def __init__(self, channel):
+        threading.Thread.__init__(self, daemon=True)
+        self._channel = channel
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._channel.sample()
+            except Exception as e:
+                if DEBUG:
+                    print("acquisition: read failed: {}".format(e))
+                time.sleep(0.1)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class AcquisitionScheduler(threading.Thread):
+    """ drives several hx711s from one thread. a thread per sensor would let the interpreter switch threads in the
+    middle of a frame and stretch PD_SCK, so instead every round reads each sensor that has a conversion ready, one
+    complete frame at a time, starting from a different sensor each round so none is starved. when no sensor is
+    ready it sleeps until the next conversion is due, one sample period (the drivers' sampleRateHz) after a sensor's
+    last read. a conversion running late is polled for every 1/16 period, a sensor more than a period late (unplugged,
+    powered down) only once a period. without sample rates it polls every idle_sleep seconds. """
+    def __init__(self, channels, idle_sleep=0.001):
+        threading.Thread.__init__(self, daemon=True)
+        self._channels = list(channels)
+        self._idle_sleep = idle_sleep
+        rates = [getattr(channel.device, "sampleRateHz", None) for channel in self._channels]
+        self._periods = [1.0 / rate if rate else None for rate in rates]
+        # monotonic time of every channel's last read, due right away
+        self._last_read = [time.monotonic() - (period or 0) for period in self._periods]
+        self._stop_event = threading.Event()
+
+    def run(self):
+        first = 0
+        while not self._stop_event.is_set():
+            read_any = False
+            count = len(self._channels)
+
+            for i in range(count):
+                index = (first + i) % count
+                channel = self._channels[index]
+                if not channel.device.is_ready():
+                    continue
+
+                self._last_read[index] = time.monotonic()
+                try:
+                    channel.sample()
+                    read_any = True
+                except Exception as e:
+                    if DEBUG:
+                        print("acquisition: read failed: {}".format(e))
+
+            first = (first + 1) % count
+            if not read_any:
+                self._stop_event.wait(self._idle_time(time.monotonic()))
+
+    def _idle_time(self, now):
+        """ seconds to sleep when no sensor had a conversion ready. """
+        wait = None
+        for (period, last_read) in zip(self._periods, self._last_read):
+            if period is None:
+                return self._idle_sleep
+
+            late = now - (last_read + period)
+            if late < 0:
+                channel_wait = -late
+            elif late < period:
+                channel_wait = period / 16
+            else:
+                channel_wait = period
+            wait = channel_wait if wait is None else min(wait, channel_wait)
+
+        return max(wait, self._idle_sleep)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class ChannelRunScheduler(threading.Thread):
+    """ reads both inputs of one hx711 in runs instead of switching channels around every read. the gain pulses after
+    a frame select the input of the next conversion, so the last frame of a run is clocked out with the next run's
+    gain (set on the driver directly) and a switch costs no extra frame. the first `settle` frames converted after a
+    switch are unsettled and thrown away. every run fills its own AcquisitionChannel, runs are (gain, frames, channel)
+    and their lengths weigh the channels' sample rates. the gain is set and the frame read under the driver's read
+    lock. the hx711 is this thread's alone: its channels are marked read in runs, with the longest gap between their
+    samples (the other runs, the unsettled frames and one conversion), and take no blocking reads. """
+    def __init__(self, device, runs, settle=1):
+        threading.Thread.__init__(self, daemon=True)
+        self._device = device
+        self._runs = [(GAIN_PULSES[gain], frames, channel) for (gain, frames, channel) in runs]
+        self._settle = settle
+        self._switches = 0
+        self._discarded = 0
+        self._stop_event = threading.Event()
+
+        rate = getattr(device, "sampleRateHz", None)
+        cycle = sum(frames + settle for (_, frames, _) in runs)
+        for (_, frames, channel) in runs:
+            channel.read_in_runs((cycle - frames + 1) / rate if rate else 0.0)
+
+    def run(self):
+        device = self._device
+        # gain pulses of the conversion under way (None when a failed read left it unknown) and how many more
+        # conversions after the last switch are unsettled
+        pending = device.GAIN
+        unsettled = self._settle
+
+        while not self._stop_event.is_set():
+            for (index, (pulses, frames, channel)) in enumerate(self._runs):
+                following = self._runs[(index + 1) % len(self._runs)][0]
+                kept = 0
+
+                while kept < frames and not self._stop_event.is_set():
+                    keep = pending == pulses and unsettled == 0
+
+                    try:
+                        with device.readLock:
+                            device.GAIN = following if keep and kept == frames - 1 else pulses
+                            if keep:
+                                channel.sample()
+                            else:
+                                device.read_long()
+                    except Exception as e:
+                        if DEBUG:
+                            print("acquisition: read failed: {}".format(e))
+                        pending = None
+                        time.sleep(0.1)
+                        continue
+
+                    if device.GAIN != pending:
+                        unsettled = self._settle
+                        self._switches += 1
+                    elif unsettled > 0:
+                        unsettled -= 1
+                    pending = device.GAIN
+
+                    if keep:
+                        kept += 1
+                    else:
+                        self._discarded += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def stats(self):
+        """ channel switches and frames thrown away (converted on the other channel or unsettled). """
+        return {"switches": self._switches, "discarded": self._discarded}
+
+
+def hx711_pins(sensor_config):
+    """ identifies the hx711 of a sensor: (backend, data pin, clock pin). """
+    return (sensor_config.get("backend"), sensor_config["data_pin"], sensor_config["clock_pin"])
+
+
+def shared_drivers(sensor_configs, build_driver):
+    """ a driver per sensor name. sensors on the same pins are channel A and B of one hx711 and share one driver. """
+    by_pins = {}
+    drivers = {}
+    for sensor_config in sensor_configs:
+        pins = hx711_pins(sensor_config)
+        if pins not in by_pins:
+            by_pins[pins] = build_driver(sensor_config)
+        drivers[sensor_config["name"]] = by_pins[pins]
+
+    return drivers
+
+
+def start_acquisition_threads(channels, idle_sleep=0.001, settle=1):
+    """ starts the threads clocking samples into channels, given as (AcquisitionChannel, gain, run frames): a
+    ChannelRunScheduler for every hx711 both inputs of which are read, and for the rest an AcquisitionWorker or, with
+    several hx711s, an AcquisitionScheduler interleaving them, with each hx711's gain selected first. returns the
+    threads. """
+    by_device = {}
+    for (channel, gain, frames) in channels:
+        by_device.setdefault(id(channel.device), []).append((gain, frames, channel))
+
+    threads = []
+    single = []
+    for runs in by_device.values():
+        if len(runs) > 1:
+            threads.append(ChannelRunScheduler(runs[0][2].device, runs, settle))
+        else:
+            (gain, _, channel) = runs[0]
+            if channel.device.get_gain() != gain:
+                channel.device.set_gain(gain)
+            single.append(channel)
+
+    if len(single) == 1:
+        threads.append(AcquisitionWorker(single[0]))
+    elif single:
+        threads.append(AcquisitionScheduler(single, idle_sleep))
+
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+class RingFollower(threading.Thread):
+    """ feeds the gate, filter and estimator of channels whose ring another process writes (see
+    src/sensor_process.py): every round observes the samples written since the last one, sleeping idle_sleep seconds
+    when there were none. """
+    def __init__(self, channels, idle_sleep=0.001):
+        threading.Thread.__init__(self, daemon=True)
+        self._channels = list(channels)
+        self._idle_sleep = idle_sleep
+        self._stop_event = threading.Event()
+
+    def run(self):
+        seen = [channel.ring.count for channel in self._channels]
+        while not self._stop_event.is_set():
+            read_any = False
+            for (i, channel) in enumerate(self._channels):
+                (samples, seen[i]) = channel.ring.samples_since(seen[i])
+                for (timestamp, value) in samples:
+                    channel.observe(value, timestamp)
+                read_any = read_any or bool(samples)
+
+            if not read_any:
+                time.sleep(self._idle_sleep)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class SingleFlight(object):
+    """ coalesces concurrent calls of fn: a caller arriving while a call is already running attaches to it and gets
+    its result (or exception) instead of starting another one. counts issued versus coalesced calls. """
+    def __init__(self, fn):
+        self._fn = fn
+        self._lock = threading.Lock()
+        self._in_flight = None
+        self._issued = 0
+        self._coalesced = 0
+
+    def __call__(self):
+        with self._lock:
+            future = self._in_flight
+            leader = future is None
+            if leader:
+                future = self._in_flight = Future()
+                self._issued += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(self._fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._in_flight = None
+
+        return future.result()
+
+    @property
+    def stats(self):
+        return {"issued": self._issued, "coalesced": self._coalesced}
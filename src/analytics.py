@@ -0,0 +1,180 @@
+""" incrementally maintained consumption rates and time-to-empty forecasts.
+
+every window (an hour, a shift, a day, a week, ...) fits a least squares line through the readings of its span. the
+readings are decimated into a fixed number of buckets holding only the regression sums, so a window costs the same
+memory whether it spans an hour or a week, adding a reading is O(1) and dropping the oldest bucket is O(buckets). """
+import threading
+import time
+from collections import deque
+
+NS_PER_S = 1000000000
+
+class RegressionSums(object):
+    """ sums for a least squares line w = a + b * t, mergeable with the sums of other readings. """
+    __slots__ = ("n", "st", "sw", "stt", "stw")
+
+    def __init__(self):
+        self.n = 0
+        self.st = 0.0
+        self.sw = 0.0
+        self.stt = 0.0
+        self.stw = 0.0
+
+    def add(self, t, w):
+        self.n += 1
+        self.st += t
+        self.sw += w
+        self.stt += t * t
+        self.stw += t * w
+
+    def merge(self, other):
+        self.n += other.n
+        self.st += other.st
+        self.sw += other.sw
+        self.stt += other.stt
+        self.stw += other.stw
+
+    def slope(self):
+        """ the slope of the fitted line or None with fewer than two distinct times. """
+        if self.n < 2:
+            return None
+
+        mean_t = self.st / self.n
+        var_t = self.stt / self.n - mean_t * mean_t
+        if var_t <= 0:
+            return None
+
+        return (self.stw / self.n - mean_t * self.sw / self.n) / var_t
+
+
+class ConsumptionWindow(object):
+    """ rate of change over the last `span` seconds, decimated into `buckets` buckets of regression sums. """
+    def __init__(self, span, buckets=60):
+        self._span = span
+        self._buckets = buckets
+        self._width = span / buckets
+        # [bucket index, RegressionSums], oldest first
+        self._sums = deque()
+        self._total = RegressionSums()
+        self._first = None
+        self._last = None
+
+    def push(self, t, w):
+        index = int(t // self._width)
+        if not self._sums or self._sums[-1][0] != index:
+            self._sums.append([index, RegressionSums()])
+            self._expire(index)
+
+        self._sums[-1][1].add(t, w)
+        self._total.add(t, w)
+        self._last = t
+        if self._first is None:
+            self._first = t
+
+    def _expire(self, index):
+        expired = False
+        while self._sums[0][0] <= index - self._buckets:
+            self._sums.popleft()
+            expired = True
+
+        if not expired:
+            return
+
+        # rebuilt from the buckets instead of subtracting, so rounding errors don't pile up over months
+        self._total = RegressionSums()
+        for (_, sums) in self._sums:
+            self._total.merge(sums)
+        self._first = self._sums[0][0] * self._width
+
+    def clear(self):
+        self._sums.clear()
+        self._total = RegressionSums()
+        self._first = None
+        self._last = None
+
+    @property
+    def slope(self):
+        return self._total.slope()
+
+    @property
+    def count(self):
+        return self._total.n
+
+    @property
+    def covered(self):
+        """ seconds of the span that hold readings, less than the span until the window filled up. """
+        if self._first is None:
+            return 0
+        return min(self._span, self._last - max(self._first, self._last - self._span))
+
+
+class ConsumptionAnalytics(object):
+    """ consumption rates over several windows and the time left until the cylinder reaches `empty_weight`.
+
+    readings are pushed by the sensor worker as they are taken. snapshot() is what the api serves: it is computed at
+    most once every `cache_ttl` seconds, so dashboards polling it never cost more than a dict lookup. a jump up by more
+    than `refill_threshold` is a cylinder swap and starts all windows over. """
+    def __init__(self, windows, empty_weight=0, refill_threshold=None, buckets=60, cache_ttl=5):
+        self._windows = {name: ConsumptionWindow(span, buckets) for (name, span) in windows.items()}
+        self._empty_weight = empty_weight
+        self._refill_threshold = refill_threshold
+        self._cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        # times are kept in seconds since the first reading so the squared sums stay small
+        self._origin = None
+        self._latest = None
+        self._refilled = None
+        self._snapshot = None
+        self._snapshot_time = None
+
+    def push(self, created_date, weight):
+        """ feeds a reading, created date in ns since the epoch. """
+        if weight is None:
+            return
+
+        with self._lock:
+            if self._origin is None:
+                self._origin = created_date
+
+            if self._latest is not None and self._refill_threshold is not None and weight - self._latest[1] > self._refill_threshold:
+                for window in self._windows.values():
+                    window.clear()
+                self._refilled = created_date
+
+            t = (created_date - self._origin) / NS_PER_S
+            for window in self._windows.values():
+                window.push(t, weight)
+            self._latest = (created_date, weight)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is None or now - self._snapshot_time >= self._cache_ttl:
+                self._snapshot = self._compute()
+                self._snapshot_time = now
+
+            return self._snapshot
+
+    def _compute(self):
+        if self._latest is None:
+            return {"weight": None, "empty_weight": self._empty_weight, "windows": {}}
+
+        (created_date, weight) = self._latest
+        remaining = weight - self._empty_weight
+
+        windows = {}
+        for (name, window) in self._windows.items():
+            slope = window.slope
+            # consumption is positive while the weight goes down
+            rate = -slope if slope is not None else None
+            time_to_empty = remaining / rate if rate is not None and rate > 0 else None
+            windows[name] = {
+                "rate_per_hour": rate * 3600 if rate is not None else None,
+                "samples": window.count,
+                "covered": window.covered,
+                "time_to_empty": time_to_empty,
+                "empty_at": created_date + int(time_to_empty * NS_PER_S) if time_to_empty is not None else None,
+            }
+
+        return {"timestamp": created_date, "weight": weight, "empty_weight": self._empty_weight, "remaining": remaining,
+            "refilled": self._refilled, "windows": windows}
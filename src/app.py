@@ -1,78 +1,163 @@
 import time
 import threading
-from fastapi import FastAPI, BackgroundTasks
+import asyncio
+from fastapi import FastAPI, APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import uvicorn
-import RPi.GPIO as GPIO
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-import sqlite3
 import os 
 import pickle
-import queue
 import calendar
 
-from lib.hx711py import hx711
+try:
+    import RPi.GPIO as GPIO
+    from lib.hx711py import hx711
+    from lib.hx711py import hx711v0_5_1
+except ImportError:
+    # not running on a pi, only the emulator backend is available
+    GPIO = None
+    hx711 = None
+    hx711v0_5_1 = None
+from lib.hx711py import hx711_emulator
+from lib.hx711py import hx711_trace
+from lib.hx711py.hx711_filters import SlidingMedian
+from lib.hx711py.hx711_filters import TrimmedMean
+from lib.hx711py.hx711_filters import MadGate
+from lib.hx711py.hx711_filters import ConstantVelocityKalman
+
+from src.acquisition import SampleRing
+from src.acquisition import AcquisitionChannel
+from src.acquisition import AcquisitionWorker
+from src.acquisition import RingFollower
+from src.acquisition import shared_drivers
+from src.acquisition import hx711_pins
+from src.acquisition import start_acquisition_threads
+from src.acquisition import SingleFlight
+from src.sensor_process import SensorProcess
+from src.storage import DBWorker
+from src.storage import ReadPool
+from src.streaming import Broadcaster
+from src.polling import AdaptivePollingRate
+from src.analytics import ConsumptionAnalytics
+from src.sessions import SessionSegmenter
+from src.jobs import JobRegistry
+from src.calibration import CalibrationCurve
+from src import metrics
 
-from config import APP_NAME
-from config import WELDER_TYPE
 
 from config import SENSOR_POLLING_RATE
-from config import DATA_PIN
-from config import CLOCK_PIN
+from config import SENSOR_POLLING_ADAPTIVE
+from config import SENSOR_POLLING_MIN
+from config import SENSOR_POLLING_MAX
+from config import SENSOR_POLLING_BACKOFF
+from config import SENSOR_POLLING_SLOPE_THRESHOLD
+from config import SENSOR_POLLING_STDDEV_THRESHOLD
+from config import SENSOR_POLLING_WINDOW
+from config import SENSOR_POLLING_HYSTERESIS
+from config import SENSORS
+from config import SENSOR_BACKEND
+from config import EMULATOR_SEED
+from config import REPLAY_SPEED
 from config import LED_PIN
 from config import DEBUG
 
 from config import REFERENCE_UNIT
 from config import MEDIAN_VALUE_N
-
-class DBWorker(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
-        self._db = sqlite3.connect("{}-{}-db".format(APP_NAME, WELDER_TYPE.name))
-        self._queue = queue.Queue()
-
-        # first creates a table if not exists
-        self.enqueue("CREATE TABLE IF NOT EXISTS Weights (Id INTEGER PRIMARY KEY AUTOINCREMENT, CreatedDate INTEGER, Data INTEGER)")
-
-    def enqueue(self, sql, sql_params=tuple | None, cb=None):
-        self._queue.put((sql, sql_params, cb), False)
-
-    def run(self):
-        while 1:
-            (sql, sql_params, cb) = self._queue.get(block=True)
-
-            try:
-                cur = self._db.cursor()
-                
-                if sql_params:
-                    cur.execute(sql, sql_params)
-                else:
-                    cur.execute(sql)
-
-                if cb: 
-                    cb(cur.fetchall())
-
-                self._db.commit()
-            except Exception as e:
-                raise e
-            
-            finally:
-                cur.close()
-
+from config import ACQUISITION_MODE
+from config import SAMPLE_RING_SIZE
+from config import ACQUISITION_IDLE_SLEEP
+from config import SENSOR_SAMPLE_RATE
+from config import CHANNEL_RUN_FRAMES
+from config import CHANNEL_SETTLE_FRAMES
+from config import SAMPLE_MAX_AGE
+from config import TARE_SAMPLES
+from config import JOB_POLL_INTERVAL
+from config import JOB_HISTORY
+from config import OUTLIER_GATE_THRESHOLD
+from config import ESTIMATOR_ENABLED
+from config import ESTIMATOR_PROCESS_NOISE
+from config import ESTIMATOR_MEASUREMENT_NOISE
+from config import SENSOR_READ_TIMEOUT
+from config import SENSOR_FRAME_RETRIES
+from config import SENSOR_REQUEST_TIMEOUT
+from config import DB_READ_POOL_SIZE
+from config import ANALYTICS_WINDOWS
+from config import ANALYTICS_BUCKETS
+from config import ANALYTICS_EMPTY_WEIGHT
+from config import ANALYTICS_REFILL_THRESHOLD
+from config import ANALYTICS_CACHE_TTL
+from config import SESSION_DRIFT
+from config import SESSION_START_THRESHOLD
+from config import SESSION_END_THRESHOLD
+
+def build_driver(sensor_config):
+    """ the hx711 driver for a sensor: the gpio one, the emulated load cell or a replayed trace. interrupt acquisition
+    needs the ready callback of the v0.5.1 driver (or its emulation). """
+    backend = sensor_config.get("backend", SENSOR_BACKEND)
+    interrupt = ACQUISITION_MODE == "interrupt"
+    sample_rate = sensor_config.get("sample_rate", SENSOR_SAMPLE_RATE)
+    if backend == "emulator":
+        emulator = hx711_emulator.HX711v0_5_1 if interrupt else hx711_emulator.HX711
+        return emulator(sensor_config["data_pin"], sensor_config["clock_pin"], seed=EMULATOR_SEED, sampleRateHz=sample_rate)
+
+    if backend == "replay":
+        if interrupt:
+            raise RuntimeError("sensor {}: a replayed trace has no ready callback, use continuous acquisition".format(sensor_config["name"]))
+        return hx711_trace.HX711Replay(sensor_config["replay_file"], speed=REPLAY_SPEED)
+
+    if hx711 is None:
+        raise RuntimeError("sensor {}: the hx711 backend needs RPi.GPIO, use the emulator backend off the pi".format(sensor_config["name"]))
+
+    driver = (hx711v0_5_1.HX711 if interrupt else hx711.HX711)(sensor_config["data_pin"], sensor_config["clock_pin"])
+    driver.sampleRateHz = sample_rate
+    return driver
 
 class HX711Device(object):
-    def __init__(self, init_hx: hx711.HX711 | None = None):
-        # self._device = hx711.HX711(dout=DATA_PIN, pd_sck=CLOCK_PIN, gain=128) if init_hx is None else init_hx
-        self._device = hx711.HX711(DATA_PIN, CLOCK_PIN)
+    def __init__(self, sensor_config, init_hx=None):
+        self._name = sensor_config["name"]
+        self._pins = hx711_pins(sensor_config)
+        self._device = build_driver(sensor_config) if init_hx is None else init_hx
+        # deadlines and sample ages are on the driver's clock, a replayed trace runs on a virtual one
+        self._clock = getattr(self._device, "clock", time)
+        self._recorder = None
+        # a driver reading from the sensor process brings its ring, the sensor process records its frames itself
+        if sensor_config.get("trace_file") and getattr(self._device, "ring", None) is None:
+            self._recorder = hx711_trace.HX711TraceRecorder(self._device, sensor_config["trace_file"])
+
+        # a sensor on channel B keeps its offset and reference unit in the driver's B slots, the driver may be shared
+        # with the sensor on channel A of the same hx711. the gain isn't changed here, every read selects its own
+        self._channel = sensor_config.get("channel", "A")
+        self._run_frames = sensor_config.get("run_frames", CHANNEL_RUN_FRAMES)
+        self._gain = 32 if self._channel == "B" else 128
+        self._get_offset = getattr(self._device, "get_offset_" + self._channel)
+        self._set_offset = getattr(self._device, "set_offset_" + self._channel)
+        self._get_reference_unit = getattr(self._device, "get_reference_unit_" + self._channel)
+        self._set_reference_unit = getattr(self._device, "set_reference_unit_" + self._channel)
+
         self._device.set_reading_format("MSB", "MSB")
-        self._device.set_reference_unit(REFERENCE_UNIT)
-        self._hx_config_save_file_name = "hx711.obj.config"
-        GPIO.setup(LED_PIN, GPIO.OUT) # setup LED pin for reading
+        self._set_reference_unit(REFERENCE_UNIT)
+        self._device.readTimeout = SENSOR_READ_TIMEOUT
+        self._device.frameRetries = SENSOR_FRAME_RETRIES
+        self._hx_config_save_file_name = sensor_config["config_file"]
+        if GPIO is not None:
+            GPIO.setup(LED_PIN, GPIO.OUT) # setup LED pin for reading
         self._tared_value = 0
-        self._calibration_value = 0
+        # (tared value, weight) points of the last calibrations and, with more than one, the curve through them.
+        # without a curve the reference unit alone converts values to weights
+        self._calibration_points = []
+        self._curve = None
+        self._acquisition = None
+        self._acquisition_worker = None
+        self._ready_callback = False
+
+        # concurrent blocking reads of the same kind share one acquisition
+        self._value_flight = SingleFlight(self._read_value)
+        self._tare_flight = SingleFlight(self._read_tare)
 
         if DEBUG:
-            print("sensor_device_init: reference_unit: {} tared_value: {} calibration_value: {} raw_reading: {} ".format(REFERENCE_UNIT, self._tared_value, self._calibration_value, self.get_weight()))
+            print("sensor_device_init: reference_unit: {} tared_value: {} raw_reading: {} ".format(REFERENCE_UNIT, self._tared_value, self.get_weight()))
 
         # check if device object backup exists
         self.restore_from_disk()
@@ -81,30 +166,117 @@ class HX711Device(object):
         self._device.reset()
         return {"reset":"successful"}
 
-    def calibrate(self, known_weight):
-        """ calibration routine to give the scale a unit to use and to scale the value accordingly. Make sure to tare the scale first to get an accurate weight. Place the object of known weight on the scale first before calling. """
-        reading = self.get_weight()
-        self._calibration_value = reading / known_weight
-        self._device.set_reference_unit(self._calibration_value)
+    def calibrate(self, known_weight, progress=None, add_point=False):
+        """ calibration routine to give the scale a unit to use and to scale the value accordingly. Make sure to tare the scale first to get an accurate weight. Place the object of known weight on the scale first before calling. with add_point the points of earlier calibrations are kept and weights are interpolated between all of them. blocks, run it as a job. """
+        if self._streaming():
+            median = SlidingMedian(MEDIAN_VALUE_N)
+            for value in self._next_samples(MEDIAN_VALUE_N, progress):
+                median.push(value)
+            value = median.value - self._get_offset()
+        else:
+            value = self._value_flight()
+
+        points = self.calibration_points if add_point else []
+        self.set_calibration(points + [(value, known_weight)])
         if DEBUG: 
-            print("calibration: known_weight: {} reading: {} reference_unit (reading/known_weight): {} ".format(known_weight, reading, self._calibration_value))
-        return {"reference_unit": self._calibration_value}
+            print("calibration: known_weight: {} value: {} reference_unit: {} points: {}".format(known_weight, value, self._get_reference_unit(), self.calibration_points))
+        return {"reference_unit": self._get_reference_unit(), "points": self.calibration_points}
+
+    def set_calibration(self, points):
+        """ calibrates from (tared value, weight) points: one is a reference unit, several a CalibrationCurve. """
+        if len(points) == 1:
+            ((value, weight),) = points
+            self._curve = None
+            self._set_reference_unit(value / weight)
+        else:
+            curve = CalibrationCurve(points)
+            self._set_reference_unit(curve.reference_unit)
+            self._curve = curve
+
+        self._calibration_points = list(points)
+
+    def clear_calibration_points(self):
+        """ drops the points and the curve, the reference unit of the heaviest point stays. """
+        self._curve = None
+        self._calibration_points = []
+
+    def tare(self, progress=None):
+        """ measures the offset of the empty scale on this sensor's channel. blocks, run it as a job. """
+        if self._streaming():
+            mean = TrimmedMean(TARE_SAMPLES, 0.2)
+            for value in self._next_samples(TARE_SAMPLES, progress):
+                mean.push(value)
+            self._set_offset(mean.value)
+            self._tared_value = mean.value
+        else:
+            self._tared_value = self._tare_flight()
 
-    def tare(self):
-        # measure tare and save the value as offset for current channel
-            # and gain selected. That means channel A and gain 128
-        self._tared_value = self._device.tare()
         if DEBUG:
             print("tare: new offset is {}".format(self._tared_value))
+        return self.tare_value
+
+    def _read_tare(self):
+        tare = self._device.tare_B if self._channel == "B" else self._device.tare_A
+        return self._channel_read(lambda: tare(TARE_SAMPLES, deadline=self._clock.monotonic() + SENSOR_REQUEST_TIMEOUT))
+
+    def _channel_read(self, read=None):
+        """ selects this sensor's gain and calls read, if given, holding the driver's read lock so the sensor on the
+        other channel of a shared hx711 can't select its own in between. """
+        if not self._device.readLock.acquire(timeout=SENSOR_REQUEST_TIMEOUT):
+            raise TimeoutError("sensor {}: the hx711 stayed busy for {}s".format(self._name, SENSOR_REQUEST_TIMEOUT))
+
+        try:
+            # costs a frame, converted at the gain selected before
+            if self._device.get_gain() != self._gain:
+                self._device.set_gain(self._gain)
+            return read() if read is not None else None
+        finally:
+            self._device.readLock.release()
+
+    def _streaming(self):
+        """ whether fresh samples are being clocked into the acquisition ring, or the channel is read in runs. tare and
+        calibration then take theirs from the ring rather than competing with the acquisition for the hx711. """
+        if self._acquisition is None:
+            return False
+
+        return self._acquisition.run_gap is not None or self._fresh()
+
+    def _fresh(self):
+        """ whether the newest sample in the acquisition ring is younger than the max age of this channel. """
+        last = self._acquisition.ring.last()
+        return last is not None and self._clock.time() - last[0] <= self._max_age()
+
+    def _max_age(self):
+        # a channel read in runs goes without samples while the other channel's runs are read
+        run_gap = self._acquisition.run_gap if self._acquisition is not None else None
+        return SAMPLE_MAX_AGE if run_gap is None else max(SAMPLE_MAX_AGE, run_gap)
+
+    def _next_samples(self, n, progress=None):
+        """ the next n raw samples clocked into the acquisition ring, progress is called with the count collected. """
+        ring = self._acquisition.ring
+        deadline = self._clock.monotonic() + SENSOR_REQUEST_TIMEOUT
+        seen = ring.count
+        values = []
+        while True:
+            (samples, seen) = ring.samples_since(seen)
+            values.extend(value for (_, value) in samples)
+            if samples and progress is not None:
+                progress(min(len(values), n))
+            if len(values) >= n:
+                return values[:n]
+
+            if self._clock.monotonic() >= deadline:
+                raise TimeoutError("sensor {}: {} of {} samples arrived within {}s".format(self._name, len(values), n, SENSOR_REQUEST_TIMEOUT))
+            self._clock.sleep(JOB_POLL_INTERVAL)
     
     def save_to_disk(self):
         # This is how you can save the ratio and offset in order to load it later.
         # If Raspberry Pi unexpectedly powers down, load the settings.
         if DEBUG:
-            print('disk: saving ... ({}, {}, {}) to disk as {}'.format(self._device.get_gain(), self._device.get_offset(), self._device.get_reference_unit(), self._hx_config_save_file_name))
+            print('disk: saving ... ({}, {}, {}) to disk as {}'.format(self._gain, self._get_offset(), self._get_reference_unit(), self._hx_config_save_file_name))
         
         with open(self._hx_config_save_file_name, 'wb') as file:
-            device_config = (self._device.get_gain(), self._device.get_offset(), self._device.get_reference_unit())
+            device_config = (self._gain, self._get_offset(), self._get_reference_unit(), self.calibration_points)
             pickle.dump(device_config, file)
             file.flush()
             os.fsync(file.fileno())
@@ -115,19 +287,169 @@ class HX711Device(object):
         """ restores gain, offset, and reference unit from disk. used for tare."""
         if os.path.isfile(self._hx_config_save_file_name):
             with open(self._hx_config_save_file_name, 'rb') as swap_file:
-                (_gain, _offset, _reference_unit) = pickle.load(swap_file) # load the device from disk if it does
-                self._device.set_gain(_gain)
-                self._device.set_offset(_offset)
-                self._device.set_reference_unit(_reference_unit)
+                device_config = pickle.load(swap_file) # load the device from disk if it does
+                # files saved before multi-point calibration hold no points
+                (_gain, _offset, _reference_unit) = device_config[:3]
+                _points = device_config[3] if len(device_config) > 3 else []
+                # channel B is always read at gain 32
+                if self._channel == "A":
+                    self._gain = _gain
+                    self._device.set_gain(_gain)
+                self._set_offset(_offset)
+                self._set_reference_unit(_reference_unit)
+                self._curve = CalibrationCurve(_points) if len(_points) > 1 else None
+                self._calibration_points = list(_points)
                 if DEBUG:
-                    print('disk: restoring disk from {} ... ({}, {}, {})'.format(self._hx_config_save_file_name, self._device.get_gain(), self._device.get_offset(), self._device.get_reference_unit()))
+                    print('disk: restoring disk from {} ... ({}, {}, {})'.format(self._hx_config_save_file_name, self._gain, self._get_offset(), self._get_reference_unit()))
 
         else:
             self.save_to_disk()
 
+    def acquisition_channel(self):
+        """ the ring buffer and filters samples are clocked into. once it exists get_weight is computed from the
+        buffer instead of taking fresh blocking reads. a driver reading from the sensor process brings its ring. """
+        if self._acquisition is None:
+            estimator = ConstantVelocityKalman(ESTIMATOR_PROCESS_NOISE, ESTIMATOR_MEASUREMENT_NOISE) if ESTIMATOR_ENABLED else None
+            ring = getattr(self._device, "ring", None)
+            self._acquisition = AcquisitionChannel(self._device, ring if ring is not None else SampleRing(SAMPLE_RING_SIZE),
+                value_filter=SlidingMedian(MEDIAN_VALUE_N), gate=MadGate(MEDIAN_VALUE_N, OUTLIER_GATE_THRESHOLD),
+                estimator=estimator, metrics=metrics.SensorMetrics(self._name))
+
+        return self._acquisition
+
+    def start_acquisition(self):
+        """ starts a thread clocking samples into the acquisition channel of this device only. several devices are
+        driven by one AcquisitionScheduler instead. in interrupt mode the driver's ready callback reads every frame
+        and no thread is needed. """
+        if self._acquisition_worker is not None or self._ready_callback:
+            return
+
+        if ACQUISITION_MODE == "interrupt":
+            if self._channel != "A":
+                raise RuntimeError("sensor {}: interrupt acquisition only reads channel A".format(self._name))
+            self.acquisition_channel()
+            self._channel_read()
+            self._device.enableReadyCallback(self._on_frame)
+            self._ready_callback = True
+            return
+
+        self._channel_read()
+        self._acquisition_worker = AcquisitionWorker(self.acquisition_channel())
+        self._acquisition_worker.start()
+
+    def _on_frame(self, raw_bytes):
+        # runs on the gpio callback thread for every falling edge of DOUT, None when the frame was lost
+        if raw_bytes is not None:
+            self._acquisition.receive(self._device.rawBytesToLong(raw_bytes))
+
+    def stop_acquisition(self):
+        if self._ready_callback:
+            self._device.disableReadyCallback()
+            self._ready_callback = False
+
+        if self._acquisition_worker is None:
+            return
+
+        self._acquisition_worker.stop()
+        self._acquisition_worker = None
+
+    def get_estimate(self):
+        """ weight and flow (weight units per second drawn, positive while gas is used) with their standard deviations
+        from the state estimator, or None if it is disabled, not settled yet or its samples are stale. """
+        estimate = self._acquisition.estimate if self._acquisition is not None else None
+        if estimate is None:
+            return None
+
+        (value, rate, value_std, rate_std, timestamp) = estimate
+        if self._clock.time() - timestamp > self._max_age():
+            return None
+
+        value = value - self._get_offset()
+        # weight per count where the scale is, constant without a curve
+        slope = self._curve.slope(value) if self._curve is not None else 1 / self._get_reference_unit()
+        return {
+            "weight": self.to_weight(value),
+            "weight_std": value_std * abs(slope),
+            "flow": -rate * slope,
+            "flow_std": rate_std * abs(slope),
+        }
+
     def get_weight(self):
-        return self._device.get_weight(MEDIAN_VALUE_N)
+        estimate = self.get_estimate()
+        if estimate is not None:
+            return estimate["weight"]
+
+        if self._acquisition is not None:
+            if self._acquisition.run_gap is not None and not self._fresh():
+                # the hx711 is the run scheduler's, wait for this channel's next run instead of reading it
+                self._next_samples(1)
+
+            median = self._acquisition.filtered_value
+            if median is not None and self._fresh():
+                return self.to_weight(median - self._get_offset())
+            if self._acquisition.run_gap is not None:
+                return self.to_weight(self._acquisition.ring.last()[1] - self._get_offset())
+
+        # no fresh samples buffered (acquisition not running, still filling or stalled) so read the hx711 directly
+        return self.to_weight(self._value_flight())
+
+    def to_weight(self, value):
+        """ weight of a tared value (raw counts minus the offset). """
+        if self._curve is not None:
+            return self._curve.weight(value)
+        return value / self._get_reference_unit()
+
+    def _read_value(self):
+        # the median of MEDIAN_VALUE_N reads minus the offset, the drivers only scale it by the reference unit
+        get_weight = self._device.get_weight_B if self._channel == "B" else self._device.get_weight_A
+        return self._channel_read(lambda: get_weight(MEDIAN_VALUE_N, deadline=self._clock.monotonic() + SENSOR_REQUEST_TIMEOUT)) * self._get_reference_unit()
+
+    @property
+    def read_stats(self):
+        """ blocking hx711 acquisitions issued versus callers that attached to one already running. """
+        return {"weight": self._value_flight.stats, "tare": self._tare_flight.stats}
+
+    @property
+    def dropped_frames(self):
+        """ frames the ready callback lost because a blocking read held the driver, 0 outside interrupt mode. """
+        return getattr(self._device, "droppedFrameCount", 0)
+
+    @property
+    def ring(self):
+        return self._acquisition.ring if self._acquisition is not None else None
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def pins(self):
+        """ the hx711 read, shared with the sensor on its other channel (see hx711_pins). """
+        return self._pins
+
+    @property
+    def gain(self):
+        return self._gain
+
+    @property
+    def run_frames(self):
+        return self._run_frames
+
+    @property
+    def frame_errors(self):
+        """ frames the driver's integrity checks threw away per check, and reads that gave up ("failures"). with the
+        sensor process they are its driver's counts. """
+        ring = getattr(self._device, "ring", None)
+        if ring is not None:
+            return ring.frame_errors
+
+        return dict(getattr(self._device, "frameErrorCounts", {}), failures=getattr(self._device, "frameFailureCount", 0))
     
+    def close(self):
+        """ flushes and closes the frame trace, if one is recorded. """
+        if self._recorder is not None:
+            self._recorder.close()
+
     def __enter__(self):
         return self._device
     
@@ -139,113 +461,447 @@ class HX711Device(object):
     def tare_value(self):
         return {"tared-weight": self._tared_value}
 
+    @property
+    def calibration_value(self):
+        return self._get_reference_unit()
+
+    @property
+    def calibration_points(self):
+        """ (tared value, weight) points of the multi-point calibration, empty without one. """
+        return list(self._calibration_points)
+
 class SensorWorker(threading.Thread):
-    def __init__(self, db, *args, **kwargs):
-        threading.Thread.__init__(self)
-        # self._db = db
-        # self._db.start()
-        self._hx_device = HX711Device()
+    def __init__(self, sensor_config, db, db_reader, broadcaster=None, init_hx=None, *args, **kwargs):
+        # the thread is named after the sensor, sensors are looked up by that name
+        threading.Thread.__init__(self, name=sensor_config["name"], daemon=True)
+        self._db = db
+        self._db_reader = db_reader
+        self._broadcaster = broadcaster
+        self._hx_device = HX711Device(sensor_config, init_hx)
+        # (created date in ns, weight) of the most recent reading and the estimator state it was taken from
+        self._latest = None
+        self._estimate = None
+        # read() runs on this thread and, for fresh readings, on the api's threadpool. the analytics, the segmenter and
+        # the broadcaster aren't thread safe and need readings in time order
+        self._publish_lock = threading.Lock()
+        self._analytics = ConsumptionAnalytics(ANALYTICS_WINDOWS, sensor_config.get("empty_weight", ANALYTICS_EMPTY_WEIGHT),
+            ANALYTICS_REFILL_THRESHOLD, ANALYTICS_BUCKETS, ANALYTICS_CACHE_TTL)
+        self._segmenter = SessionSegmenter(SESSION_DRIFT, SESSION_START_THRESHOLD, SESSION_END_THRESHOLD)
+        self._polling_rate = None
+        if SENSOR_POLLING_ADAPTIVE:
+            self._polling_rate = AdaptivePollingRate(SENSOR_POLLING_MIN, SENSOR_POLLING_MAX, SENSOR_POLLING_SLOPE_THRESHOLD,
+                SENSOR_POLLING_STDDEV_THRESHOLD, SENSOR_POLLING_HYSTERESIS, SENSOR_POLLING_BACKOFF, SENSOR_POLLING_WINDOW)
     
     def run(self,*args,**kwargs):
+        # with continuous acquisition a reading is just a look at the filtered ring buffer, so the weight is checked
+        # every SENSOR_POLLING_MIN seconds and only the logging backs off. without it every reading clocks the hx711,
+        # so the readings themselves back off.
+        cheap_reads = ACQUISITION_MODE in ("continuous", "process", "interrupt")
+        interval = SENSOR_POLLING_RATE if self._polling_rate is None else self._polling_rate.interval
+        last_logged = None
+        self.warm_up_analytics()
+
         while True:
-            time.sleep(SENSOR_POLLING_RATE)
-            data = self._hx_device.get_weight()
-            # self._db.enqueue("INSERT INTO Weights VALUES (NULL, ?, ?)", (time.time_ns(), data, ))
+            time.sleep(SENSOR_POLLING_MIN if cheap_reads and self._polling_rate is not None else interval)
+            try:
+                (created_date, data) = self.read()
+            except OSError as e:
+                # read timeouts and frames that kept failing the integrity checks
+                if DEBUG:
+                    print("sensor_poll[{}](@{}): {}".format(self.name, interval, e))
+                continue
+
+            if self._polling_rate is not None:
+                was_active = self._polling_rate.active
+                # due against the interval in effect since the last log, update() may have just grown it
+                logged_interval = interval
+                interval = self._polling_rate.update(created_date, data)
+                # log right away when the weight starts moving instead of waiting out the backed off interval
+                due = last_logged is None or created_date - last_logged >= logged_interval * 1000000000 or self._polling_rate.active != was_active
+                if not due:
+                    continue
+
+            last_logged = created_date
+            self._db.insert_weight(created_date, data)
             if DEBUG:
-                print("sensor_poll(@{}): {}".format(SENSOR_POLLING_RATE, data))
+                print("sensor_poll[{}](@{}): {}".format(self.name, interval, data))
+
+    def read(self):
+        """ takes a new filtered reading and makes it the latest one. blocks, keep it off the event loop. """
+        estimate = self._hx_device.get_estimate()
+        data = estimate["weight"] if estimate is not None else self._hx_device.get_weight()
+
+        # stamped under the lock, so readings are published in the order of their timestamps
+        with self._publish_lock:
+            latest = (time.time_ns(), data)
+            if self._latest is not None and latest[0] <= self._latest[0]:
+                # the wall clock stepped back, keep the timestamps increasing
+                latest = (self._latest[0] + 1, data)
+            self._estimate = estimate
+            self._latest = latest
+
+            self._analytics.push(*latest)
+            session = self._segmenter.push(*latest)
+            if session is not None:
+                self._db.insert_session(*session)
+                if DEBUG:
+                    print("session[{}]: {}".format(self.name, session))
+
+            if self._broadcaster is not None:
+                self._broadcaster.publish(*latest, **self.estimate_fields)
+
+        return latest
+
+    def warm_up_analytics(self):
+        """ seeds the consumption windows with the minute rollups of the longest window, so forecasts survive a
+        restart. runs once, from then on the analytics only see new readings. """
+        now = time.time_ns()
+        span = max(ANALYTICS_WINDOWS.values())
+        try:
+            points = self._db_reader.aggregate(now - span * 1000000000, now, 60 * 1000000000)
+        except Exception as e:
+            # nothing logged yet, the db file doesn't exist
+            if DEBUG:
+                print("analytics[{}]: no history to warm up from: {}".format(self.name, e))
+            return
+
+        for point in points:
+            self._analytics.push(point["time"], point["mean"])
+
+    @property
+    def latest(self):
+        return self._latest
+
+    @property
+    def estimate_fields(self):
+        """ uncertainty and flow of the latest reading, empty when it didn't come from the estimator. """
+        if self._estimate is None:
+            return {}
+        return {"weight_std": self._estimate["weight_std"], "flow": self._estimate["flow"], "flow_std": self._estimate["flow_std"]}
 
     @property
     def hx_device(self):
         return self._hx_device
-    
-app = FastAPI()
-db = DBWorker()
-sensor = SensorWorker(db)
 
-@app.get("/")
-async def get_data():
+    @property
+    def analytics(self):
+        return self._analytics
+
+    @property
+    def current_session(self):
+        return self._segmenter.current
+
+    @property
+    def polling_state(self):
+        return self._polling_rate.state if self._polling_rate is not None else {"interval": SENSOR_POLLING_RATE, "active": None}
+
+    @property
+    def db(self):
+        return self._db
+
+    @property
+    def db_reader(self):
+        return self._db_reader
+
+    @property
+    def broadcaster(self):
+        return self._broadcaster
+
+def build_sensor(sensor_config):
+    db = DBWorker(sensor_config["name"], metrics.StorageMetrics(sensor_config["name"]))
+    init_hx = sensor_process.driver(sensor_config["name"]) if sensor_process is not None else drivers[sensor_config["name"]]
+    return SensorWorker(sensor_config, db, ReadPool(db.path, DB_READ_POOL_SIZE), Broadcaster(), init_hx)
+
+def start_acquisition():
+    """ one sensor gets its own acquisition thread, several share a scheduler that interleaves their frames and the two
+    channels of one hx711 are read in runs (see start_acquisition_threads). with the sensor process clocking the
+    frames a follower thread feeds the filters from its rings. """
+    if ACQUISITION_MODE == "interrupt":
+        for sensor in sensors.values():
+            sensor.hx_device.start_acquisition()
+        return None
+
+    if ACQUISITION_MODE == "process":
+        follower = RingFollower([sensor.hx_device.acquisition_channel() for sensor in sensors.values()], ACQUISITION_IDLE_SLEEP)
+        follower.start()
+        return follower
+
+    if ACQUISITION_MODE != "continuous":
+        return None
+
+    if len(sensors) == 1:
+        default_sensor.hx_device.start_acquisition()
+        return None
+
+    return start_acquisition_threads([(sensor.hx_device.acquisition_channel(), sensor.hx_device.gain, sensor.hx_device.run_frames)
+        for sensor in sensors.values()], ACQUISITION_IDLE_SLEEP, CHANNEL_SETTLE_FRAMES)
+
+app = FastAPI()
+router = APIRouter()
+
+# forked before this process starts any thread
+sensor_process = None
+if ACQUISITION_MODE == "process":
+    sensor_process = SensorProcess(SENSORS, SAMPLE_RING_SIZE, build_driver, SENSOR_READ_TIMEOUT, ACQUISITION_IDLE_SLEEP)
+    sensor_process.start()
+
+# tare and calibration run in the background, one queue per hx711
+jobs = JobRegistry(JOB_HISTORY)
+
+# sensors on the same pins share the driver of their hx711, with the sensor process every sensor reads its own ring
+drivers = shared_drivers(SENSORS, build_driver) if sensor_process is None else {}
+sensors = {sensor_config["name"]: build_sensor(sensor_config) for sensor_config in SENSORS}
+default_sensor = sensors[SENSORS[0]["name"]]
+
+metrics.REGISTRY.register(metrics.GaugeCallback("db_queue_depth", "Statements waiting in the db queue.", ("series",),
+    lambda: {(name,): sensor.db.queue_depth for (name, sensor) in sensors.items()}))
+metrics.REGISTRY.register(metrics.CounterCallback("hx711_frame_errors_total", "Frames thrown away by the integrity checks.", ("sensor", "check"),
+    lambda: {(name, check): count for (name, sensor) in sensors.items() for (check, count) in sensor.hx_device.frame_errors.items() if check != "failures"}))
+metrics.REGISTRY.register(metrics.CounterCallback("hx711_frame_failures_total", "Reads that gave up after too many bad frames.", ("sensor",),
+    lambda: {(name,): sensor.hx_device.frame_errors["failures"] for (name, sensor) in sensors.items()}))
+metrics.REGISTRY.register(metrics.CounterCallback("hx711_dropped_frames_total", "Frames the ready callback lost to a blocking read.", ("sensor",),
+    lambda: {(name,): sensor.hx_device.dropped_frames for (name, sensor) in sensors.items()}))
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # labelled with the route template, not the raw path, so unknown urls can't grow the label set
+    route = request.scope.get("route")
+    metrics.REQUEST_LATENCY.labels(request.method, route.path if route is not None else "unmatched", response.status_code).observe(time.perf_counter() - start)
+    return response
+
+def get_sensor(sensor: str | None = None):
+    # the same routes are served at / for the default sensor (or ?sensor=name) and at /sensors/{sensor}/
+    if sensor is None:
+        return default_sensor
+
+    if sensor not in sensors:
+        raise HTTPException(status_code=404, detail="unknown sensor: {}".format(sensor))
+
+    return sensors[sensor]
+
+@app.on_event("startup")
+async def startup():
+    # samples are published from the sensor threads and fanned out on this loop
+    for sensor in sensors.values():
+        sensor.broadcaster.bind(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def shutdown():
+    # flush and commit whatever is still queued before the process exits
+    jobs.stop()
+    for sensor in sensors.values():
+        sensor.db.stop()
+        sensor.db.join()
+        sensor.db_reader.close()
+        sensor.hx_device.close()
+
+    if sensor_process is not None:
+        sensor_process.stop()
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/sensors")
+async def get_sensors():
+    return {"sensors": list(sensors.keys()), "default": default_sensor.name}
+
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="unknown job: {}".format(job_id))
+
+    return job
+
+@app.get("/jobs")
+async def get_jobs():
+    return {"jobs": [job.as_dict() for job in jobs.jobs()]}
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job = Depends(get_job)):
+    return job.as_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job = Depends(get_job)):
+    if not job.done:
+        raise HTTPException(status_code=409, detail="job {} is {}".format(job.id, job.status))
+
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+
+    return job.result
+
+@router.get("/")
+async def get_data(max_age: float | None = None, fresh: bool = False, sensor: SensorWorker = Depends(get_sensor)):
+    # serves the latest reading taken by the sensor worker. only reads the sensor when asked for a fresh reading, when
+    # the latest one is older than max_age seconds or when there is none yet, and then off the event loop.
     try:
-        reading = sensor.hx_device.get_weight()
-        return {"weight": reading}
+        latest = sensor.latest
+        if fresh or latest is None or (max_age is not None and time.time_ns() - latest[0] > max_age * 1000000000):
+            latest = await run_in_threadpool(sensor.read)
+
+        (created_date, reading) = latest
+        return dict({"weight": reading, "timestamp": created_date, "age": (time.time_ns() - created_date) / 1000000000}, **sensor.estimate_fields)
     
     except Exception as e:
         return {"Exception": e}
 
+@router.get("/stream")
+async def get_stream(request: Request, rate: float | None = None, decimation: int = 1, delta: float = 0, sensor: SensorWorker = Depends(get_sensor)):
+    # server-sent events with every new reading. rate caps messages per second, decimation only forwards every n-th
+    # reading and delta skips readings that moved less than that since the last one sent.
+    broadcaster = sensor.broadcaster
+
+    async def events():
+        # subscribed once the response starts streaming, a client gone before that never subscribes
+        subscription = broadcaster.subscribe(1 / rate if rate else 0, decimation, delta)
+        try:
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(subscription.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle stream
+                    yield b": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@router.get("/analytics")
+async def get_analytics(sensor: SensorWorker = Depends(get_sensor)):
+    # consumption rates per window and the time left until the cylinder is empty. maintained as readings arrive, this
+    # never touches the db.
+    return sensor.analytics.snapshot()
+
 class Filter(BaseModel):
     timestart : datetime
     timeend: datetime
 
+class Aggregate(BaseModel):
+    timestart : datetime
+    timeend: datetime
+    # number of points wanted over the range, or an explicit bucket width in seconds
+    points: int = 300
+    resolution: float | None = None
+
 class Calibrate(BaseModel):
     known_weight : float
+    # keep the points of earlier calibrations and interpolate between all of them
+    add_point: bool = False
 
-@app.post("/")
-async def get_data_range(filter: Filter):
-    return {"weights": "this function is not implemented"}
-    data = None
+@router.post("/")
+def get_data_range(filter: Filter, sensor: SensorWorker = Depends(get_sensor)):
+    # plain def: fastapi runs it on its threadpool so the sqlite read doesn't block the event loop
+    try:
+        # CreatedDate is stored in ns since the epoch
+        time_start = calendar.timegm(filter.timestart.utctimetuple()) * 1000000000
+        time_end = calendar.timegm(filter.timeend.utctimetuple()) * 1000000000
+
+        return {"weights": sensor.db_reader.weights(time_start, time_end)}
 
-    def set_data(_data):
-        data = _data
+    except Exception as e:
+        return {"weights": "error", "Exception": e}
 
-    time_start = calendar.timegm(filter.timestart.utctimetuple())
-    time_end = calendar.timegm(filter.timeend.utctimetuple())
+@router.post("/sessions")
+def get_sessions(filter: Filter, sensor: SensorWorker = Depends(get_sensor)):
+    # weld sessions overlapping the range plus the one in progress, if any
+    try:
+        time_start = calendar.timegm(filter.timestart.utctimetuple()) * 1000000000
+        time_end = calendar.timegm(filter.timeend.utctimetuple()) * 1000000000
 
-    # db.enqueue("SELECT * FROM Weights WHERE CreatedDate >= {} AND CreatedData <= {}".format(time_start, time_end), None, set_data)
+        return {"sessions": sensor.db_reader.sessions(time_start, time_end), "current": sensor.current_session}
 
-    return {"weights": data}    
+    except Exception as e:
+        return {"sessions": "error", "Exception": e}
 
-@app.get("/tare")
-async def get_tare():
+@router.post("/aggregate")
+def get_data_aggregate(aggregate: Aggregate, sensor: SensorWorker = Depends(get_sensor)):
+    # time bucketed min/max/mean/first/last/count, served from the minute/hour/day rollups
     try:
-        return sensor.hx_device.tare_value
+        time_start = calendar.timegm(aggregate.timestart.utctimetuple()) * 1000000000
+        time_end = calendar.timegm(aggregate.timeend.utctimetuple()) * 1000000000
+
+        if aggregate.resolution is not None:
+            resolution = int(aggregate.resolution * 1000000000)
+        else:
+            resolution = (time_end - time_start) // max(1, aggregate.points)
+
+        return {"weights": sensor.db_reader.aggregate(time_start, time_end, resolution)}
+
     except Exception as e:
-        return {"Exception": e}
-    
-@app.put("/tare")
-async def put_tare():
+        return {"weights": "error", "Exception": e}
+
+@router.get("/tare")
+async def get_tare(sensor: SensorWorker = Depends(get_sensor)):
     try:
-        sensor.hx_device.tare()
         return sensor.hx_device.tare_value
     except Exception as e:
         return {"Exception": e}
     
-@app.get("/save")
-async def put_save():
+@router.put("/tare", status_code=202)
+async def put_tare(sensor: SensorWorker = Depends(get_sensor)):
+    # answers right away, the tare runs as a job: poll /jobs/{id} for its progress and /jobs/{id}/result for the offset
+    job = jobs.submit("tare", sensor.name, sensor.hx_device.pins, TARE_SAMPLES, sensor.hx_device.tare)
+    return job.as_dict()
+    
+@router.get("/save")
+async def put_save(sensor: SensorWorker = Depends(get_sensor)):
     try:
         sensor.hx_device.save_to_disk()
         return {"save_to_disk": "successful"}
     except Exception as e:
         return {"save_to_disk": "error", "Exception": e}
     
-@app.get("/restore")
-async def get_restore():
+@router.get("/restore")
+async def get_restore(sensor: SensorWorker = Depends(get_sensor)):
     try:
         sensor.hx_device.restore_from_disk()
         return {"restore_from_disk": "successful"}
     except Exception as e:
         return {"restore_from_disk": "error", "Exception": e}
     
-@app.get("/calibrate")
-async def get_calibrate():
+@router.get("/calibrate")
+async def get_calibrate(sensor: SensorWorker = Depends(get_sensor)):
     try:
-        return {"calibrate" :sensor.hx_device.calibration_value}
+        return {"calibrate" :sensor.hx_device.calibration_value, "points": sensor.hx_device.calibration_points}
     except Exception as e:
         return {"calibrate": "error", "Exception": e}
     
-@app.put("/calibrate")
-async def get_calibrate(cal:Calibrate):
-    try:
-        sensor.hx_device.calibrate(cal.known_weight)
-        return {"calibrate" :sensor.hx_device.calibration_value}
-    except Exception as e:
-        return {"calibrate": "error", "Exception": e}
+@router.put("/calibrate", status_code=202)
+async def put_calibrate(cal:Calibrate, sensor: SensorWorker = Depends(get_sensor)):
+    # a job like PUT /tare, its result is the new reference unit
+    job = jobs.submit("calibrate", sensor.name, sensor.hx_device.pins, MEDIAN_VALUE_N, lambda progress: sensor.hx_device.calibrate(cal.known_weight, progress, cal.add_point))
+    return job.as_dict()
+
+@router.delete("/calibrate/points")
+async def delete_calibration_points(sensor: SensorWorker = Depends(get_sensor)):
+    sensor.hx_device.clear_calibration_points()
+    return {"calibrate" :sensor.hx_device.calibration_value, "points": sensor.hx_device.calibration_points}
     
-@app.get("/reset")
-async def get_reset():
+@router.get("/reads")
+async def get_reads(sensor: SensorWorker = Depends(get_sensor)):
+    return dict(sensor.hx_device.read_stats, polling=sensor.polling_state, frames=sensor.hx_device.frame_errors,
+        dropped=sensor.hx_device.dropped_frames)
+
+@router.get("/reset")
+async def get_reset(sensor: SensorWorker = Depends(get_sensor)):
     try:
         return sensor.hx_device.reset()
     except Exception as e:
         return {"reset": "error", "Exception": e}
 
+app.include_router(router)
+app.include_router(router, prefix="/sensors/{sensor}")
+
 if __name__ == "__main__":
-    sensor.start()
+    for sensor in sensors.values():
+        sensor.db.start()
+
+    start_acquisition()
+
+    for sensor in sensors.values():
+        sensor.start()
+
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,106 @@
+""" multi-point calibration: weight as a piecewise-linear function of the tared hx711 value (raw counts minus the offset)
+through the known weights the sensor was calibrated with.
+
+a load cell is not linear over a full cylinder's range, a single reference unit is only exact at the weight it was
+taken at. the curve is compiled into a lookup table so converting a value costs the same as that division did, however
+many points there are. """
+import math
+import bisect
+from array import array
+
+# upper bound of lookup cells per curve, reached only by two points much closer together than the others
+MAX_CELLS = 4096
+
+class CalibrationCurve(object):
+    """ interpolates linearly between the calibration points (value, weight) and extends the end segments beyond them.
+    the tared, empty scale reads 0, so the origin is a point unless one of the given points is at weight 0. weight has
+    to move the same way with the value across all points.
+
+    the range between the first and last point is cut into equal cells, at most half as wide as the narrowest segment,
+    and every cell holds the segment it starts in. the segment of a value is its cell's or the next one: converting is a
+    multiply, a truncation, a comparison and a multiply-add. the tables are flat arrays, a batch is converted in one
+    pass by weights(). """
+    def __init__(self, points):
+        self._points = [(float(value), float(weight)) for (value, weight) in points]
+        knots = sorted(self._points)
+        if not any(weight == 0 for (_, weight) in knots):
+            bisect.insort(knots, (0.0, 0.0))
+
+        if len(knots) < 2:
+            raise ValueError("CalibrationCurve(): needs a point besides the origin!")
+
+        slopes = []
+        intercepts = []
+        for ((v0, w0), (v1, w1)) in zip(knots, knots[1:]):
+            if v1 == v0:
+                raise ValueError("CalibrationCurve(): two points read the same value {}!".format(v0))
+            slope = (w1 - w0) / (v1 - v0)
+            slopes.append(slope)
+            intercepts.append(w0 - slope * v0)
+
+        if not (all(slope > 0 for slope in slopes) or all(slope < 0 for slope in slopes)):
+            raise ValueError("CalibrationCurve(): weight doesn't move the same way with the value across all points!")
+
+        values = [value for (value, _) in knots]
+        self._knots = array('d', values)
+        self._slopes = array('d', slopes)
+        self._intercepts = array('d', intercepts)
+        self._last = len(slopes) - 1
+
+        self._low = values[0]
+        narrowest = min(v1 - v0 for (v0, v1) in zip(values, values[1:]))
+        self._cells = min(MAX_CELLS, int(math.ceil(2 * (values[-1] - self._low) / narrowest)))
+        self._scale = self._cells / (values[-1] - self._low)
+        self._cell_segments = array('l', [min(self._last, bisect.bisect_right(values, self._low + cell / self._scale) - 1)
+            for cell in range(self._cells)])
+
+    def _segment(self, value):
+        cell = int((value - self._low) * self._scale)
+        if cell < 0:
+            return 0
+        if cell >= self._cells:
+            return self._last
+
+        segment = self._cell_segments[cell]
+        # more than one step only for cells capped by MAX_CELLS
+        while segment < self._last and value >= self._knots[segment + 1]:
+            segment += 1
+        return segment
+
+    def weight(self, value):
+        segment = self._segment(value)
+        return self._intercepts[segment] + self._slopes[segment] * value
+
+    def slope(self, value):
+        """ weight per count at value, converts rates and standard deviations in counts. """
+        return self._slopes[self._segment(value)]
+
+    def weights(self, values):
+        """ weight of every value of a batch. """
+        (low, scale, cells, last) = (self._low, self._scale, self._cells, self._last)
+        (knots, slopes, intercepts, cell_segments) = (self._knots, self._slopes, self._intercepts, self._cell_segments)
+        weights = array('d', bytes(8 * len(values)))
+        for (i, value) in enumerate(values):
+            cell = int((value - low) * scale)
+            if cell < 0:
+                segment = 0
+            elif cell >= cells:
+                segment = last
+            else:
+                segment = cell_segments[cell]
+                while segment < last and value >= knots[segment + 1]:
+                    segment += 1
+            weights[i] = intercepts[segment] + slopes[segment] * value
+        return weights
+
+    @property
+    def points(self):
+        """ the calibration points as given, without the implied origin. """
+        return list(self._points)
+
+    @property
+    def reference_unit(self):
+        """ counts per weight unit of the line from the origin to the heaviest point, for code that only knows a single
+        reference unit. """
+        (value, weight) = max(self._points, key=lambda point: abs(point[1]))
+        return value / weight
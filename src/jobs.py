@@ -0,0 +1,135 @@
+""" tare and calibration as background jobs. a request only queues the job and answers with its id, the job's status,
+progress and result are looked up by that id. the jobs of one hx711 run one after the other on a thread of that hx711,
+so a tare and a calibration never read it at once, not even for the two sensors on its channels, and the jobs of
+different hx711s run side by side. """
+import time
+import uuid
+import queue
+import threading
+import collections
+
+# queued to tell a runner to exit
+_STOP = object()
+
+class Job(object):
+    """ one tare or calibration. status goes from "queued" to "running" to "done" (result set) or "failed" (error set).
+    fn is called with a progress callback taking the number of samples collected so far, out of `samples`. """
+    def __init__(self, kind, sensor, samples, fn):
+        self._id = uuid.uuid4().hex
+        self._kind = kind
+        self._sensor = sensor
+        self._samples = samples
+        self._fn = fn
+        self._collected = 0
+        self._status = "queued"
+        self._result = None
+        self._error = None
+        self._created = time.time()
+        self._started = None
+        self._finished = None
+
+    def _progress(self, collected):
+        self._collected = collected
+
+    def run(self):
+        self._started = time.time()
+        self._status = "running"
+        try:
+            self._result = self._fn(self._progress)
+            self._collected = self._samples
+            self._status = "done"
+        except Exception as e:
+            self._error = "{}: {}".format(type(e).__name__, e)
+            self._status = "failed"
+        finally:
+            self._finished = time.time()
+
+    def as_dict(self):
+        return {"id": self._id, "kind": self._kind, "sensor": self._sensor, "status": self._status,
+            "progress": {"collected": self._collected, "samples": self._samples},
+            "result": self._result, "error": self._error,
+            "created": self._created, "started": self._started, "finished": self._finished}
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def done(self):
+        return self._status in ("done", "failed")
+
+    @property
+    def result(self):
+        return self._result
+
+    @property
+    def error(self):
+        return self._error
+
+
+class JobRunner(threading.Thread):
+    """ runs the queued jobs of one hx711, identified by its pins, in order. """
+    def __init__(self, pins):
+        threading.Thread.__init__(self, name="jobs-{}".format("-".join(str(pin) for pin in pins)), daemon=True)
+        self._queue = queue.Queue()
+
+    def put(self, job):
+        self._queue.put(job)
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            job.run()
+
+    def stop(self):
+        self._queue.put(_STOP)
+
+
+class JobRegistry(object):
+    """ submits jobs to the runner of the hx711 they read (started with its first job) and keeps them by id. queued and
+    running jobs are always kept, of the finished ones only the `history` most recent. """
+    def __init__(self, history=100):
+        self._history = history
+        self._jobs = collections.OrderedDict()
+        self._runners = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, sensor, pins, samples, fn):
+        """ queues a job of sensor, which reads the hx711 on pins (see hx711_pins in src/acquisition.py). """
+        job = Job(kind, sensor, samples, fn)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._expire()
+            runner = self._runners.get(pins)
+            if runner is None:
+                runner = self._runners[pins] = JobRunner(pins)
+                runner.start()
+
+        runner.put(job)
+        return job
+
+    def _expire(self):
+        finished = [job_id for (job_id, job) in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self._history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        """ the jobs kept, oldest first. """
+        with self._lock:
+            return list(self._jobs.values())
+
+    def stop(self):
+        """ lets every runner finish the jobs already queued and exit. """
+        with self._lock:
+            runners = list(self._runners.values())
+        for runner in runners:
+            runner.stop()
@@ -0,0 +1,198 @@
+""" counters and histograms of the acquisition and storage pipeline, exposed in the prometheus text format on /metrics.
+
+kept dependency free and cheap enough to stay on: recording a value is a bisect over the bucket bounds and two
+additions, there are no locks. a concurrent increment can rarely be lost, which metrics can live with. """
+import bisect
+
+# seconds, from a few microseconds (a clock-out on a fast pi) to a blocking read that times out
+DURATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    escaped = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for (name, value) in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _HistogramChild(object):
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one count per bucket plus +Inf, not cumulative, summed up when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        """ the child for these label values, bind it once and record on it. """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for (values, child) in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values), _format_value(child.value))]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets + (float("inf"),), list(child.counts)):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, values, ("le", _format_value(bound))), cumulative))
+        labels = _format_labels(self.labelnames, values)
+        lines.append("{}_sum{} {}".format(self.name, labels, _format_value(child.sum)))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class GaugeCallback(_Metric):
+    """ a gauge read when the metrics are rendered, fn returns {label values tuple: value}. """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, fn):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self._fn = fn
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for (values, value) in self._fn().items():
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, values), _format_value(value)))
+        return lines
+
+
+class CounterCallback(GaugeCallback):
+    """ a counter kept elsewhere (a driver counts on its own), read when the metrics are rendered. """
+    kind = "counter"
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+READY_WAIT = REGISTRY.register(Histogram("hx711_ready_wait_seconds", "Time spent waiting for DOUT to signal a conversion.", ("sensor",)))
+CLOCK_OUT = REGISTRY.register(Histogram("hx711_clock_out_seconds", "Time spent clocking a frame out of the hx711.", ("sensor",)))
+LOCK_WAIT = REGISTRY.register(Histogram("hx711_read_lock_wait_seconds", "Time spent waiting for the driver's read lock.", ("sensor",)))
+LOCK_HOLD = REGISTRY.register(Histogram("hx711_read_lock_hold_seconds", "Time the driver's read lock was held per frame.", ("sensor",)))
+FILTER_LATENCY = REGISTRY.register(Histogram("acquisition_filter_seconds", "Time spent pushing a sample through the gate, filter and estimator.", ("sensor",)))
+SAMPLES = REGISTRY.register(Counter("acquisition_samples_total", "Samples clocked into the ring buffer.", ("sensor",)))
+OUTLIERS = REGISTRY.register(Counter("acquisition_outliers_total", "Samples the outlier gate rejected.", ("sensor",)))
+DB_BATCH_SIZE = REGISTRY.register(Histogram("db_batch_size", "Statements drained from the db queue per batch.", ("series",), BATCH_BUCKETS))
+DB_COMMIT = REGISTRY.register(Histogram("db_commit_seconds", "Time a group commit took.", ("series",)))
+DB_ROWS = REGISTRY.register(Counter("db_rows_total", "Rows written by the db worker.", ("series",)))
+DB_ERRORS = REGISTRY.register(Counter("db_errors_total", "Statements the db worker failed to run.", ("series",)))
+REQUEST_LATENCY = REGISTRY.register(Histogram("http_request_duration_seconds", "Time to respond to an api request.", ("method", "route", "status")))
+
+
+class SensorMetrics(object):
+    """ the acquisition metrics of one sensor, label children bound once. passed to an AcquisitionChannel. """
+    def __init__(self, sensor):
+        self._ready_wait = READY_WAIT.labels(sensor)
+        self._clock_out = CLOCK_OUT.labels(sensor)
+        self._lock_wait = LOCK_WAIT.labels(sensor)
+        self._lock_hold = LOCK_HOLD.labels(sensor)
+        self._filter = FILTER_LATENCY.labels(sensor)
+        self._samples = SAMPLES.labels(sensor)
+        self._outliers = OUTLIERS.labels(sensor)
+
+    def observe_frame(self, device):
+        """ records the timings the driver kept for the frame it just read. """
+        self._lock_wait.observe(device.lastLockWait)
+        self._ready_wait.observe(device.lastReadyWait)
+        self._clock_out.observe(device.lastClockOut)
+        self._lock_hold.observe(device.lastLockHold)
+
+    def observe_sample(self, accepted, filter_seconds):
+        self._samples.inc()
+        if not accepted:
+            self._outliers.inc()
+        self._filter.observe(filter_seconds)
+
+
+class StorageMetrics(object):
+    """ the metrics of one DBWorker. """
+    def __init__(self, series):
+        self._batch_size = DB_BATCH_SIZE.labels(series)
+        self._commit = DB_COMMIT.labels(series)
+        self._rows = DB_ROWS.labels(series)
+        self._errors = DB_ERRORS.labels(series)
+
+    def observe_batch(self, size):
+        self._batch_size.observe(size)
+
+    def observe_commit(self, seconds, rows):
+        self._commit.observe(seconds)
+        self._rows.inc(rows)
+
+    def observe_errors(self, statements):
+        self._errors.inc(statements)
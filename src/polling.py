@@ -0,0 +1,83 @@
+from collections import deque
+
+NS_PER_S = 1000000000
+
+class AdaptivePollingRate(object):
+    """ picks how often the sensor worker logs a reading from how much the weight is moving.
+
+    the slope (weight units per second, between the oldest and newest of the readings of the last `window` seconds, at
+    least two) and the standard deviation of those readings are compared to their thresholds. once either goes above
+    its threshold the rate goes active and the interval drops to min_interval. it only leaves the active state once both
+    fell below threshold * hysteresis, so a signal hovering around a threshold doesn't flip back and forth. while
+    inactive the interval grows by `backoff` every time a whole interval passed, until it reaches max_interval. both are
+    in seconds, so they mean the same whether update() sees every logged reading or much more frequent ones. """
+    def __init__(self, min_interval, max_interval, slope_threshold, stddev_threshold, hysteresis=0.5, backoff=2, window=5):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("AdaptivePollingRate(): need 0 < min_interval <= max_interval!")
+
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._slope_threshold = slope_threshold
+        self._stddev_threshold = stddev_threshold
+        self._hysteresis = hysteresis
+        self._backoff = backoff
+        self._window = window * NS_PER_S
+
+        # start fast so the first minutes after a restart are logged in detail
+        self._interval = min_interval
+        self._active = True
+        # created date the interval was last set at
+        self._interval_since = None
+        self._slope = 0
+        self._stddev = 0
+
+        # (created date in ns, weight) of the readings in the window, with running sums for the variance
+        self._readings = deque()
+        self._total = 0.0
+        self._total_sq = 0.0
+
+    def update(self, created_date, weight):
+        """ feeds a reading (created date in ns) and returns the interval in seconds until the next one. """
+        self._readings.append((created_date, weight))
+        self._total += weight
+        self._total_sq += weight * weight
+
+        while len(self._readings) > 2 and self._readings[0][0] < created_date - self._window:
+            (_, old) = self._readings.popleft()
+            self._total -= old
+            self._total_sq -= old * old
+
+        n = len(self._readings)
+        (first_date, first) = self._readings[0]
+        elapsed = (created_date - first_date) / NS_PER_S
+        self._slope = (weight - first) / elapsed if elapsed > 0 else 0
+        mean = self._total / n
+        # the running sums can go very slightly negative through rounding
+        self._stddev = max(0.0, self._total_sq / n - mean * mean) ** 0.5
+
+        level = max(abs(self._slope) / self._slope_threshold, self._stddev / self._stddev_threshold)
+        if level >= 1:
+            self._active = True
+        elif self._active and level < self._hysteresis:
+            self._active = False
+
+        if self._active or self._interval_since is None:
+            self._interval = self._min_interval
+            self._interval_since = created_date
+        elif created_date - self._interval_since >= self._interval * NS_PER_S:
+            self._interval = min(self._max_interval, self._interval * self._backoff)
+            self._interval_since = created_date
+
+        return self._interval
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def state(self):
+        return {"interval": self._interval, "active": self._active, "slope": self._slope, "stddev": self._stddev}
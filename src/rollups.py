@@ -0,0 +1,79 @@
+""" incrementally maintained minute/hour/day rollups of the Weights table.
+
+every rollup row summarises one bucket of raw rows as (Count, Total, Min, Max, FirstDate, First, LastDate, Last), which
+can be merged with any other summary of adjacent rows. the DBWorker merges each batch of inserts into all rollups, and
+range queries merge rollup rows (or raw rows for short ranges) into the requested resolution. """
+
+NS_PER_S = 1000000000
+
+# (table, bucket size in seconds), finest first
+ROLLUPS = (
+    ("WeightsMinute", 60),
+    ("WeightsHour", 60 * 60),
+    ("WeightsDay", 24 * 60 * 60),
+)
+
+CREATE_ROLLUP = "CREATE TABLE IF NOT EXISTS {} (Bucket INTEGER PRIMARY KEY, Count INTEGER, Total REAL, Min REAL, Max REAL, FirstDate INTEGER, First REAL, LastDate INTEGER, Last REAL)"
+
+# sqlite evaluates every SET expression against the old row, so the First/Last cases see the old dates
+UPSERT_ROLLUP = """INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(Bucket) DO UPDATE SET
+    Count = Count + excluded.Count,
+    Total = Total + excluded.Total,
+    Min = min(Min, excluded.Min),
+    Max = max(Max, excluded.Max),
+    First = CASE WHEN excluded.FirstDate < FirstDate THEN excluded.First ELSE First END,
+    FirstDate = min(FirstDate, excluded.FirstDate),
+    Last = CASE WHEN excluded.LastDate >= LastDate THEN excluded.Last ELSE Last END,
+    LastDate = max(LastDate, excluded.LastDate)"""
+
+SELECT_ROLLUP_RANGE = "SELECT Bucket, Count, Total, Min, Max, FirstDate, First, LastDate, Last FROM {} WHERE Bucket >= ? AND Bucket <= ? ORDER BY Bucket"
+
+def summarise(rows, bucket_ns, origin=0):
+    """ folds rows into per-bucket summaries. rows are either raw (CreatedDate, Data) pairs or summaries
+    (Bucket, Count, Total, Min, Max, FirstDate, First, LastDate, Last). returns summaries keyed by bucket start in
+    insertion order. """
+    buckets = {}
+    for row in rows:
+        if len(row) == 2:
+            (created_date, data) = row
+            if data is None:
+                continue
+            row = (created_date, 1, data, data, data, created_date, data, created_date, data)
+
+        bucket = origin + (row[0] - origin) // bucket_ns * bucket_ns
+        summary = buckets.get(bucket)
+        if summary is None:
+            buckets[bucket] = [bucket] + list(row[1:])
+            continue
+
+        summary[1] += row[1]
+        summary[2] += row[2]
+        summary[3] = min(summary[3], row[3])
+        summary[4] = max(summary[4], row[4])
+        if row[5] < summary[5]:
+            summary[5] = row[5]
+            summary[6] = row[6]
+        if row[7] >= summary[7]:
+            summary[7] = row[7]
+            summary[8] = row[8]
+
+    return buckets
+
+def update(cur, rows):
+    """ merges a batch of raw (CreatedDate, Data) rows into every rollup table. """
+    for (table, size) in ROLLUPS:
+        summaries = summarise(rows, size * NS_PER_S)
+        cur.executemany(UPSERT_ROLLUP.format(table), [tuple(summary) for summary in summaries.values()])
+
+def choose(resolution_ns):
+    """ the coarsest rollup whose buckets are no wider than the requested resolution, or None for raw rows. """
+    chosen = None
+    for (table, size) in ROLLUPS:
+        if size * NS_PER_S <= resolution_ns:
+            chosen = (table, size)
+
+    return chosen
+
+def to_point(summary):
+    (bucket, count, total, minimum, maximum, _, first, _, last) = summary
+    return {"time": bucket, "count": count, "mean": total / count, "min": minimum, "max": maximum, "first": first, "last": last}
@@ -0,0 +1,171 @@
+""" acquisition in a process of its own, ACQUISITION_MODE "process".
+
+the hx711 powers down when PD_SCK stays high for more than 60us. in the api process every frame competes for the gil
+with uvicorn, pydantic and the db thread, so a thread switch in the middle of a frame can corrupt it or power cycle the
+chip. here a forked process does nothing but clock frames into one SharedSampleRing per sensor. the api process reads
+the rings in place: a RingDriver per sensor serves blocking reads (tare, calibration, fallback readings) and a
+RingFollower (src/acquisition.py) feeds the filters and the estimator. """
+import os
+import signal
+import time
+import multiprocessing
+
+from lib.hx711py import hx711_trace
+from lib.hx711py.hx711_emulator import HX711 as EmulatedHX711
+
+from src.acquisition import SharedSampleRing
+from src.acquisition import AcquisitionChannel
+from src.acquisition import GAIN_PULSES
+from src.acquisition import shared_drivers
+from src.acquisition import start_acquisition_threads
+
+from config import DEBUG
+from config import SENSOR_FRAME_RETRIES
+from config import CHANNEL_RUN_FRAMES
+from config import CHANNEL_SETTLE_FRAMES
+
+class RingClock(object):
+    """ the sensor process' driver clock as seen from another process. deadlines stay on the real monotonic clock. """
+    def __init__(self, ring):
+        self._ring = ring
+
+    def time(self):
+        return time.time() + self._ring.clock_offset
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class RingDriver(EmulatedHX711):
+    """ the hx711 api served from a sensor's SharedSampleRing, the way the chip serves it: a read waits for a sample
+    newer than the last one read and returns the newest. gains are passed on to the sensor process, offsets and
+    reference units stay here where weights are computed. """
+    def __init__(self, ring, poll_interval=0.001, gain=128):
+        self.ring = ring
+        self._poll_interval = poll_interval
+        self._position = ring.count
+        EmulatedHX711.__init__(self, None, None, gain, clock=RingClock(ring))
+        # these are real samples, tare them
+        self.simulateTare = True
+        # and already passed the integrity checks in the sensor process, where a frame of 0xFFFFFF is stuck dout. here
+        # it is a legitimate -1 and must not be thrown away
+        self.checkFrames = False
+
+    def set_gain(self, gain):
+        # the sensor process throws away the frame taken at the old gain
+        if gain not in GAIN_PULSES:
+            return False
+
+        self.GAIN = GAIN_PULSES[gain]
+        self.ring.requested_gain = gain
+        return True
+
+    def is_ready(self):
+        return self.ring.count > self._position
+
+    def wait_ready(self, deadline=None):
+        while not self.is_ready():
+            wait = self._poll_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            time.sleep(wait)
+
+        return True
+
+    def generateFakeSample(self):
+        # called by readSample once a sample is ready, with the read lock held
+        self._position = self.ring.count
+        (_, value) = self.ring.last()
+        self.sampleCount += 1
+        return value
+
+    def reset(self):
+        # the chip belongs to the sensor process
+        pass
+
+def run_sensor_process(sensor_configs, rings, build_driver, read_timeout, idle_sleep, stop_event, parent_pid):
+    """ main of the sensor process: clocks frames into the rings until stop_event is set or the api process dies,
+    applying the gains the api process asks for and publishing the frame integrity counters. """
+    # the api process decides when to stop, ctrl-c in the terminal must not cut a frame short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    drivers = shared_drivers(sensor_configs, build_driver)
+    recorders = []
+    for sensor_config in sensor_configs:
+        driver = drivers[sensor_config["name"]]
+        if sensor_config.get("trace_file"):
+            recorders.append(hx711_trace.HX711TraceRecorder(driver, sensor_config["trace_file"]))
+        driver.set_reading_format("MSB", "MSB")
+        driver.readTimeout = read_timeout
+        driver.frameRetries = SENSOR_FRAME_RETRIES
+
+    # the gains of an hx711 read on both channels are the ChannelRunScheduler's
+    shared = {name for (name, driver) in drivers.items() if list(drivers.values()).count(driver) > 1}
+    channels = [(AcquisitionChannel(drivers[sensor_config["name"]], rings[sensor_config["name"]]),
+        32 if sensor_config.get("channel") == "B" else drivers[sensor_config["name"]].get_gain(),
+        sensor_config.get("run_frames", CHANNEL_RUN_FRAMES)) for sensor_config in sensor_configs]
+    workers = start_acquisition_threads(channels, idle_sleep, CHANNEL_SETTLE_FRAMES)
+
+    try:
+        while True:
+            for (name, driver) in drivers.items():
+                ring = rings[name]
+                if name not in shared and ring.requested_gain and ring.requested_gain != driver.get_gain():
+                    driver.set_gain(ring.requested_gain)
+                ring.clock_offset = getattr(driver, "clock", time).time() - time.time()
+                ring.publish_frame_errors(getattr(driver, "frameErrorCounts", {}), getattr(driver, "frameFailureCount", 0))
+
+            if stop_event.wait(0.1) or os.getppid() != parent_pid:
+                break
+    finally:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join(1)
+        for recorder in recorders:
+            recorder.close()
+
+class SensorProcess(object):
+    """ owns the rings of all sensors and the process writing them. the process is forked, so create and start this
+    before the api process starts any thread: forking copies only the calling thread and could copy a held lock. """
+    def __init__(self, sensor_configs, ring_size, build_driver, read_timeout, idle_sleep=0.001):
+        self._rings = {sensor_config["name"]: SharedSampleRing(ring_size) for sensor_config in sensor_configs}
+        self._idle_sleep = idle_sleep
+
+        # fork, spawn would import the api module again in the child
+        context = multiprocessing.get_context("fork")
+        self._stop_event = context.Event()
+        self._process = context.Process(target=run_sensor_process, name="sensors", daemon=True,
+            args=(sensor_configs, self._rings, build_driver, read_timeout, idle_sleep, self._stop_event, os.getpid()))
+
+    def start(self):
+        self._process.start()
+        if DEBUG:
+            print("sensor_process: started pid {} rings {}".format(self._process.pid, {name: ring.name for (name, ring) in self._rings.items()}))
+
+    def stop(self, timeout=2):
+        self._stop_event.set()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+        for ring in self._rings.values():
+            ring.close()
+
+    def driver(self, name):
+        """ a RingDriver reading the ring of sensor `name`. """
+        return RingDriver(self._rings[name], self._idle_sleep)
+
+    def ring(self, name):
+        return self._rings[name]
+
+    @property
+    def alive(self):
+        return self._process.is_alive()
@@ -0,0 +1,90 @@
+""" streaming segmentation of the weight signal into consumption (weld) sessions.
+
+two one-sided CUSUMs run over the weight drawn between consecutive readings. `drift` is the flow (weight units per
+second) below which the cylinder counts as idle. while idle, the weight drawn in excess of drift * dt accumulates and a
+session starts once it passes start_threshold. while in a session, the weight not drawn (drift * dt minus what was
+drawn) accumulates and the session ends once that passes end_threshold. both start and end are dated back to where
+their CUSUM last left zero, which is the usual CUSUM estimate of the change point. every reading costs O(1). """
+
+NS_PER_S = 1000000000
+
+CREATE_SESSIONS = "CREATE TABLE IF NOT EXISTS Sessions (Id INTEGER PRIMARY KEY AUTOINCREMENT, StartDate INTEGER, EndDate INTEGER, GasUsed REAL, MeanFlow REAL)"
+CREATE_SESSIONS_INDEX = "CREATE INDEX IF NOT EXISTS SessionsStartDate ON Sessions (StartDate)"
+INSERT_SESSION = "INSERT INTO Sessions VALUES (NULL, ?, ?, ?, ?)"
+# sessions overlapping [start, end]
+SELECT_SESSIONS_RANGE = "SELECT StartDate, EndDate, GasUsed, MeanFlow FROM Sessions WHERE StartDate <= ? AND EndDate >= ? ORDER BY StartDate"
+
+def to_session(row):
+    (start, end, gas_used, mean_flow) = row
+    return {"start": start, "end": end, "gas_used": gas_used, "mean_flow": mean_flow}
+
+class SessionSegmenter(object):
+    def __init__(self, drift, start_threshold, end_threshold):
+        self._drift = drift
+        self._start_threshold = start_threshold
+        self._end_threshold = end_threshold
+
+        self._previous = None
+        self._in_session = False
+        self._cusum = 0.0
+        # (created date, weight) where the running CUSUM last left zero, the candidate change point
+        self._anchor = None
+        # (created date, weight) the current session started at
+        self._start = None
+
+    def push(self, created_date, weight):
+        """ feeds a reading (created date in ns). returns a finished session as (start, end, gas used, mean flow per
+        second) or None. """
+        if weight is None:
+            return None
+
+        previous = self._previous
+        self._previous = (created_date, weight)
+        if previous is None:
+            self._anchor = self._previous
+            return None
+
+        dt = (created_date - previous[0]) / NS_PER_S
+        if dt <= 0:
+            return None
+
+        drawn = previous[1] - weight
+        excess = drawn - self._drift * dt if not self._in_session else self._drift * dt - drawn
+
+        if self._cusum == 0:
+            # the change, if this turns out to be one, started at the previous reading
+            self._anchor = previous
+        self._cusum = max(0.0, self._cusum + excess)
+
+        if not self._in_session:
+            if self._cusum > self._start_threshold:
+                self._in_session = True
+                self._start = self._anchor
+                self._cusum = 0.0
+            return None
+
+        if self._cusum <= self._end_threshold:
+            return None
+
+        # ended where the weight last moved
+        (start_date, start_weight) = self._start
+        (end_date, end_weight) = self._anchor
+        self._in_session = False
+        self._start = None
+        self._cusum = 0.0
+
+        duration = (end_date - start_date) / NS_PER_S
+        gas_used = start_weight - end_weight
+        return (start_date, end_date, gas_used, gas_used / duration if duration > 0 else 0.0)
+
+    @property
+    def current(self):
+        """ the session in progress as a dict (end and gas used so far) or None while idle. """
+        if not self._in_session or self._previous is None:
+            return None
+
+        (start_date, start_weight) = self._start
+        (last_date, last_weight) = self._previous
+        duration = (last_date - start_date) / NS_PER_S
+        gas_used = start_weight - last_weight
+        return {"start": start_date, "end": last_date, "gas_used": gas_used, "mean_flow": gas_used / duration if duration > 0 else 0.0}
@@ -0,0 +1,294 @@
+import time
+import threading
+import sqlite3
+import queue
+
+from config import APP_NAME
+
+from config import DB_COMMIT_ROWS
+from config import DB_COMMIT_INTERVAL
+from config import DB_BATCH_MAX
+from config import DB_JOURNAL_MODE
+from config import DB_SYNCHRONOUS
+from config import DB_READ_TIMEOUT
+
+from src import rollups
+from src import sessions
+
+INSERT_WEIGHT = "INSERT INTO Weights VALUES (NULL, ?, ?)"
+SELECT_WEIGHTS_RANGE = "SELECT CreatedDate, Data FROM Weights WHERE CreatedDate >= ? AND CreatedDate <= ? ORDER BY CreatedDate"
+
+def db_path(series):
+    """ every sensor logs its own series into its own db file. """
+    return "{}-{}-db".format(APP_NAME, series)
+
+# queued to tell the worker to flush, commit and exit
+_STOP = object()
+
+class DBWorker(threading.Thread):
+    """ owns the sqlite connection and runs every queued statement on its own thread.
+
+    writes are group committed: the worker drains everything waiting in the queue, runs consecutive statements that
+    share the same sql with executemany, and only commits once DB_COMMIT_ROWS rows are pending or DB_COMMIT_INTERVAL
+    seconds have passed since the last commit. statements with a callback (reads) run one by one. an optional
+    StorageMetrics (src/metrics.py) records batch sizes and commit latency. """
+    def __init__(self, series, metrics=None):
+        threading.Thread.__init__(self, daemon=True)
+        self._db_path = db_path(series)
+        self._metrics = metrics
+        self._db = None
+        self._queue = queue.Queue()
+        # group commit bookkeeping, see commit_stats
+        self._rows_written = 0
+        self._commits = 0
+        self._commit_seconds = 0.0
+        self._last_commit_seconds = 0.0
+        self._max_commit_seconds = 0.0
+        # statements that raised, their rows are lost
+        self._errors = 0
+
+    def enqueue(self, sql, sql_params: tuple | None = None, cb=None):
+        self._queue.put((sql, sql_params, cb), False)
+
+    def insert_weight(self, created_date, data):
+        self.enqueue(INSERT_WEIGHT, (created_date, data))
+
+    def insert_session(self, start, end, gas_used, mean_flow):
+        self.enqueue(sessions.INSERT_SESSION, (start, end, gas_used, mean_flow))
+
+    def stop(self):
+        """ flushes and commits everything queued before this call, then ends the worker. """
+        self._queue.put(_STOP, False)
+
+    @property
+    def path(self):
+        return self._db_path
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    @property
+    def commit_stats(self):
+        """ rows written, commits and how long the commits took (seconds), and statements that failed. """
+        return {"rows": self._rows_written, "commits": self._commits, "commit_seconds": self._commit_seconds,
+            "last_commit_seconds": self._last_commit_seconds, "max_commit_seconds": self._max_commit_seconds,
+            "errors": self._errors}
+
+    def _commit(self, rows):
+        start = time.perf_counter()
+        self._db.commit()
+        elapsed = time.perf_counter() - start
+
+        if self._metrics is not None:
+            self._metrics.observe_commit(elapsed, rows)
+
+        self._commits += 1
+        self._commit_seconds += elapsed
+        self._last_commit_seconds = elapsed
+        self._max_commit_seconds = max(self._max_commit_seconds, elapsed)
+
+    def _connect(self):
+        # the connection has to be created on the thread that uses it
+        self._db = sqlite3.connect(self._db_path)
+        # WAL appends to a log instead of rewriting pages and with synchronous=NORMAL only syncs on checkpoints,
+        # which suits an append-heavy workload on an sd card.
+        self._db.execute("PRAGMA journal_mode={}".format(DB_JOURNAL_MODE))
+        self._db.execute("PRAGMA synchronous={}".format(DB_SYNCHRONOUS))
+        self._db.execute("PRAGMA temp_store=MEMORY")
+
+    def _create_schema(self):
+        # first creates a table if not exists
+        self._db.execute("CREATE TABLE IF NOT EXISTS Weights (Id INTEGER PRIMARY KEY AUTOINCREMENT, CreatedDate INTEGER, Data INTEGER)")
+        # range queries over history filter on CreatedDate
+        self._db.execute("CREATE INDEX IF NOT EXISTS WeightsCreatedDate ON Weights (CreatedDate)")
+
+        for (table, _) in rollups.ROLLUPS:
+            self._db.execute(rollups.CREATE_ROLLUP.format(table))
+
+        self._db.execute(sessions.CREATE_SESSIONS)
+        self._db.execute(sessions.CREATE_SESSIONS_INDEX)
+
+        self._backfill_rollups()
+        self._db.commit()
+
+    def _backfill_rollups(self):
+        """ builds the rollups from history logged before they existed. only does work on the first start after an
+        upgrade, afterwards the rollups are kept up to date as rows are inserted. """
+        (table, _) = rollups.ROLLUPS[0]
+        if self._db.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is not None:
+            return
+
+        cur = self._db.execute("SELECT CreatedDate, Data FROM Weights ORDER BY CreatedDate")
+        while True:
+            rows = cur.fetchmany(DB_BATCH_MAX)
+            if not rows:
+                break
+            rollups.update(self._db.cursor(), rows)
+
+    def _drain(self, timeout):
+        """ blocks for the first item (up to timeout seconds) then takes whatever else is already waiting. """
+        batch = []
+        try:
+            batch.append(self._queue.get(block=True, timeout=timeout))
+            while len(batch) < DB_BATCH_MAX:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return batch
+
+    def _execute(self, batch):
+        """ runs a drained batch, returns the number of rows (or statements without a callback) written. """
+        rows = 0
+        i = 0
+        while i < len(batch):
+            (sql, sql_params, cb) = batch[i]
+            cur = self._db.cursor()
+            # statements the attempt below covers, all of a grouped executemany
+            statements = 1
+
+            try:
+                if cb is None and sql_params:
+                    # group the run of identical statements that follows into one executemany
+                    j = i + 1
+                    while j < len(batch) and batch[j][0] == sql and batch[j][2] is None and batch[j][1]:
+                        j += 1
+
+                    params = [item[1] for item in batch[i:j]]
+                    statements = len(params)
+                    i = j
+                    cur.executemany(sql, params)
+                    if sql == INSERT_WEIGHT:
+                        rollups.update(cur, params)
+                    rows += len(params)
+                    continue
+
+                i += 1
+                if sql_params:
+                    cur.execute(sql, sql_params)
+                else:
+                    cur.execute(sql)
+
+                if cb:
+                    cb(cur.fetchall())
+                else:
+                    rows += 1
+
+            except Exception as e:
+                # always reported, a failed insert loses logged weights
+                self._errors += statements
+                if self._metrics is not None:
+                    self._metrics.observe_errors(statements)
+                print("db: {} statement(s) failed: {} ({})".format(statements, sql, e))
+
+            finally:
+                cur.close()
+
+        return rows
+
+    def run(self):
+        self._connect()
+        self._create_schema()
+
+        pending = 0
+        first_pending = time.monotonic()
+
+        while True:
+            # nothing to commit: sleep until work arrives, otherwise wake up in time for the interval commit
+            timeout = None if pending == 0 else max(0, DB_COMMIT_INTERVAL - (time.monotonic() - first_pending))
+            batch = self._drain(timeout)
+            if self._metrics is not None and batch:
+                self._metrics.observe_batch(len(batch))
+
+            if pending == 0:
+                first_pending = time.monotonic()
+
+            stop = _STOP in batch
+            written = self._execute([item for item in batch if item is not _STOP])
+            pending += written
+            self._rows_written += written
+
+            if pending > 0 and (pending >= DB_COMMIT_ROWS or time.monotonic() - first_pending >= DB_COMMIT_INTERVAL):
+                self._commit(pending)
+                pending = 0
+
+            if stop:
+                self._commit(pending)
+                self._db.close()
+                return
+
+
+class ReadPool(object):
+    """ small pool of read-only connections for history queries. with the WAL journal readers never block the
+    DBWorker's inserts and inserts never wait on a long scan, so reads don't go through the worker's queue.
+    connections are opened on first use since the db file only exists once the DBWorker created it. """
+    def __init__(self, path, size):
+        self._path = path
+        self._size = size
+        self._opened = 0
+        self._open_lock = threading.Lock()
+        self._connections = queue.Queue()
+
+    def _acquire(self):
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._open_lock:
+            if self._opened < self._size:
+                self._opened += 1
+                try:
+                    return self._open()
+                except Exception:
+                    self._opened -= 1
+                    raise
+
+        return self._connections.get(block=True, timeout=DB_READ_TIMEOUT)
+
+    def _open(self):
+        con = sqlite3.connect("file:{}?mode=ro".format(self._path), uri=True, check_same_thread=False)
+        con.execute("PRAGMA query_only=ON")
+        return con
+
+    def query(self, sql, sql_params: tuple = ()):
+        """ runs a read-only statement on a pooled connection and returns all rows. """
+        con = self._acquire()
+        try:
+            return con.execute(sql, sql_params).fetchall()
+        finally:
+            self._connections.put(con)
+
+    def weights(self, start, end):
+        """ (CreatedDate, Data) rows with start <= CreatedDate <= end, both in ns since the epoch. """
+        return self.query(SELECT_WEIGHTS_RANGE, (start, end))
+
+    def sessions(self, start, end):
+        """ sessions overlapping start..end (ns since the epoch), from the Sessions table the segmenter fills. """
+        return [sessions.to_session(row) for row in self.query(sessions.SELECT_SESSIONS_RANGE, (end, start))]
+
+    def aggregate(self, start, end, resolution):
+        """ summaries of the rows with start <= CreatedDate <= end in buckets of at least `resolution`, all in ns.
+        reads the coarsest rollup that is still fine enough and only falls back to raw rows when the resolution is
+        finer than a minute. """
+        rollup = rollups.choose(resolution)
+
+        if rollup is None:
+            rows = self.weights(start, end)
+            bucket_ns = max(1, resolution)
+        else:
+            (table, size) = rollup
+            size_ns = size * rollups.NS_PER_S
+            rows = self.query(rollups.SELECT_ROLLUP_RANGE.format(table), (start // size_ns * size_ns, end))
+            # whole rollup buckets only, a rollup bucket can't be split
+            bucket_ns = max(1, resolution // size_ns) * size_ns
+
+        return [rollups.to_point(summary) for summary in rollups.summarise(rows, bucket_ns).values()]
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
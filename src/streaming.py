@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+class Subscription(object):
+    """ one streaming client. decides per sample whether the client wants it (rate limit, decimation, delta threshold)
+    and buffers the already serialized messages. a slow client drops its oldest messages instead of growing the
+    buffer or holding up anyone else. """
+    def __init__(self, min_interval=0, decimation=1, min_delta=0, maxsize=16):
+        self._queue = asyncio.Queue(maxsize)
+        self._min_interval_ns = int(min_interval * 1000000000)
+        self._decimation = max(1, decimation)
+        self._min_delta = min_delta
+        self._seen = 0
+        self._last_sent = None
+
+    def offer(self, created_date, weight, message):
+        self._seen += 1
+        if (self._seen - 1) % self._decimation != 0:
+            return
+
+        if self._last_sent is not None:
+            (last_date, last_weight) = self._last_sent
+            if created_date - last_date < self._min_interval_ns:
+                return
+            if weight is not None and last_weight is not None and abs(weight - last_weight) < self._min_delta:
+                return
+
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(message)
+        self._last_sent = (created_date, weight)
+
+    async def get(self):
+        return await self._queue.get()
+
+
+class Broadcaster(object):
+    """ fans samples published by the sensor worker out to every streaming client. each sample is serialized into a
+    server-sent event once, and that same bytes object is handed to every subscriber. publish is called from the
+    sensor thread, the fan out runs on the event loop. """
+    def __init__(self):
+        self._loop = None
+        self._subscribers = set()
+        self._sequence = 0
+
+    def bind(self, loop):
+        self._loop = loop
+
+    def publish(self, created_date, weight, **fields):
+        if self._loop is None or not self._subscribers:
+            return
+
+        self._sequence += 1
+        payload = json.dumps(dict(timestamp=created_date, weight=weight, **fields))
+        message = "id: {}\ndata: {}\n\n".format(self._sequence, payload).encode()
+        self._loop.call_soon_threadsafe(self._fan_out, created_date, weight, message)
+
+    def _fan_out(self, created_date, weight, message):
+        for subscription in self._subscribers:
+            subscription.offer(created_date, weight, message)
+
+    def subscribe(self, min_interval=0, decimation=1, min_delta=0):
+        subscription = Subscription(min_interval, decimation, min_delta)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)